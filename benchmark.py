@@ -0,0 +1,206 @@
+"""
+Benchmarks of the blpapiwrapper hot paths, run offline against fakeblpapi.
+End to end benchmarks (bdp, bdh, BLPTS.get) include the time the fake takes to build its responses, the others time the wrapper code alone on prebuilt messages.
+Usage:
+    python benchmark.py                                    # print a table
+    python benchmark.py --scale 0.1 --repeat 1             # quick run
+    python benchmark.py --json results.json                # save the timings, e.g. as a CI artifact
+    python benchmark.py --compare baseline.json --tolerance 0.25   # exit code 1 if any benchmark is more than 25% slower than the baseline
+"""
+
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import sys
+import timeit
+
+import fakeblpapi
+fakeblpapi.install()
+import blpapiwrapper
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Registers setup(scale), which returns (number of items processed, function to time)"""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def _securities(n):
+    return ['XS%010d Corp' % i for i in range(0, n)]
+
+
+REFERENCE_FIELDS = ['PX_LAST', 'PX_BID', 'PX_ASK', 'YLD_YTM_MID', 'DUR_ADJ_MID', 'CPN', 'AMT_OUTSTANDING', 'CRNCY', 'MATURITY', 'NAME']
+HISTORY_FIELDS   = ['PX_LAST', 'PX_OPEN', 'PX_HIGH', 'PX_LOW', 'VOLUME']
+
+
+@benchmark('bdp list')
+def bdpList(scale):
+    securities = _securities(int(5000 * scale))
+    blp = blpapiwrapper.BLP(pooled=True)
+    return len(securities) * len(REFERENCE_FIELDS), lambda: blp.bdp(securities, REFERENCE_FIELDS)
+
+
+@benchmark('bdp scalar')
+def bdpScalar(scale):
+    securities = _securities(int(200 * scale))
+    blp = blpapiwrapper.BLP(pooled=True)
+    return len(securities), lambda: [blp.bdp(s, 'PX_LAST') for s in securities]
+
+
+@benchmark('bdh')
+def bdh(scale):
+    securities = _securities(int(100 * scale))
+    blp = blpapiwrapper.BLP(pooled=True)
+    return len(securities) * len(HISTORY_FIELDS) * 2610, lambda: blp.bdh(securities, HISTORY_FIELDS, datetime.date(2010, 1, 1), datetime.date(2019, 12, 31))
+
+
+@benchmark('BLPTS.get reference')
+def blptsReference(scale):
+    securities = _securities(int(10000 * scale))
+    blpts = blpapiwrapper.BLPTS(securities, REFERENCE_FIELDS, pooled=True)
+    return len(securities) * len(REFERENCE_FIELDS), blpts.get
+
+
+@benchmark('BLPTS.get historical')
+def blptsHistory(scale):
+    securities = _securities(int(100 * scale))
+    blpts = blpapiwrapper.BLPTS(securities, HISTORY_FIELDS, startDate=datetime.datetime(2010, 1, 1), endDate=datetime.datetime(2019, 12, 31), pooled=True)
+    return len(securities) * len(HISTORY_FIELDS) * 2610, blpts.get
+
+
+@benchmark('bdit')
+def bdit(scale):
+    blp   = blpapiwrapper.BLP(pooled=True)
+    days  = max(1, int(5 * scale))
+    ticks = days * 24 * fakeblpapi.config.intradayTicksPerHour
+    return ticks, lambda: blp.bdit('SPX Index', datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 1) + datetime.timedelta(days=days))
+
+
+@benchmark('reference decoder')
+def referenceDecoder(scale):
+    securities = _securities(int(10000 * scale))
+    request    = fakeblpapi.Service('//blp/refdata').createRequest('ReferenceDataRequest')
+    for s in securities:
+        request.append('securities', s)
+    for f in REFERENCE_FIELDS:
+        request.append('fields', f)
+    messages = list(fakeblpapi._referenceMessages(request, fakeblpapi.CorrelationId(0)))
+
+    def run():
+        decoder = blpapiwrapper._ReferenceDataDecoder(securities, REFERENCE_FIELDS)
+        for msg in messages:
+            decoder.addMessage(msg)
+        return decoder.frame()
+    return len(securities) * len(REFERENCE_FIELDS), run
+
+
+@benchmark('history accumulator')
+def historyAccumulator(scale):
+    securities = _securities(int(100 * scale))
+    request    = fakeblpapi.Service('//blp/refdata').createRequest('HistoricalDataRequest')
+    for s in securities:
+        request.append('securities', s)
+    for f in HISTORY_FIELDS:
+        request.append('fields', f)
+    request.set('startDate', '20100101')
+    request.set('endDate', '20191231')
+    messages = list(fakeblpapi._historyMessages(request, fakeblpapi.CorrelationId(0)))
+
+    def run():
+        history = blpapiwrapper._HistoryAccumulator(HISTORY_FIELDS)
+        for msg in messages:
+            history.addMessage(msg)
+        return history.wide(securities)
+    return len(securities) * len(HISTORY_FIELDS) * 2610, run
+
+
+@benchmark('_dict_from_element')
+def dictFromElement(scale):
+    fakeblpapi.config.bulkRows = 100
+    elements = [fakeblpapi.bulkElement(s, 'DVD_HIST_ALL') for s in _securities(int(1000 * scale))]
+    fakeblpapi.config.bulkRows = 10
+    return len(elements) * 100, lambda: [blpapiwrapper._dict_from_element(e) for e in elements]
+
+
+@benchmark('bulk decoder')
+def bulkDecoder(scale):
+    fakeblpapi.config.bulkRows = 100
+    elements = [(s, fakeblpapi.bulkElement(s, 'DVD_HIST_ALL')) for s in _securities(int(1000 * scale))]
+    fakeblpapi.config.bulkRows = 10
+
+    def run():
+        decoder = blpapiwrapper._BulkDecoder()
+        for security, element in elements:
+            decoder.add(security, element)
+        return decoder.frame('DVD_HIST_ALL')
+    return len(elements) * 100, run
+
+
+@benchmark('BLPStream.handleDataEvent')
+def handleDataEvent(scale):
+    securities = _securities(3000)
+    stream     = blpapiwrapper.BLPStream(securities, ['BID', 'ASK'], 0, list(range(0, len(securities))))
+    events     = [fakeblpapi.tickEvent([(i % len(securities), ['BID', 'ASK'])]) for i in range(0, int(100000 * scale))]
+    return len(events), lambda: [stream.handleDataEvent(e) for e in events]
+
+
+@benchmark('BLPStream burst')
+def streamBurst(scale):
+    """Events of 50 messages each, as blpapi batches them during bursts"""
+    securities = _securities(3000)
+    stream     = blpapiwrapper.BLPStream(securities, ['BID', 'ASK', 'LAST_PRICE', 'VOLUME'], 0, list(range(0, len(securities))))
+    events     = [fakeblpapi.tickEvent([((i * 50 + j) % len(securities), ['BID', 'ASK', 'LAST_PRICE', 'VOLUME']) for j in range(0, 50)]) for i in range(0, int(2000 * scale))]
+    return len(events) * 50, lambda: [stream.handleDataEvent(e) for e in events]
+
+
+def run(scale, repeat, names=None):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        items, function = setup(scale)
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+        results[name] = {'items': items, 'seconds': seconds, 'itemsPerSecond': items / seconds if seconds > 0 else float('inf')}
+        print('%-28s %12d items %10.4f s %14.0f items/s' % (name, items, seconds, results[name]['itemsPerSecond']))
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the names of the benchmarks more than tolerance slower than the baseline, per item processed"""
+    slower = []
+    for name, result in results.items():
+        if name in baseline and result['itemsPerSecond'] < baseline[name]['itemsPerSecond'] / (1 + tolerance):
+            print('REGRESSION %s: %.0f items/s vs %.0f in baseline' % (name, result['itemsPerSecond'], baseline[name]['itemsPerSecond']))
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='blpapiwrapper benchmarks against the offline fakeblpapi backend')
+    parser.add_argument('--scale', type=float, default=1., help='multiplies every benchmark size')
+    parser.add_argument('--repeat', type=int, default=3, help='the best of that many runs is reported')
+    parser.add_argument('--only', nargs='*', help='names of the benchmarks to run')
+    parser.add_argument('--json', help='file to save the results to')
+    parser.add_argument('--compare', help='results file of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown allowed by --compare')
+    args = parser.parse_args()
+
+    results = run(args.scale, args.repeat, args.only)
+    blpapiwrapper.BLPSessionPool.closeAll()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
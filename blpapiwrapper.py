@@ -8,22 +8,50 @@ Released under Apache 2.0 license. More info at http://www.apache.org/licenses/L
 from __future__ import print_function
 from abc import ABCMeta, abstractmethod
 import blpapi
+import collections
 import datetime
+import getpass
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
 import pandas
+import socket
+import stat
+import struct
+import tempfile
 import threading
+import time
+import zlib
+import numpy
 from numpy import nan
+try:
+    import queue
+    import socketserver
+except ImportError:  # Python 2
+    import Queue as queue
+    import SocketServer as socketserver
 
 #This makes successive requests faster
+AUTHORIZATION_FAILURE = blpapi.Name("AuthorizationFailure")
+AUTHORIZATION_REVOKED = blpapi.Name("AuthorizationRevoked")
+AUTHORIZATION_SUCCESS = blpapi.Name("AuthorizationSuccess")
 DATE             = blpapi.Name("date")
 ERROR_INFO       = blpapi.Name("errorInfo")
 EVENT_TIME       = blpapi.Name("EVENT_TIME")
 FIELD_DATA       = blpapi.Name("fieldData")
 FIELD_EXCEPTIONS = blpapi.Name("fieldExceptions")
 FIELD_ID         = blpapi.Name("fieldId")
+RESPONSE_ERROR   = blpapi.Name("responseError")
 SECURITY         = blpapi.Name("security")
 SECURITY_DATA    = blpapi.Name("securityData")
+TIME             = blpapi.Name("time")
 
 BLPAPI_VERSION = float(blpapi.version()[0:4]) # the MessageIterator next() method became hidden starting in blpapi 3.18
+_ORDINAL_1970  = datetime.date(1970, 1, 1).toordinal()
 ################################################
 
 
@@ -32,17 +60,22 @@ class BLPSession(blpapi.Session):
     host_ip: server IP
     host_port: server port
     uuid: the user who's authenticating - determines market data permissions
-    local_ip: the ip of the uuid user - has to be the latest machine the user logged in from"""
-    def __init__(self, host_ip=None, host_port=None, uuid=None, local_ip=None):
+    local_ip: the ip of the uuid user - has to be the latest machine the user logged in from
+    eventHandler: optional callback(event, session) putting the session in asynchronous mode - the authorization response still comes through its own event queue
+    Without uuid, a SAPI session authorizes no one, see BLPIdentityPool."""
+    def __init__(self, host_ip=None, host_port=None, uuid=None, local_ip=None, eventHandler=None):
         if host_ip is not None:
             host_port = int(host_port)  # needs to be an int
-            uuid = int(uuid)  # needs to be an int
             opt = blpapi.SessionOptions()
             opt.setClientMode(2)
             opt.setServerHost(host_ip)
             opt.setServerPort(host_port)
-            blpapi.Session.__init__(self, opt)
-            self.start()
+            blpapi.Session.__init__(self, opt, eventHandler)
+        else:
+            blpapi.Session.__init__(self, None, eventHandler)
+        self.start()
+        if host_ip is not None and uuid is not None:
+            uuid = int(uuid)  # needs to be an int
             identity = self.createIdentity()
             self.openService('//blp/apiauth')
             apiAuthSvc = self.getService('//blp/apiauth')
@@ -50,9 +83,10 @@ class BLPSession(blpapi.Session):
             auth_req.set('uuid', uuid)
             auth_req.set('ipAddress', local_ip)
             corr = blpapi.CorrelationId(uuid)
-            self.sendAuthorizationRequest(auth_req, identity, corr)
+            auth_queue = blpapi.EventQueue()
+            self.sendAuthorizationRequest(auth_req, identity, corr, auth_queue)
             while True:
-                event = self.nextEvent()
+                event = auth_queue.nextEvent()
                 if event.eventType() == blpapi.event.Event.RESPONSE:
                     break
             msg_iter = blpapi.event.MessageIterator(event)
@@ -63,45 +97,581 @@ class BLPSession(blpapi.Session):
             else:
                 print(str(uuid) + ' failed to connect.')
                 self.auth_success = False
+################################################
+
+
+class BLPRoutedEvent(object):
+    """The messages of one blpapi event that belong to one correlation id, handle being the BLPRequestHandle they were routed to.
+    Behaves like a blpapi.Event as far as this module is concerned: eventType() and iteration over messages."""
+    def __init__(self, eventType, messages, handle=None):
+        self._eventType = eventType
+        self.messages   = messages
+        self.handle     = handle
+
+    def eventType(self):
+        return self._eventType
+
+    def __iter__(self):
+        return iter(self.messages)
+
+
+class BLPRequestHandle(object):
+    """Receives the events routed to it by a BLPSharedSession.
+    nextEvent mimics blpapi.Session.nextEvent (timeout in milliseconds, 0 waits forever), so request loops read the same as with a private session.
+    events: optional queue shared with other handles, see sibling.
+    stats: the BLPStats recording the latency of the request, if any - set by BLPSharedSession.sendRequest.
+    deadline: optional time.time() by which the final response must be in, see _responseMessages.
+    finished: set by _responseMessages once the final response or a request failure is in."""
+    def __init__(self, sharedSession, events=None):
+        self.sharedSession = sharedSession
+        self.correlationId = blpapi.CorrelationId(self)
+        self.events        = events if events is not None else queue.Queue()
+        self.stats         = None
+        self.sentTime      = None
+        self.firstTime     = None
+        self.deadline      = None
+        self.cancelled     = False
+        self.finished      = False
+
+    def sibling(self, sharedSession):
+        """A handle with its own correlation id delivering into the same queue, to read the responses to several requests in one loop"""
+        return BLPRequestHandle(sharedSession, self.events)
+
+    def deliver(self, event):
+        self.events.put(event)
+
+    def cancel(self):
+        """Cancels the request, and delivers an empty REQUEST_STATUS event in place of the responses that will not come"""
+        self.cancelled = True
+        self.sharedSession.cancel(self)
+        self.deliver(BLPRoutedEvent(blpapi.event.Event.REQUEST_STATUS, [], self))
+
+    def nextEvent(self, timeout=0):
+        try:
+            return self.events.get(timeout=timeout / 1000. if timeout > 0 else None)
+        except queue.Empty:
+            return BLPRoutedEvent(blpapi.event.Event.TIMEOUT, [])
+
+
+class BLPSharedSession(object):
+    """A BLPSession in asynchronous mode: blpapi's dispatcher thread calls dispatch, which routes every message to the BLPRequestHandle of its correlation id.
+    Many requests and subscriptions can therefore be in flight on one session at the same time, from any number of threads.
+    Requests are tagged with their handle as correlation id. Subscriptions keep their user defined integer correlation ids, which must be unique per session.
+    sapi_dic is used for the SAPI connection."""
+
+    def __init__(self, sapi_dic=None):
+        self.pooled   = False
+        self.stopped  = False
+        self.lock     = threading.Lock()
+        self.services = {}
+        self.routes   = {}  # integer correlation id -> subscription handle
+        self.recorder = None
+        if sapi_dic is not None:
+            self.session = BLPSession(sapi_dic['host_ip'], sapi_dic['host_port'], sapi_dic.get('uuid'), sapi_dic.get('local_ip'), eventHandler=self.processEvent)
         else:
-            blpapi.Session.__init__(self)
-            self.start()
+            self.session = BLPSession(eventHandler=self.processEvent)
+
+    def getService(self, serviceName):
+        with self.lock:
+            if serviceName not in self.services:
+                self.session.openService(serviceName)
+                self.services[serviceName] = self.session.getService(serviceName)
+            return self.services[serviceName]
+
+    def sendRequest(self, request, handle=None, stats=None, identity=None):
+        """handle: optional BLPRequestHandle (or subclass) to receive the response, a new one is created otherwise
+        stats: optional BLPStats recording the latency to the first and to the final response
+        identity: optional blpapi Identity the request is entitled as, see BLPIdentityPool"""
+        if handle is None:
+            handle = BLPRequestHandle(self)
+        if stats is not None:
+            handle.stats    = stats
+            handle.sentTime = time.time()
+            stats.count('requests')
+        if self.recorder is not None:
+            self.recorder.request(request, handle)
+        self.session.sendRequest(request, identity, correlationId=handle.correlationId)
+        return handle
+
+    def cancel(self, handle):
+        self.session.cancel(handle.correlationId)
+
+    def subscribe(self, subscriptionList, intCorrIDList, stats=None, handle=None, identity=None):
+        """stats: optional BLPStats counting the messages received
+        handle: optional BLPRequestHandle to route the subscriptions to, e.g. the one of earlier subscriptions - a new one is created otherwise
+        identity: optional blpapi Identity the subscriptions are entitled as"""
+        if handle is None:
+            handle = BLPRequestHandle(self)
+        if stats is not None:
+            handle.stats = stats
+        with self.lock:
+            for intCorrID in intCorrIDList:
+                if intCorrID in self.routes:
+                    raise ValueError('Correlation ID ' + str(intCorrID) + ' is already subscribed on this session')
+            for intCorrID in intCorrIDList:
+                self.routes[intCorrID] = handle
+        if self.recorder is not None:
+            self.recorder.subscribe(subscriptionList)
+        self.session.subscribe(subscriptionList, identity)
+        return handle
+
+    def unsubscribe(self, subscriptionList, handle):
+        self.session.unsubscribe(subscriptionList)
+        with self.lock:
+            for i in range(0, subscriptionList.size()):
+                intCorrID = subscriptionList.correlationIdAt(i).value()
+                if self.routes.get(intCorrID) is handle:
+                    del self.routes[intCorrID]
+
+    def authorize(self, uuid, ipAddress, handle):
+        """Sends a SAPI authorization request for the user, whose response and later status messages are routed to handle. Returns the identity being authorized."""
+        request = self.getService('//blp/apiauth').createAuthorizationRequest()
+        request.set('uuid', int(uuid))
+        request.set('ipAddress', ipAddress)
+        identity = self.session.createIdentity()
+        self.session.sendAuthorizationRequest(request, identity, handle.correlationId)
+        return identity
+
+    def resubscribe(self, subscriptionList):
+        """Changes the fields or options of subscriptions, keeping their correlation ids and routes"""
+        self.session.resubscribe(subscriptionList)
+
+    def record(self, recorder):
+        """Writes every request, subscription and response or subscription event of this session to recorder, a BLPRecorder, from now on. None stops recording."""
+        self.recorder = recorder
+
+    def processEvent(self, event, session):
+        self.dispatch(event)
+
+    def dispatch(self, event):
+        if self.recorder is not None:
+            self.recorder.event(event)
+        routed = {}
+        for msg in event:
+            for corrID in msg.correlationIds():
+                value = corrID.value()
+                handle = value if isinstance(value, BLPRequestHandle) else self.routes.get(value)
+                if handle is not None:
+                    routed.setdefault(handle, []).append(msg)
+        for handle, messages in routed.items():
+            if handle.stats is not None:
+                handle.stats.received(handle, event.eventType(), len(messages))
+            try:
+                handle.deliver(BLPRoutedEvent(event.eventType(), messages, handle))
+            except Exception as e:
+                # one broken handle must not keep the event from the others, nor kill the dispatcher thread
+                print('error delivering event: ' + str(e))
+
+    def stop(self):
+        self.stopped = True
+        self.session.stop()
+
+
+class BLPSessionPool(object):
+    """Process-wide pool of BLPSharedSession objects that BLP, BLPTS and BLPStream can borrow with pooled=True.
+    Sessions are keyed by SAPI connection details (None for desktop) and a slot number, started on first use and kept warm until closeAll()."""
+    lock     = threading.Lock()
+    sessions = {}
+
+    @classmethod
+    def getSession(cls, sapi_dic=None, slot=0):
+        key = (_sapiKey(sapi_dic), slot)
+        with cls.lock:
+            session = cls.sessions.get(key)
+            if session is None or session.stopped:
+                session        = BLPSharedSession(sapi_dic)
+                session.pooled = True
+                cls.sessions[key] = session
+            return session
+
+    @classmethod
+    def closeAll(cls):
+        with cls.lock:
+            for session in cls.sessions.values():
+                session.stop()
+            cls.sessions.clear()
+
+
+def _sapiKey(sapi_dic):
+    if sapi_dic is None:
+        return None
+    return (sapi_dic['host_ip'], str(sapi_dic['host_port']), str(sapi_dic.get('uuid')), sapi_dic.get('local_ip'))
+
+
+def _openSession(sapi_dic=None, pooled=False):
+    return BLPSessionPool.getSession(sapi_dic) if pooled else BLPSharedSession(sapi_dic)
+
+
+class BLPIdentityPool(object):
+    """Authorized SAPI identities of any number of users on one server-mode session, so that per-user entitlements do not need a session per user.
+    Identities are cached by (uuid, ipAddress) and authorized on first use. Concurrent calls for the same user wait for the same authorization,
+    those for different users authorize at the same time. An identity Bloomberg revokes is dropped, and authorized again when next asked for.
+    Pass the identity to BLP(identity=...), BLPTS(..., identity=...) or BLPStream(..., identity=...): their requests and subscriptions are then entitled as that user.
+    sapi_dic: host_ip and host_port of the server API, without uuid - the session itself authorizes no one. Its pooled session is used unless sharedSession is given.
+    timeout: seconds an authorization may take, after which BLPTimeoutError is raised.
+    Example:
+    pool = BLPIdentityPool({'host_ip': '10.0.0.1', 'host_port': 8194})
+    BLP(pool.sapi_dic, pooled=True, identity=pool.getIdentity(12345678, '10.0.0.42')).bdp('AAPL US Equity', 'PX_LAST')
+    """
+
+    def __init__(self, sapi_dic=None, sharedSession=None, timeout=30):
+        self.sapi_dic   = sapi_dic
+        self.session    = sharedSession if sharedSession is not None else BLPSessionPool.getSession(sapi_dic)
+        self.timeout    = timeout
+        self.lock       = threading.Lock()
+        self.identities = {}  # (uuid, ipAddress) -> _IdentityHandle
+        self.counts     = collections.Counter()
+
+    def getIdentity(self, uuid, ipAddress):
+        """The blpapi Identity of the user, authorizing it first if needed. Raises BLPAuthorizationError if Bloomberg refuses it."""
+        key = (int(uuid), ipAddress)
+        with self.lock:
+            handle = self.identities.get(key)
+            if handle is None:
+                handle = self.identities[key] = _IdentityHandle(self, key)
+                self.counts['authorizations'] += 1
+            else:
+                self.counts['hits'] += 1
+        return handle.wait(self.timeout)
+
+    def drop(self, handle, revoked=False):
+        """Forgets an identity that failed or was revoked, unless it was replaced already"""
+        with self.lock:
+            if revoked:
+                self.counts['revocations'] += 1
+            if self.identities.get(handle.key) is handle:
+                del self.identities[handle.key]
+
+    def summary(self):
+        with self.lock:
+            return {'identities': len(self.identities), 'authorizations': self.counts['authorizations'], 'hits': self.counts['hits'], 'revocations': self.counts['revocations']}
+
+
+class BLPAuthorizationError(Exception):
+    pass
+
+
+class _IdentityHandle(BLPRequestHandle):
+    """Receives the authorization response and later status messages of one identity of a BLPIdentityPool, on the dispatcher thread"""
+
+    def __init__(self, pool, key):
+        BLPRequestHandle.__init__(self, pool.session)
+        self.pool     = pool
+        self.key      = key
+        self.ready    = threading.Event()
+        self.error    = None
+        self.identity = pool.session.authorize(key[0], key[1], self)
+
+    def deliver(self, event):
+        if event.eventType() == blpapi.event.Event.REQUEST_STATUS and not self.ready.is_set():
+            # RequestFailure, or the request was cancelled: no authorization response will come
+            self.error = 'authorization request failed for uuid ' + str(self.key[0]) + ''.join(': ' + str(msg.asElement()) for msg in event)
+            self.pool.drop(self)
+            self.ready.set()
+            return
+        for msg in event:
+            if msg.messageType() == AUTHORIZATION_SUCCESS:
+                self.ready.set()
+            elif msg.messageType() in (AUTHORIZATION_FAILURE, AUTHORIZATION_REVOKED):
+                self.error = str(msg.messageType()) + ' for uuid ' + str(self.key[0])
+                self.pool.drop(self, msg.messageType() == AUTHORIZATION_REVOKED)
+                self.ready.set()
+
+    def wait(self, timeout):
+        if not self.ready.wait(timeout):
+            self.pool.drop(self)
+            raise BLPTimeoutError('no authorization response for uuid ' + str(self.key[0]))
+        if self.error is not None:
+            raise BLPAuthorizationError(self.error)
+        return self.identity
+################################################
+
+class BLPTimeoutError(Exception):
+    """Raised when the responses to a request with a timeout do not arrive in time. The request is cancelled."""
+    pass
+
+
+class BLPScheduler(object):
+    """Sends requests in priority order within Bloomberg quotas, passed as scheduler= to any number of BLP and BLPTS objects.
+    Requests wait in one queue per priority, lowest number first: an INTERACTIVE request goes out before any BATCH request still waiting,
+    so overnight loads can be queued in bulk without slowing lookups down. Within a priority, requests go out in the order they came.
+    requestsPerSecond, securitiesPerSecond: optional token bucket limits, with bursts of up to one second's worth.
+    A request whose deadline passes or which is cancelled while waiting is dropped.
+    One thread sends the requests, callers read the responses on their handles as usual.
+    Example:
+    scheduler = BLPScheduler(requestsPerSecond=50, securitiesPerSecond=5000)
+    BLP(pooled=True, scheduler=scheduler, timeout=10).bdp(bonds, 'PX_LAST')
+    BLPTS(universe, fields, pooled=True, scheduler=scheduler, priority=BLPScheduler.BATCH).get()
+    close() stops the thread, also on leaving a with block.
+    """
+    INTERACTIVE = 0
+    BATCH       = 10
+
+    def __init__(self, requestsPerSecond=None, securitiesPerSecond=None, stats=None):
+        self.requestBucket  = _TokenBucket(requestsPerSecond)
+        self.securityBucket = _TokenBucket(securitiesPerSecond)
+        self.stats          = stats
+        self.condition      = threading.Condition()
+        self.waiting        = []  # heap of (priority, sequence number, (session, request, handle, requestStats, identity, securities, queuedTime))
+        self.sequence       = itertools.count()
+        self.counts         = collections.Counter()
+        self.closed         = False
+        self.thread         = threading.Thread(target=self.run)
+        self.thread.daemon  = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def sendRequest(self, sharedSession, request, handle=None, stats=None, priority=INTERACTIVE, identity=None):
+        """Queues the request for sharedSession.sendRequest and returns its handle straight away"""
+        if handle is None:
+            handle = BLPRequestHandle(sharedSession)
+        with self.condition:
+            if self.closed:
+                raise ValueError('BLPScheduler is closed')
+            heapq.heappush(self.waiting, (priority, next(self.sequence), (sharedSession, request, handle, stats, identity, _requestSecurities(request), time.time())))
+            self.condition.notify()
+        return handle
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.waiting) == 0 and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                priority, n, item = self.waiting[0]
+                sharedSession, request, handle, stats, identity, securities, queuedTime = item
+                now = time.time()
+                if handle.cancelled or handle.deadline is not None and handle.deadline < now:
+                    heapq.heappop(self.waiting)
+                    self.counts['dropped'] += 1
+                    continue
+                wait = max(self.requestBucket.wait(1, now), self.securityBucket.wait(securities, now))
+                if wait > 0:
+                    self.condition.wait(wait)  # a more urgent request may come in meanwhile
+                    continue
+                heapq.heappop(self.waiting)
+                self.requestBucket.take(1)
+                self.securityBucket.take(securities)
+                self.counts['sent'] += 1
+            if self.stats is not None:
+                self.stats.record('schedulerWait', now - queuedTime)
+            try:
+                sharedSession.sendRequest(request, handle, stats, identity)
+            except Exception as e:
+                print('error sending scheduled request: ' + str(e))
+                handle.deliver(BLPRoutedEvent(blpapi.event.Event.REQUEST_STATUS, [], handle))
+
+    def close(self, timeout=None):
+        """Stops the thread. Requests still waiting get an empty REQUEST_STATUS event, as if they had failed."""
+        with self.condition:
+            self.closed = True
+            waiting, self.waiting = self.waiting, []
+            self.condition.notify()
+        for priority, n, item in waiting:
+            handle = item[2]
+            handle.deliver(BLPRoutedEvent(blpapi.event.Event.REQUEST_STATUS, [], handle))
+        self.thread.join(timeout)
+
+    def summary(self):
+        """Requests waiting per priority, and requests sent and dropped so far"""
+        with self.condition:
+            waiting = collections.Counter(priority for (priority, n, item) in self.waiting)
+            return {'waiting': dict(waiting), 'sent': self.counts['sent'], 'dropped': self.counts['dropped']}
+
+
+class _TokenBucket(object):
+    """rate tokens per second, up to rate in store. Taking more tokens than are available leaves a debt, so large requests are not starved. rate=None never waits."""
+    def __init__(self, rate):
+        self.rate   = rate
+        self.tokens = rate
+        self.time   = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.time) * self.rate)
+        self.time   = now
+
+    def wait(self, n, now):
+        """Seconds until n tokens can be taken"""
+        if self.rate is None:
+            return 0
+        self.refill(now)
+        return 0 if self.tokens >= min(n, self.rate) else (min(n, self.rate) - self.tokens) / self.rate
+
+    def take(self, n):
+        if self.rate is not None:
+            self.tokens -= n
+
+
+def _requestSecurities(request):
+    try:
+        return request.getElement('securities').numValues()
+    except Exception:
+        return 1  # intraday requests have a single security
+################################################
+
+
+class BLPStats(object):
+    """Optional instrumentation for BLP, BLPTS and BLPStream, passed as stats=BLPStats(). Objects without one skip all timing.
+    Timings, in seconds, go into log-spaced histograms:
+    firstPartialLatency: request sent to its first partial or final response received
+    responseLatency: request sent to its final response received
+    decode: time spent decoding one response event (BLPTS, BLPStream) or the responses to one call (BLP), excluding observers
+    observers: time spent in one updateObservers call
+    Counters: requests, responses, messages, ticks (field updates decoded by BLPStream).
+    summary() returns a dictionary of all of them, with the counters also per second since the last reset.
+    hook: optional callable(name, value) receiving every timing and counter increment as it is recorded, e.g. to feed a metrics exporter.
+    One BLPStats can be shared by several objects, it is thread-safe."""
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.startTime  = time.time()
+            self.histograms = {}
+            self.counters   = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = _Histogram()
+            histogram.add(seconds)
+        self.callHook(name, seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        self.callHook(name, n)
+
+    def callHook(self, name, value):
+        if self.hook is not None:
+            try:
+                self.hook(name, value)
+            except Exception as e:
+                print('error in stats hook: ' + str(e))
+
+    def received(self, handle, eventType, messageCount):
+        """Called by BLPSharedSession.dispatch for every event routed to a handle carrying this BLPStats"""
+        now = time.time()
+        self.count('messages', messageCount)
+        if eventType not in (blpapi.event.Event.PARTIAL_RESPONSE, blpapi.event.Event.RESPONSE):
+            return
+        if handle.firstTime is None:
+            handle.firstTime = now
+            self.record('firstPartialLatency', now - handle.sentTime)
+        if eventType == blpapi.event.Event.RESPONSE:
+            self.count('responses')
+            self.record('responseLatency', now - handle.sentTime)
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.startTime
+            output  = {'elapsed': elapsed}
+            for name, histogram in self.histograms.items():
+                output[name] = histogram.summary()
+            for name, n in self.counters.items():
+                output[name] = n
+                output[name + 'PerSecond'] = n / elapsed if elapsed > 0 else nan
+        return output
+
+
+class _Histogram(object):
+    """Bucket k counts the values up to 2**(k/4) microseconds, so percentiles are accurate to 19%"""
+    buckets = 128  # up to 2**32 microseconds, over an hour
+
+    def __init__(self):
+        self.counts = [0] * self.buckets
+        self.n      = 0
+        self.total  = 0.
+        self.min    = float('inf')
+        self.max    = 0.
+
+    def add(self, seconds):
+        microseconds = seconds * 1e6
+        k = int(math.ceil(4 * math.log(microseconds, 2))) if microseconds > 1 else 0
+        self.counts[min(k, self.buckets - 1)] += 1
+        self.n     += 1
+        self.total += seconds
+        self.min    = min(self.min, seconds)
+        self.max    = max(self.max, seconds)
+
+    def percentile(self, p):
+        rank       = p / 100. * self.n
+        cumulative = 0
+        for k, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= rank and n > 0:
+                return min(max(2 ** (k / 4.) / 1e6, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.n, 'mean': self.total / self.n, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
 
 
 class BLP:
     """Naive implementation of the Request/Response Paradigm closely matching the Excel API.
-    Sharing one session for subsequent requests is faster, however it is not thread-safe, as some events can come faster than others.
+    Sharing one session for subsequent requests is faster. Responses are routed by correlation ID, so one BLP object can be used from several threads.
     bdp returns a string, bdh returns a pandas DataFrame.
     This is mostly useful for scripting, but care should be taken when used in a real world application.
     Desktop users should not need to use sapi_dic.
+    pooled=True borrows a warm session from BLPSessionPool instead of starting a new one.
+    Lists passed to bdp and bdh are split into requests of at most securitiesPerRequest securities and fieldsPerRequest fields.
+    historyStore: optional BLPHistoryStore - bdh then only asks Bloomberg for the date ranges the store lacks.
+    referenceCache: optional BLPReferenceCache - bdp then only asks Bloomberg for the securities and fields the cache lacks.
+    With a referenceCache, bdp for a single security and field returns the typed value rather than a string.
+    coalescer: optional BLPRequestCoalescer - bdp then shares its requests with the other threads using the same coalescer. bdp returns typed values as with a referenceCache.
+    A coalescer sends with its own scheduler, so it cannot be combined with scheduler.
+    stats: optional BLPStats recording request latencies and decode times.
+    scheduler: optional BLPScheduler the requests then go through, at the given priority.
+    timeout: optional seconds each request may take, after which it is cancelled and BLPTimeoutError raised.
+    identity: optional blpapi Identity every request is entitled as, e.g. from a BLPIdentityPool on a SAPI session. A coalescer only shares values between callers with the same identity, a referenceCache between all its users.
+    bdib and bdit return intraday bars and ticks. Windows longer than intradayBarSpan or intradayTickSpan are split into sub-ranges fetched concurrently.
     """
-
-    def __init__(self, sapi_dic=None):
-        if sapi_dic is not None:
-            self.session = BLPSession(sapi_dic['host_ip'], sapi_dic['host_port'], sapi_dic['uuid'], sapi_dic['local_ip'])
-        else:
-            self.session = BLPSession()
-        self.session.openService('//BLP/refdata')
-        self.refDataSvc = self.session.getService('//BLP/refdata')
+    securitiesPerRequest = 500
+    fieldsPerRequest     = 20
+    intradayBarSpan      = datetime.timedelta(days=30)
+    intradayTickSpan     = datetime.timedelta(days=1)
+
+    def __init__(self, sapi_dic=None, pooled=False, historyStore=None, referenceCache=None, stats=None, coalescer=None, scheduler=None, priority=BLPScheduler.INTERACTIVE, timeout=None, identity=None):
+        if coalescer is not None and scheduler is not None:
+            raise ValueError('pass the scheduler to the BLPRequestCoalescer instead')
+        self.session        = _openSession(sapi_dic, pooled)
+        self.refDataSvc     = self.session.getService('//BLP/refdata')
+        self.historyStore   = historyStore
+        self.referenceCache = referenceCache
+        self.stats          = stats
+        self.coalescer      = coalescer
+        self.scheduler      = scheduler
+        self.priority       = priority
+        self.timeout        = timeout
+        self.identity       = identity
 
     def bdp(self, strSecurity='US900123AL40 Govt', strData='PX_LAST', strOverrideField='', strOverrideValue=''):
+        """A single security and field returns a string.
+        Lists of securities and/or fields return a typed DataFrame indexed by security with one column per field, fetched in chunked requests that are all in flight at once."""
+        if type(strSecurity) != str or type(strData) != str:
+            return self._bdpFrame(strSecurity, strData, strOverrideField, strOverrideValue)
+        if self.referenceCache is not None or self.coalescer is not None:
+            return self._bdpFrame(strSecurity, strData, strOverrideField, strOverrideValue).iloc[0, 0]
+
         request = self.refDataSvc.createRequest('ReferenceDataRequest')
         request.append('securities', strSecurity)
         request.append('fields', strData)
+        _setOverride(request, strOverrideField, strOverrideValue)
 
-        if strOverrideField != '':
-            o = request.getElement('overrides').appendElement()
-            o.setElement('fieldId', strOverrideField)
-            o.setElement('value', strOverrideValue)
-
-        requestID = self.session.sendRequest(request)
-
-        while True:
-            event = self.session.nextEvent()
-            if event.eventType() == blpapi.event.Event.RESPONSE:
-                break
+        messages = list(_responseMessages(self._send(request)))
         try:
-            output = blpapi.event.MessageIterator(event).__next__().getElement(SECURITY_DATA).getValueAsElement(0).getElement(FIELD_DATA).getElementAsString(strData) if BLPAPI_VERSION > 3.17 else blpapi.event.MessageIterator(event).next().getElement(SECURITY_DATA).getValueAsElement(0).getElement(FIELD_DATA).getElementAsString(strData)
+            output = messages[-1].getElement(SECURITY_DATA).getValueAsElement(0).getElement(FIELD_DATA).getElementAsString(strData)
             if output == '#N/A':
                 output = nan
         except:
@@ -109,48 +679,627 @@ class BLP:
             output = nan
         return output
 
+    def _bdpFrame(self, securities, fields, strOverrideField, strOverrideValue):
+        overrides = _overrideKey(strOverrideField, strOverrideValue)
+        decoder, missingSecurities, missingFields = self._cachedDecoder(_uniqueList(securities), _uniqueList(fields), overrides)
+        if self.coalescer is not None:
+            for security, values in self.coalescer.getMany(missingSecurities, missingFields, overrides, self.timeout, self.identity).items():
+                decoder.seed({security: values})
+                if self.referenceCache is not None:
+                    self.referenceCache.putMany(security, _knownValues(values), overrides)
+            return decoder.frame()
+        handles = self._sendAll(self._referenceRequests(missingSecurities, missingFields, strOverrideField, strOverrideValue))
+        try:
+            return self._decodeReference(decoder, itertools.chain.from_iterable(_responseMessages(h) for h in handles), overrides)
+        finally:
+            _cancelUnfinished(handles)
+
+    def _cachedDecoder(self, securities, fields, overrides):
+        """Returns a decoder seeded with the cached values, and the securities and fields still to request"""
+        decoder = _ReferenceDataDecoder(securities, fields)
+        if self.referenceCache is None:
+            return decoder, securities, fields
+        cached = self.referenceCache.getMany(securities, fields, overrides)
+        decoder.seed(cached)
+        return (decoder,) + _missingRectangle(securities, fields, cached)
+
+    def _decodeReference(self, decoder, messages, overrides):
+        timer = _DecodeTimer(self.stats)
+        for msg in timer.wrap(messages):
+            for security, values in decoder.addMessage(msg):
+                if self.referenceCache is not None:
+                    self.referenceCache.putMany(security, values, overrides)
+        return timer.record(decoder.frame)
+
+    def _referenceRequests(self, securities, fields, strOverrideField='', strOverrideValue=''):
+        requests = []
+        for securityChunk in _chunks(securities, self.securitiesPerRequest):
+            for fieldChunk in _chunks(fields, self.fieldsPerRequest):
+                request = self.refDataSvc.createRequest('ReferenceDataRequest')
+                for s in securityChunk:
+                    request.append('securities', s)
+                for f in fieldChunk:
+                    request.append('fields', f)
+                _setOverride(request, strOverrideField, strOverrideValue)
+                requests.append(request)
+        return requests
+
+    def bds(self, strSecurity='AAPL US Equity', strData='DVD_HIST_ALL', strOverrideField='', strOverrideValue=''):
+        """Bulk fields as flat tables: one DataFrame per field with a security column and one column per sub-element, one row per bulk row.
+        A single field returns its DataFrame, a list of fields a dictionary of them. Requests are chunked as for bdp and all in flight at once."""
+        decoder = _BulkDecoder()
+        handles = self._sendAll(self._referenceRequests(_uniqueList(strSecurity), _uniqueList(strData), strOverrideField, strOverrideValue))
+        timer   = _DecodeTimer(self.stats)
+        try:
+            for msg in timer.wrap(itertools.chain.from_iterable(_responseMessages(h) for h in handles)):
+                decoder.addMessage(msg)
+        finally:
+            _cancelUnfinished(handles)
+        output = timer.record(lambda: dict((field, decoder.frame(field)) for field in _uniqueList(strData)))
+        return output[strData] if type(strData) == str else output
+
     def bdh(self, strSecurity='SPX Index', strData='PX_LAST', startdate=datetime.date(2014, 1, 1), enddate=datetime.date(2014, 1, 9), adjustmentSplit=False, periodicity='DAILY', strOverrideField='', strOverrideValue=''):
-        request = self.refDataSvc.createRequest('HistoricalDataRequest')
-        request.append('securities', strSecurity)
-        if type(strData) == str:
-            strData = [strData]
+        """A single security returns a DataFrame indexed by date with one column per field.
+        A list of securities returns a DataFrame with (Security, Field) MultiIndex columns, fetched in chunked requests that are all in flight at once."""
+        strData    = _uniqueList(strData)
+        securities = _uniqueList(strSecurity)
+        if self.historyStore is not None:
+            output = self.historyStore.history(self._fetchHistory, securities, strData, startdate, enddate, adjustmentSplit, periodicity, strOverrideField, strOverrideValue)
+        else:
+            output = self._fetchHistory(securities, strData, startdate, enddate, adjustmentSplit, periodicity, strOverrideField, strOverrideValue)
+        return output[strSecurity].rename_axis(None, axis=1) if type(strSecurity) == str else output
 
-        for strD in strData:
-            request.append('fields', strD)
+    def _fetchHistory(self, securities, fields, startdate, enddate, adjustmentSplit=False, periodicity='DAILY', strOverrideField='', strOverrideValue=''):
+        """Wide DataFrame with (Security, Field) MultiIndex columns"""
+        requests = self._historyRequests(securities, fields, startdate, enddate, adjustmentSplit, periodicity, strOverrideField, strOverrideValue)
+        handles  = self._sendAll([r for (r, fieldChunk) in requests])
+        try:
+            return self._historyOutput(securities, fields, [(_responseMessages(h), fieldChunk) for (h, (r, fieldChunk)) in zip(handles, requests)])
+        finally:
+            _cancelUnfinished(handles)
+
+    def _historyRequests(self, securities, fields, startdate, enddate, adjustmentSplit=False, periodicity='DAILY', strOverrideField='', strOverrideValue=''):
+        requests = []
+        for securityChunk in _chunks(securities, self.securitiesPerRequest):
+            for fieldChunk in _chunks(fields, self.fieldsPerRequest):
+                request = self.refDataSvc.createRequest('HistoricalDataRequest')
+                for s in securityChunk:
+                    request.append('securities', s)
+                for f in fieldChunk:
+                    request.append('fields', f)
+                _setOverride(request, strOverrideField, strOverrideValue)
+                request.set('startDate', startdate.strftime('%Y%m%d'))
+                request.set('endDate', enddate.strftime('%Y%m%d'))
+                request.set('adjustmentSplit', 'TRUE' if adjustmentSplit else 'FALSE')
+                request.set('periodicitySelection', periodicity)
+                requests.append((request, fieldChunk))
+        return requests
+
+    def _historyOutput(self, securities, fields, responses):
+        """responses: list of (messages, fieldChunk), one per request"""
+        history = _HistoryAccumulator(fields)
+        timer   = _DecodeTimer(self.stats)
+        for messages, fieldChunk in responses:
+            for msg in timer.wrap(messages):
+                history.addMessage(msg, fieldChunk)
+        return timer.record(history.wide, securities)
 
-        if strOverrideField != '':
-            o = request.getElement('overrides').appendElement()
-            o.setElement('fieldId', strOverrideField)
-            o.setElement('value', strOverrideValue)
+    def bdhOHLC(self, strSecurity='SPX Index', startdate=datetime.date(2014, 1, 1), enddate=datetime.date(2014, 1, 9), periodicity='DAILY'):
+        return self.bdh(strSecurity, ['PX_OPEN', 'PX_HIGH', 'PX_LOW', 'PX_LAST'], startdate, enddate, False, periodicity)
 
-        request.set('startDate', startdate.strftime('%Y%m%d'))
-        request.set('endDate', enddate.strftime('%Y%m%d'))
-        request.set('adjustmentSplit', 'TRUE' if adjustmentSplit else 'FALSE')
-        request.set('periodicitySelection', periodicity)
-        requestID = self.session.sendRequest(request)
+    def bdib(self, strSecurity='SPX Index', startDateTime=datetime.datetime(2014, 1, 2, 14, 30), endDateTime=datetime.datetime(2014, 1, 2, 21), interval=1, eventType='TRADE'):
+        """Intraday bars of interval minutes, times in UTC.
+        A single security returns a DataFrame indexed by bar time with columns open, high, low, close, volume, numEvents.
+        A list of securities returns a dictionary of such DataFrames. All the sub-range requests of all the securities are in flight at once."""
+        requests = dict((s, [self._intradayBarRequest(s, start, end, interval, eventType) for (start, end) in _timeRanges(startDateTime, endDateTime, self.intradayBarSpan)]) for s in _uniqueList(strSecurity))
+        return self._intradayOutput(strSecurity, requests, _IntradayDecoder.bars)
+
+    def bdit(self, strSecurity='SPX Index', startDateTime=datetime.datetime(2014, 1, 2, 14, 30), endDateTime=datetime.datetime(2014, 1, 2, 15), eventTypes=['TRADE']):
+        """Intraday ticks, times in UTC.
+        A single security returns a DataFrame indexed by tick time with columns type, value, size.
+        A list of securities returns a dictionary of such DataFrames. All the sub-range requests of all the securities are in flight at once."""
+        requests = dict((s, [self._intradayTickRequest(s, start, end, eventTypes) for (start, end) in _timeRanges(startDateTime, endDateTime, self.intradayTickSpan)]) for s in _uniqueList(strSecurity))
+        return self._intradayOutput(strSecurity, requests, _IntradayDecoder.ticks)
+
+    def bditChunks(self, strSecurity='SPX Index', startDateTime=datetime.datetime(2014, 1, 2, 14, 30), endDateTime=datetime.datetime(2014, 1, 2, 15), eventTypes=['TRADE'], requestsInFlight=2):
+        """Generator of the ticks of one security as DataFrames like bdit's, one per response message, in time order.
+        Only requestsInFlight sub-range requests are in flight at a time, so multi-day histories stream through in constant memory."""
+        decoder  = _IntradayDecoder.ticks()
+        requests = collections.deque(self._intradayTickRequest(strSecurity, start, end, eventTypes) for (start, end) in _timeRanges(startDateTime, endDateTime, self.intradayTickSpan))
+        handles  = collections.deque()
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        try:
+            while requests or handles:
+                while requests and len(handles) < requestsInFlight:
+                    handles.append(self._send(requests.popleft(), deadline=deadline))
+                for msg in _responseMessages(handles[0]):
+                    chunk = decoder.decode(msg, strSecurity)
+                    if chunk is not None:
+                        yield decoder.frame([chunk])
+                handles.popleft()
+        finally:
+            # left early, by the caller or a BLPTimeoutError
+            _cancelUnfinished(handles)
+
+    def _intradayBarRequest(self, security, startDateTime, endDateTime, interval, eventType):
+        request = self.refDataSvc.createRequest('IntradayBarRequest')
+        request.set('security', security)
+        request.set('eventType', eventType)
+        request.set('interval', interval)
+        request.set('startDateTime', startDateTime)
+        request.set('endDateTime', endDateTime)
+        return request
+
+    def _intradayTickRequest(self, security, startDateTime, endDateTime, eventTypes):
+        request = self.refDataSvc.createRequest('IntradayTickRequest')
+        request.set('security', security)
+        for eventType in _uniqueList(eventTypes):
+            request.append('eventTypes', eventType)
+        request.set('startDateTime', startDateTime)
+        request.set('endDateTime', endDateTime)
+        return request
+
+    def _intradayOutput(self, strSecurity, requests, makeDecoder):
+        """requests: {security: [requests in time order]}, all sent before any response is read"""
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        handles  = dict((s, [self._send(r, deadline=deadline) for r in securityRequests]) for (s, securityRequests) in requests.items())
+        output   = {}
+        try:
+            for security, securityHandles in handles.items():
+                decoder = makeDecoder()
+                timer   = _DecodeTimer(self.stats)
+                chunks  = [decoder.decode(msg, security) for h in securityHandles for msg in timer.wrap(_responseMessages(h))]
+                output[security] = timer.record(decoder.frame, [c for c in chunks if c is not None])
+        finally:
+            _cancelUnfinished(itertools.chain.from_iterable(handles.values()))
+        return output[strSecurity] if type(strSecurity) == str else output
+
+    def _sendAll(self, requests):
+        """Sends the requests with one deadline for them all, and returns their handles"""
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        return [self._send(r, deadline=deadline) for r in requests]
+
+    def _send(self, request, handle=None, deadline=None):
+        """Sends the request, through the scheduler if any, and returns its handle - a new BLPRequestHandle unless one is given.
+        deadline: optional time.time() by which the response must be in, self.timeout seconds from now by default"""
+        if handle is None:
+            handle = BLPRequestHandle(self.session)
+        if deadline is None and self.timeout is not None:
+            deadline = time.time() + self.timeout
+        handle.deadline = deadline
+        if self.scheduler is not None:
+            return self.scheduler.sendRequest(self.session, request, handle, self.stats, self.priority, self.identity)
+        return self.session.sendRequest(request, handle, self.stats, self.identity)
 
-        while True:
-            event = self.session.nextEvent()
-            if event.eventType() == blpapi.event.Event.RESPONSE:
-                break
+    def closeSession(self):
+        if not self.session.pooled:
+            self.session.stop()
+################################################
 
-        fieldDataArray = blpapi.event.MessageIterator(event).__next__().getElement(SECURITY_DATA).getElement(FIELD_DATA) if BLPAPI_VERSION > 3.17 else blpapi.event.MessageIterator(event).next().getElement(SECURITY_DATA).getElement(FIELD_DATA)
-        fieldDataList = [fieldDataArray.getValueAsElement(i) for i in range(0, fieldDataArray.numValues())]
-        outDates = [x.getElementAsDatetime(DATE) for x in fieldDataList]
-        output = pandas.DataFrame(index=outDates, columns=strData)
 
-        for strD in strData:
-            output[strD] = [x.getElementAsFloat(strD) for x in fieldDataList]
+class BLPHistoryStore(object):
+    """Opt-in local store of historical data, used by BLP.bdh and simpleHistoryRequest when passed as historyStore.
+    Each series is keyed by security, field, periodicity, adjustment and overrides and kept as two .npy files (dates and values) that are memory-mapped on read,
+    except on Windows where a mapped file cannot be replaced, next to a small json file listing the date ranges already fetched.
+    Requests only go to Bloomberg for the ranges the store lacks. Calls for different securities fetch at the same time, those for the same security wait for each other.
+    Data from today onwards is never marked as fetched, as it can still change. Best suited to DAILY periodicity.
+    Example:
+    store = BLPHistoryStore('/data/bbg_history')
+    BLP(historyStore=store).bdh(['SPX Index', 'SX5E Index'], 'PX_LAST', datetime.date(2010, 1, 1), datetime.date.today())
+    """
+
+    def __init__(self, path):
+        self.path          = path
+        self.lock          = threading.Lock()
+        self.securityLocks = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def history(self, fetch, securities, fields, startdate, enddate, adjustmentSplit=False, periodicity='DAILY', strOverrideField='', strOverrideValue='', longFormat=False):
+        """fetch(securities, fields, startdate, enddate, adjustmentSplit, periodicity, strOverrideField, strOverrideValue) returns a wide DataFrame
+        with (Security, Field) MultiIndex columns, e.g. BLP._fetchHistory. Returns the same for the requested range, served from the store,
+        or the long security, date, field, value format of BLPTS.historyFrame."""
+        settings = (periodicity, bool(adjustmentSplit), strOverrideField, str(strOverrideValue))
+        start, end = _day(startdate), _day(enddate)
+        # always taken in the same order, so that two calls cannot each hold a lock the other waits for
+        locks = [self.securityLock(security) for security in sorted(set(securities))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            missing = {}
+            for security in securities:
+                for field in fields:
+                    for r in _missingRanges(self.load(security, field, settings)[2], start, end):
+                        missing.setdefault(r, (set(), set()))
+                        missing[r][0].add(security)
+                        missing[r][1].add(field)
+            for (rangeStart, rangeEnd), (missingSecurities, missingFields) in missing.items():
+                missingSecurities = [s for s in securities if s in missingSecurities]
+                missingFields     = [f for f in fields if f in missingFields]
+                fetched = fetch(missingSecurities, missingFields, rangeStart.astype(datetime.date), rangeEnd.astype(datetime.date), adjustmentSplit, periodicity, strOverrideField, strOverrideValue)
+                for security in missingSecurities:
+                    for field in missingFields:
+                        self.merge(security, field, settings, rangeStart, rangeEnd, fetched[(security, field)])
+
+            history = _HistoryAccumulator(fields)
+            for security in securities:
+                for field in fields:
+                    dates, values, covered = self.load(security, field, settings)
+                    inRange = (dates >= start) & (dates <= end)
+                    history.append(security, dates[inRange], [field], values[inRange])
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        return history.long() if longFormat else history.wide(securities)
+
+    def securityLock(self, security):
+        with self.lock:
+            return self.securityLocks.setdefault(security, threading.Lock())
+
+    def filename(self, security, field, settings):
+        return os.path.join(self.path, hashlib.sha1(repr((security, field) + settings).encode('utf-8')).hexdigest())
+
+    def load(self, security, field, settings):
+        """Returns (dates, values, covered ranges), dates and values being read-only memory maps"""
+        filename = self.filename(security, field, settings)
+        if not os.path.exists(filename + '.json'):
+            return numpy.array([], dtype='datetime64[D]'), numpy.array([]), []
+        with open(filename + '.json') as f:
+            covered = [(numpy.datetime64(a), numpy.datetime64(b)) for (a, b) in json.load(f)['covered']]
+        mmapMode = None if os.name == 'nt' else 'r'
+        return numpy.load(filename + '.dates.npy', mmap_mode=mmapMode), numpy.load(filename + '.values.npy', mmap_mode=mmapMode), covered
+
+    def merge(self, security, field, settings, rangeStart, rangeEnd, series):
+        """Replaces the stored data between rangeStart and rangeEnd with series"""
+        dates, values, covered = self.load(security, field, settings)
+        keep      = (dates < rangeStart) | (dates > rangeEnd)
+        series    = series.dropna()
+        newDates  = series.index.values.astype('datetime64[D]')
+        inRange   = (newDates >= rangeStart) & (newDates <= rangeEnd)
+        dates     = numpy.concatenate([dates[keep], newDates[inRange]])
+        values    = numpy.concatenate([values[keep], series.values[inRange].astype(float)])
+        order     = numpy.argsort(dates, kind='mergesort')
+        lastFinal = numpy.datetime64(datetime.date.today()) - numpy.timedelta64(1, 'D')
+        if rangeStart <= lastFinal:
+            covered = _mergeRanges(covered + [(rangeStart, min(rangeEnd, lastFinal))])
+
+        filename = self.filename(security, field, settings)
+        for suffix, array in (('.dates.npy', dates[order]), ('.values.npy', values[order])):
+            with open(filename + suffix + '.tmp', 'wb') as f:
+                numpy.save(f, array)
+            _replace(filename + suffix + '.tmp', filename + suffix)
+        with open(filename + '.json.tmp', 'w') as f:
+            json.dump({'security': security, 'field': field, 'settings': list(settings), 'covered': [(str(a), str(b)) for (a, b) in covered]}, f)
+        _replace(filename + '.json.tmp', filename + '.json')
+
+
+def _replace(src, dst, attempts=10):
+    '''
+    os.replace, which Python 2 lacks. On Windows, where a file still open in another process cannot be replaced, retries for a while before raising.
+    '''
+    for attempt in range(0, attempts):
+        try:
+            if hasattr(os, 'replace'):
+                return os.replace(src, dst)
+            if os.name == 'nt' and os.path.exists(dst):  # rename does not overwrite there
+                os.remove(dst)
+            return os.rename(src, dst)
+        except OSError:  # PermissionError on Python 3
+            if os.name != 'nt' or attempt == attempts - 1:
+                raise
+            time.sleep(0.05 * (attempt + 1))
 
-        output.replace('#N/A History', nan, inplace=True)
-        output.index = pandas.to_datetime(output.index)
+
+def _day(d):
+    return numpy.datetime64(datetime.date(d.year, d.month, d.day))
+
+
+def _missingRanges(covered, start, end):
+    '''
+    The parts of [start, end] not in the sorted, disjoint covered ranges
+    '''
+    oneDay  = numpy.timedelta64(1, 'D')
+    missing = []
+    for (a, b) in covered:
+        if b < start or a > end:
+            continue
+        if a > start:
+            missing.append((start, a - oneDay))
+        start = b + oneDay
+        if start > end:
+            return missing
+    missing.append((start, end))
+    return missing
+
+
+def _mergeRanges(ranges):
+    oneDay = numpy.timedelta64(1, 'D')
+    merged = []
+    for (a, b) in sorted(ranges):
+        if merged and a <= merged[-1][1] + oneDay:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], b))
+        else:
+            merged.append((a, b))
+    return merged
+################################################
+
+
+class BLPReferenceCache(object):
+    """Bounded in-memory cache of reference data keyed by (security, field, overrides), shared by any number of BLP and BLPTS objects.
+    maxSize: number of values kept, the least recently used ones are evicted first
+    defaultTTL: seconds a value stays valid, None for as long as the process lives
+    fieldTTL: per field TTL overriding defaultTTL, e.g. {'PX_LAST': 60, 'MATURITY': None}
+    Example:
+    cache = BLPReferenceCache(fieldTTL={'PX_LAST': 60})
+    BLP(referenceCache=cache).bdp(bonds, ['MATURITY', 'CPN', 'CRNCY'])
+    BLPTS(bonds, ['MATURITY', 'PX_LAST'], referenceCache=cache).get()  # only PX_LAST goes to Bloomberg
+    """
+
+    def __init__(self, maxSize=100000, defaultTTL=None, fieldTTL=None):
+        self.maxSize     = maxSize
+        self.defaultTTL  = defaultTTL
+        self.fieldTTL    = dict(fieldTTL) if fieldTTL is not None else {}
+        self.lock        = threading.Lock()
+        self.entries     = collections.OrderedDict()  # (security, field, overrides) -> (expiry, value), least recently used first
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self.expirations = 0
+
+    def getMany(self, securities, fields, overrides=()):
+        """Returns {security: {field: value}} for the cached values"""
+        output = {}
+        now    = time.time()
+        with self.lock:
+            for security in securities:
+                for field in fields:
+                    key   = (security, field, overrides)
+                    entry = self.entries.pop(key, None)
+                    if entry is not None and entry[0] is not None and entry[0] < now:
+                        self.expirations += 1
+                        entry = None
+                    if entry is None:
+                        self.misses += 1
+                    else:
+                        self.hits += 1
+                        self.entries[key] = entry
+                        output.setdefault(security, {})[field] = entry[1]
         return output
 
-    def bdhOHLC(self, strSecurity='SPX Index', startdate=datetime.date(2014, 1, 1), enddate=datetime.date(2014, 1, 9), periodicity='DAILY'):
-        return self.bdh(strSecurity, ['PX_OPEN', 'PX_HIGH', 'PX_LOW', 'PX_LAST'], startdate, enddate, False, periodicity)
+    def putMany(self, security, values, overrides=()):
+        """values: {field: value}"""
+        now = time.time()
+        with self.lock:
+            for field, value in values.items():
+                ttl = self.fieldTTL.get(field, self.defaultTTL)
+                key = (security, field, overrides)
+                self.entries.pop(key, None)
+                self.entries[key] = (None if ttl is None else now + ttl, value)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, securities=None, fields=None):
+        """Removes the values of the given securities and/or fields, everything if both are None"""
+        securities = None if securities is None else set(_uniqueList(securities))
+        fields     = None if fields is None else set(_uniqueList(fields))
+        with self.lock:
+            for key in [k for k in self.entries if (securities is None or k[0] in securities) and (fields is None or k[1] in fields)]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'hitRate': float(self.hits) / lookups if lookups else nan,
+                    'evictions': self.evictions, 'expirations': self.expirations}
+
+
+def _overrideKey(strOverrideField, strOverrideValue):
+    return () if strOverrideField == '' else (strOverrideField, str(strOverrideValue))
+
+
+def _missingRectangle(securities, fields, cached):
+    '''
+    The securities with at least one field missing from cached, and the fields missing for at least one of them
+    '''
+    missingSecurities = [s for s in securities if len(cached.get(s, {})) < len(fields)]
+    missingFields     = [f for f in fields if any(f not in cached.get(s, {}) for s in missingSecurities)]
+    return missingSecurities, missingFields
+
+
+class BLPRequestCoalescer(object):
+    """Shares reference data requests between threads, passed as coalescer= to any number of BLP and BLPTS objects.
+    A (security, field, overrides) already on its way from Bloomberg is not requested again: every caller asking for it waits for the same value.
+    New keys are collected for window seconds and then sent together, securities asking for the same fields sharing requests,
+    so threads asking for different fields of the same securities at about the same time end up in one request.
+    Values are not kept once delivered - put a BLPReferenceCache in front for that. One thread sends the requests and decodes all the responses.
+    scheduler: optional BLPScheduler the requests then go through, at the given priority - BLP and BLPTS using the coalescer cannot have their own.
+    Values are only shared between callers with the same identity, and requested as that identity, so users of a BLPIdentityPool keep their own entitlements.
+    Example:
+    coalescer = BLPRequestCoalescer()
+    BLP(pooled=True, coalescer=coalescer).bdp(bonds, ['PX_LAST', 'CPN'])  # from many threads at once
+    BLPTS(bonds, ['PX_LAST'], pooled=True, coalescer=coalescer).get()
+    close() stops the thread, and the session unless pooled, also on leaving a with block.
+    """
 
-    def closeSession(self):
-        self.session.stop()
+    def __init__(self, sapi_dic=None, pooled=True, window=0.005, stats=None, scheduler=None, priority=BLPScheduler.INTERACTIVE):
+        self.session    = _openSession(sapi_dic, pooled)
+        self.refDataSvc = self.session.getService('//BLP/refdata')
+        self.window     = window
+        self.stats      = stats
+        self.scheduler  = scheduler
+        self.priority   = priority
+        self.lock       = threading.Lock()
+        self.inflight   = {}    # (security, field, overrides, identity) -> _PendingValue, until its value arrives
+        self.unsent     = []    # keys waiting for the next flush
+        self.flushTime  = None  # when the unsent keys go out
+        self.batches    = {}    # request handle -> (overrides, identity, securities, fields, {(security, field): _PendingValue}, decoder)
+        self.counts     = collections.Counter()
+        self.closed     = False
+        self.handle     = BLPRequestHandle(self.session)  # every request is sent on a sibling of it, so one loop reads all the responses
+        self.thread     = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def getMany(self, securities, fields, overrides=(), timeout=None, identity=None):
+        """Returns {security: {field: value}} for every security and field, NaN where Bloomberg has no value.
+        Blocks until all values are in, or raises BLPTimeoutError after timeout seconds - the values then still arrive for the other callers.
+        identity: optional blpapi Identity the values are requested as"""
+        deadline = time.time() + timeout if timeout is not None else None
+        pending  = []
+        with self.lock:
+            if self.closed:
+                raise ValueError('BLPRequestCoalescer is closed')
+            for security in securities:
+                for field in fields:
+                    key   = (security, field, overrides, identity)
+                    value = self.inflight.get(key)
+                    if value is None:
+                        value = self.inflight[key] = _PendingValue()
+                        self.unsent.append(key)
+                        self.counts['requested'] += 1
+                    else:
+                        self.counts['coalesced'] += 1
+                    pending.append((security, field, value))
+            if self.unsent and self.flushTime is None:
+                self.flushTime = time.time() + self.window
+                self.handle.deliver(BLPRoutedEvent(blpapi.event.Event.TIMEOUT, []))  # wakes the thread up to wait for flushTime
+        output = {}
+        for security, field, value in pending:
+            output.setdefault(security, {})[field] = value.get(deadline)
+        return output
+
+    def run(self):
+        while True:
+            with self.lock:
+                flushTime, closed = self.flushTime, self.closed
+            if closed:
+                break
+            event = self.handle.nextEvent(0 if flushTime is None else max(1000 * (flushTime - time.time()), 1))
+            if flushTime is not None and time.time() >= flushTime:
+                self.flush()
+            if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.PARTIAL_RESPONSE, blpapi.event.Event.REQUEST_STATUS]:
+                self.handleResponseEvent(event)
+        # closed: the requests in flight are cancelled and every value still pending gets NaN
+        for handle, (overrides, identity, securities, fields, pending, decoder) in list(self.batches.items()):
+            handle.cancel()
+            self.resolve(overrides, identity, securities, fields, pending, {})
+        self.batches.clear()
+        with self.lock:
+            for key in self.unsent:
+                self.inflight.pop(key).set(nan)
+            self.unsent = []
+
+    def close(self, timeout=None):
+        """Stops the thread, and the session unless pooled. Callers still waiting get NaN."""
+        with self.lock:
+            self.closed = True
+        self.handle.deliver(BLPRoutedEvent(blpapi.event.Event.TIMEOUT, []))  # wakes the thread up
+        self.thread.join(timeout)
+        if not self.session.pooled:
+            self.session.stop()
+
+    def flush(self):
+        """Sends the unsent keys, one group of requests per set of overrides, identity and fields"""
+        with self.lock:
+            unsent = [(key, self.inflight[key]) for key in self.unsent]
+            self.unsent, self.flushTime = [], None
+        fieldsBySecurity = collections.OrderedDict()
+        for (security, field, overrides, identity), value in unsent:
+            fieldsBySecurity.setdefault((overrides, identity, security), {})[field] = value
+        groups = collections.OrderedDict()
+        for (overrides, identity, security), values in fieldsBySecurity.items():
+            groups.setdefault((overrides, identity, tuple(sorted(values))), []).append(security)
+        for (overrides, identity, fields), securities in groups.items():
+            for securityChunk in _chunks(securities, BLP.securitiesPerRequest):
+                for fieldChunk in _chunks(list(fields), BLP.fieldsPerRequest):
+                    pending = dict(((s, f), fieldsBySecurity[(overrides, identity, s)][f]) for s in securityChunk for f in fieldChunk)
+                    self.send(overrides, identity, securityChunk, fieldChunk, pending)
+
+    def send(self, overrides, identity, securities, fields, pending):
+        request = self.refDataSvc.createRequest('ReferenceDataRequest')
+        for s in securities:
+            request.append('securities', s)
+        for f in fields:
+            request.append('fields', f)
+        if overrides:
+            _setOverride(request, *overrides)
+        handle = self.handle.sibling(self.session)
+        self.batches[handle] = (overrides, identity, securities, fields, pending, _ReferenceDataDecoder([], fields))
+        try:
+            if self.scheduler is not None:
+                self.scheduler.sendRequest(self.session, request, handle, self.stats, self.priority, identity)
+            else:
+                self.session.sendRequest(request, handle, self.stats, identity)
+            self.counts['requests'] += 1
+        except Exception as e:
+            print('error sending coalesced request: ' + str(e))
+            del self.batches[handle]
+            self.resolve(overrides, identity, securities, fields, pending, {})
+
+    def handleResponseEvent(self, event):
+        if event.handle not in self.batches:
+            return
+        overrides, identity, securities, fields, pending, decoder = self.batches[event.handle]
+        if event.eventType() == blpapi.event.Event.REQUEST_STATUS:
+            # the request failed, every value still pending gets NaN
+            _printRequestFailure(event)
+            del self.batches[event.handle]
+            self.resolve(overrides, identity, securities, fields, pending, {})
+            return
+        for msg in event:
+            for security, values in decoder.addMessage(msg):
+                self.resolve(overrides, identity, [security], fields, pending, values)
+        if event.eventType() == blpapi.event.Event.RESPONSE:
+            # securities Bloomberg did not answer for get NaN
+            del self.batches[event.handle]
+            self.resolve(overrides, identity, securities, fields, pending, {})
+
+    def resolve(self, overrides, identity, securities, fields, pending, values):
+        with self.lock:
+            for security in securities:
+                for field in fields:
+                    value = pending.pop((security, field), None)
+                    if value is None:
+                        continue
+                    key = (security, field, overrides, identity)
+                    if self.inflight.get(key) is value:
+                        del self.inflight[key]
+                    value.set(values.get(field, nan))
+
+    def summary(self):
+        """requested: values asked of Bloomberg, coalesced: values that joined one already on its way, requests: requests sent"""
+        with self.lock:
+            return {'inflight': len(self.inflight), 'requested': self.counts['requested'], 'coalesced': self.counts['coalesced'], 'requests': self.counts['requests']}
+
+
+def _knownValues(values):
+    '''
+    The values of a BLPRequestCoalescer result Bloomberg did answer, to keep the others out of a BLPReferenceCache
+    '''
+    return dict((field, value) for field, value in values.items() if value is not nan)
+
+
+class _PendingValue(object):
+    """A value some threads are waiting for"""
+    def __init__(self):
+        self.ready = threading.Event()
+        self.value = nan
+
+    def set(self, value):
+        self.value = value
+        self.ready.set()
+
+    def get(self, deadline=None):
+        if not self.ready.wait(None if deadline is None else max(deadline - time.time(), 0)):
+            raise BLPTimeoutError('coalesced value not in time')
+        return self.value
 ################################################
 
 
@@ -168,24 +1317,47 @@ class BLPTS:
     BLPTS('AAPL US Equity','SALES_REV_TURN', startDate='CY2010', endDate='CY2018', periodicity='YEARLY')
     BLPTS('3333 HK Equity','SALES_REV_TURN', startDate='CY2010', endDate='CY2018', periodicity='YEARLY', strOverrideField='EQY_FUND_CRNCY', strOverrideValue='USD')
     There seems to be a limit to number of fields we can ask at the same time - less than 20
-    sapi_dic is used for the SAPI connection
+    Requests are therefore split into chunks of at most securitiesPerRequest securities and fieldsPerRequest fields (both can be passed as keyword arguments),
+    which are all in flight at once, spread over sessionCount sessions (1 by default). Results land in the same output and observers.
+    When the fields of a HistoricalDataRequest are split, observers receive one DataFrame per chunk of fields.
+    sapi_dic is used for the SAPI connection, pooled=True borrows a warm session from BLPSessionPool
+    referenceCache: optional BLPReferenceCache - reference data requests then only ask Bloomberg for what the cache lacks
+    coalescer: optional BLPRequestCoalescer - reference data requests then go through it, sharing Bloomberg requests with other threads. get blocks until all values are in.
+    A coalescer sends with its own scheduler, so it cannot be combined with scheduler.
+    stats: optional BLPStats recording request latencies, decode and observer times
+    scheduler: optional BLPScheduler the requests then go through, at priority (BLPScheduler.INTERACTIVE by default)
+    timeout: optional seconds a get or iterate call may take, after which its requests are cancelled and BLPTimeoutError raised
+    identity: optional blpapi Identity the requests are entitled as, see BLPIdentityPool
+    cancel() stops a get or iterate running in another thread, which then returns with what has arrived.
     """
+    securitiesPerRequest = 500
+    fieldsPerRequest     = 20
+    # keyword arguments of the object rather than of a request: kept by get and iterate, which only override them when passed again
+    objectOptions = ['sapi_dic', 'pooled', 'sessionCount', 'stats', 'identity', 'timeout', 'priority', 'referenceCache', 'coalescer', 'scheduler',
+                     'securitiesPerRequest', 'fieldsPerRequest', 'requestsInFlight']
 
     def __init__(self, securities=[], fields=[], **kwargs):
         """
         Keyword arguments:
         securities : list of ISINS
         fields : list of fields
-        kwargs : startDate and endDate (datetime.datetime object, note: hours, minutes, seconds, and microseconds must be replaced by 0), periodicity, sapi_dic, etc.
+        kwargs : startDate and endDate (datetime.datetime object, note: hours, minutes, seconds, and microseconds must be replaced by 0), periodicity, sapi_dic, pooled, sessionCount, etc.
         """
-        self.kwargs = kwargs
-        if 'sapi_dic' in self.kwargs and self.kwargs['sapi_dic'] is not None:
-            self.session = BLPSession(kwargs['sapi_dic']['host_ip'], kwargs['sapi_dic']['host_port'], kwargs['sapi_dic']['uuid'], kwargs['sapi_dic']['local_ip'])
+        self.kwargs     = kwargs
+        self.options    = dict((name, value) for (name, value) in kwargs.items() if name in BLPTS.objectOptions)
+        if kwargs.get('pooled', False):
+            self.sessions = [BLPSessionPool.getSession(kwargs.get('sapi_dic'), slot) for slot in range(0, kwargs.get('sessionCount', 1))]
         else:
-            self.session = BLPSession()
-        self.session.openService('//BLP/refdata')
+            self.sessions = [BLPSharedSession(kwargs.get('sapi_dic')) for i in range(0, kwargs.get('sessionCount', 1))]
+        self.session    = self.sessions[0]
         self.refDataSvc = self.session.getService('//BLP/refdata')
+        self.stats      = kwargs.get('stats')
         self.observers = []
+        self.observerTime = 0.
+        self.inflightHandles = set()
+        self.cancelled       = False
+        self.requests        = []
+        self.handle          = None
         if len(securities) > 0 and len(fields) > 0:
             # also works if securities and fields are a string
             self.fillRequest(securities, fields, **kwargs)
@@ -196,7 +1368,11 @@ class BLPTS:
         securities : list of ISINS
         fields : list of fields
         kwargs : startDate and endDate (datetime.datetime object, note: hours, minutes, seconds, and microseconds must be replaced by 0)
+        The options given to the constructor (see objectOptions) apply unless passed again.
         """
+        kwargs = dict(self.options, **kwargs)
+        if kwargs.get('coalescer') is not None and kwargs.get('scheduler') is not None:
+            raise ValueError('pass the scheduler to the BLPRequestCoalescer instead')
         self.kwargs = kwargs
 
         if type(securities) == str:
@@ -206,43 +1382,54 @@ class BLPTS:
             fields = [fields]
 
         if 'startDate' in kwargs:
-            self.request   = self.refDataSvc.createRequest('HistoricalDataRequest')
             self.startDate = kwargs['startDate']
             self.endDate   = kwargs['endDate']
             self.periodicity = kwargs['periodicity'] if 'periodicity' in kwargs else 'DAILY'
-            self.request.set('periodicitySelection', self.periodicity)
-            # if 'periodicity' in kwargs:
-            #     self.periodicity = kwargs['periodicity']
-            # else:
-            #     self.periodicity = 'DAILY'
+        else:
+            self.output  = pandas.DataFrame(index=securities, columns=fields)
+
+        self.securitiesPerRequest = kwargs.get('securitiesPerRequest', BLPTS.securitiesPerRequest)
+        self.fieldsPerRequest     = kwargs.get('fieldsPerRequest', BLPTS.fieldsPerRequest)
+        self.securities = list(securities)
+        self.fields     = list(fields)
+        self.requests   = self.createRequests(self.securities, self.fields)
+        self.request    = self.requests[0][0] if self.requests else None
+
+    def createRequests(self, securities, fields):
+        """A list of (request, fields), one per chunk of at most securitiesPerRequest securities and fieldsPerRequest fields"""
+        return [(self.createRequest(securityChunk, fieldChunk), fieldChunk) for securityChunk in _chunks(securities, self.securitiesPerRequest) for fieldChunk in _chunks(fields, self.fieldsPerRequest)]
+
+    def createRequest(self, securities, fields):
+        """A request for the given securities and fields, with the dates, periodicity and override of the last fillRequest"""
+        if 'startDate' in self.kwargs:
+            request = self.refDataSvc.createRequest('HistoricalDataRequest')
+            request.set('periodicitySelection', self.periodicity)
 
             if type(self.startDate) == str:
-                self.request.set('startDate', self.startDate)
+                request.set('startDate', self.startDate)
             else:
-                self.request.set('startDate', self.startDate.strftime('%Y%m%d'))
+                request.set('startDate', self.startDate.strftime('%Y%m%d'))
 
             if type(self.endDate) == str:
-                self.request.set('endDate', self.endDate)
+                request.set('endDate', self.endDate)
             else:
-                self.request.set('endDate', self.endDate.strftime('%Y%m%d'))
+                request.set('endDate', self.endDate.strftime('%Y%m%d'))
 
         else:
-            self.request = self.refDataSvc.createRequest('ReferenceDataRequest')
-            self.output  = pandas.DataFrame(index=securities, columns=fields)
+            request = self.refDataSvc.createRequest('ReferenceDataRequest')
 
-        if 'strOverrideField' in kwargs:
-            o = self.request.getElement('overrides').appendElement()
-            o.setElement('fieldId', kwargs['strOverrideField'])
-            o.setElement('value', kwargs['strOverrideValue'])
-
-        self.securities = securities
-        self.fields     = fields
+        if 'strOverrideField' in self.kwargs:
+            o = request.getElement('overrides').appendElement()
+            o.setElement('fieldId', self.kwargs['strOverrideField'])
+            o.setElement('value', self.kwargs['strOverrideValue'])
 
         for s in securities:
-            self.request.append('securities', s)
+            request.append('securities', s)
 
         for f in fields:
-            self.request.append('fields', f)
+            request.append('fields', f)
+
+        return request
 
     def get(self, newSecurities=[], newFields=[], **kwargs):
         """
@@ -253,62 +1440,207 @@ class BLPTS:
 
         if len(newSecurities) > 0 or len(newFields) > 0:
             self.fillRequest(newSecurities, newFields, **kwargs)
+        if len(self.requests) == 0:
+            # no securities or no fields, nothing to wait for
+            return
 
-        self.requestID = self.session.sendRequest(self.request)
+        self.sendRequest()
+        if self.handle is None:
+            return
 
         while True:
-            event = self.session.nextEvent()
-            if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.PARTIAL_RESPONSE]:
-                responseSize = blpapi.event.MessageIterator(event).__next__().getElement(SECURITY_DATA).numValues() if BLPAPI_VERSION > 3.17 else blpapi.event.MessageIterator(event).next().getElement(SECURITY_DATA).numValues()
-
-                for i in range(0, responseSize):
-
-                    if 'startDate' in self.kwargs:
-                        # HistoricalDataRequest
-                        output         = blpapi.event.MessageIterator(event).__next__().getElement(SECURITY_DATA) if BLPAPI_VERSION > 3.17 else blpapi.event.MessageIterator(event).next().getElement(SECURITY_DATA)
-                        security       = output.getElement(SECURITY).getValueAsString()
-                        fieldDataArray = output.getElement(FIELD_DATA)
-                        fieldDataList  = [fieldDataArray.getValueAsElement(i) for i in range(0, fieldDataArray.numValues())]
-                        dates          = map(lambda x: x.getElement(DATE).getValueAsString(), fieldDataList)
-                        outDF          = pandas.DataFrame(index=dates, columns=self.fields)
-                        try:
-                            outDF.index    = pandas.to_datetime(outDF.index, format='%Y-%m-%d%z')
-                        except:
-                            outDF.index = pandas.to_datetime(outDF.index)
-
-                        for field in self.fields:
-                            data = []
-                            for row in fieldDataList:
-                                if row.hasElement(field):
-                                    data.append(row.getElement(field).getValueAsFloat())
-                                else:
-                                    data.append(nan)
-
-                            outDF[field] = data
-                            self.updateObservers(security=security, field=field, data=outDF) # update one security one field
-
-                        self.updateObservers(security=security, field='ALL', data=outDF) # update one security all fields
-
-                    else:
-                        # ReferenceDataRequest
-                        output   = blpapi.event.MessageIterator(event).__next__().getElement(SECURITY_DATA).getValueAsElement(i) if BLPAPI_VERSION > 3.17 else blpapi.event.MessageIterator(event).next().getElement(SECURITY_DATA).getValueAsElement(i)
-                        n_elmts  = output.getElement(FIELD_DATA).numElements()
-                        security = output.getElement(SECURITY).getValueAsString()
-                        for j in range(0, n_elmts):
-                            data     = output.getElement(FIELD_DATA).getElement(j)
-                            field    = str(data.name())
-                            outData  = _dict_from_element(data)
-                            self.updateObservers(security=security, field=field, data=outData) # update one security one field
-                            self.output.loc[security, field] = outData
-
-                        if n_elmts > 0:
-                            self.updateObservers(security=security, field='ALL', data=self.output.loc[security]) # update one security all fields
-                        else:
-                            print('Empty response received for ' + security)
-
-            if event.eventType() == blpapi.event.Event.RESPONSE:
+            event = self.nextEvent()
+            if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.PARTIAL_RESPONSE, blpapi.event.Event.REQUEST_STATUS]:
+                self.handleResponseEvent(event)
+            if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.REQUEST_STATUS] and self.pendingResponses == 0:
                 break
 
+    def iterate(self, newSecurities=[], newFields=[], **kwargs):
+        """
+        Generator variant of get, yielding (security, data) as each partial response is decoded, data being what the observers receive for field 'ALL':
+        a pandas Series for a ReferenceDataRequest, a DataFrame for a HistoricalDataRequest. Observers are still notified.
+        Nothing is kept once yielded - self.output and historyFrame() stay empty - and only requestsInFlight requests (keyword argument, twice sessionCount by default)
+        are in flight at a time, so memory does not grow with the size of the universe.
+        Leaving the loop early cancels the requests still in flight.
+        Example: for security, data in BLPTS(isins, fields).iterate(): data.to_csv(...)
+        """
+        if len(newSecurities) > 0 or len(newFields) > 0:
+            self.fillRequest(newSecurities, newFields, **kwargs)
+        if len(self.requests) == 0:
+            return
+
+        finished = False
+        try:
+            for result in self.sendRequest(collect=True, keep=False, window=self.kwargs.get('requestsInFlight', 2 * len(self.sessions))):
+                yield result
+            while self.handle is not None:
+                event = self.nextEvent()
+                if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.PARTIAL_RESPONSE, blpapi.event.Event.REQUEST_STATUS]:
+                    for result in self.handleResponseEvent(event, collect=True):
+                        yield result
+                if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.REQUEST_STATUS] and self.pendingResponses == 0:
+                    break
+            finished = True
+        finally:
+            if not finished:
+                # the loop was left early (break, close() or an exception): stop the requests still in flight
+                self.cancel()
+
+    def dispatchRequests(self, requests, handle=None, window=None):
+        """Sends every (request, fields) round robin over the sessions, all at once or, given a window, that many at a time with the next one going out as each completes.
+        All responses come through self.handle."""
+        timeout               = self.kwargs.get('timeout')
+        self.handle           = handle if handle is not None else BLPRequestHandle(self.session)
+        self.chunkFields      = {}
+        self.inflightHandles  = set()
+        self.cancelled        = False
+        self.deadline         = time.time() + timeout if timeout is not None else None
+        self.pendingResponses = len(requests)
+        self.unsentRequests   = collections.deque(enumerate(requests))
+        for i in range(0, len(requests) if window is None else min(window, len(requests))):
+            self.sendNextRequest()
+
+    def sendNextRequest(self):
+        i, (request, fields) = self.unsentRequests.popleft()
+        session     = self.sessions[i % len(self.sessions)]
+        chunkHandle = self.handle if i == 0 else self.handle.sibling(session)
+        chunkHandle.deadline = self.deadline
+        self.chunkFields[chunkHandle] = fields
+        self.inflightHandles.add(chunkHandle)
+        scheduler = self.kwargs.get('scheduler')
+        if scheduler is not None:
+            scheduler.sendRequest(session, request, chunkHandle, self.stats, self.kwargs.get('priority', BLPScheduler.INTERACTIVE), self.kwargs.get('identity'))
+        else:
+            session.sendRequest(request, chunkHandle, self.stats, self.kwargs.get('identity'))
+
+    def nextEvent(self):
+        """The next event for self.handle, cancelling the requests and raising BLPTimeoutError if the timeout passes first"""
+        event = _nextEvent(self.handle, self.deadline)
+        if event.eventType() == blpapi.event.Event.TIMEOUT:
+            self.cancel()
+            raise BLPTimeoutError('BLPTS responses not in after ' + str(self.kwargs.get('timeout')) + ' seconds')
+        return event
+
+    def cancel(self):
+        """Cancels the requests in flight and those not sent yet. Can be called from any thread."""
+        self.cancelled = True
+        for handle in list(self.inflightHandles):
+            handle.cancel()
+
+    def sendRequest(self, handle=None, collect=False, keep=True, window=None):
+        """Sends the request - with a referenceCache, only for the securities and fields the cache cannot answer.
+        Securities answered entirely from the cache are sent to the observers straight away, and returned as in handleResponseEvent.
+        self.handle is None if nothing needed sending.
+        keep=False decodes the responses without accumulating them for self.output and historyFrame.
+        window: optional maximum number of requests in flight, see dispatchRequests."""
+        results = []
+        if 'startDate' in self.kwargs:
+            self.history = _HistoryAccumulator(self.fields, keep)
+            self.dispatchRequests(self.requests, handle, window)
+            return results
+
+        self.decoder = _ReferenceDataDecoder(self.securities if keep else [], self.fields)
+        self.cached  = {}
+        cache        = self.kwargs.get('referenceCache')
+        coalescer    = self.kwargs.get('coalescer')
+        if cache is None and coalescer is None:
+            self.dispatchRequests(self.requests, handle, window)
+            return results
+
+        self.cached = cache.getMany(self.securities, self.fields, self.overrideKey()) if cache is not None else {}
+        missingSecurities, missingFields = _missingRectangle(self.securities, self.fields, self.cached)
+        if coalescer is not None:
+            for security, values in coalescer.getMany(missingSecurities, missingFields, self.overrideKey(), self.kwargs.get('timeout'), self.kwargs.get('identity')).items():
+                if cache is not None:
+                    cache.putMany(security, _knownValues(values), self.overrideKey())
+                self.cached.setdefault(security, {}).update(values)
+            missingSecurities = []
+        self.decoder.seed(self.cached)
+        for security in self.securities:
+            if security not in missingSecurities:
+                self.notifyReference(security, self.cached[security], results, collect)
+        if len(missingSecurities) == 0:
+            self.handle = None
+            self.output = self.decoder.frame()
+        else:
+            self.dispatchRequests(self.createRequests(missingSecurities, missingFields), handle, window)
+        return results
+
+    def overrideKey(self):
+        return _overrideKey(self.kwargs.get('strOverrideField', ''), self.kwargs.get('strOverrideValue', ''))
+
+    def handleResponseEvent(self, event, collect=False):
+        """Decodes one partial or final response event into the observers, and into self.output once the final response is in.
+        collect=True returns a list of (security, data) with the data sent to observers for field 'ALL'.
+        Reference data values are typed: floats, datetime64 for dates, strings, nested lists and dicts for bulk fields.
+        Historical data accumulates in self.history as float64 columns, see historyFrame."""
+        if self.stats is None:
+            return self.decodeResponseEvent(event, collect)
+        self.observerTime = 0.
+        start   = time.time()
+        results = self.decodeResponseEvent(event, collect)
+        self.stats.record('decode', time.time() - start - self.observerTime)
+        return results
+
+    def decodeResponseEvent(self, event, collect=False):
+        results = []
+        if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.REQUEST_STATUS]:
+            if event.handle not in self.inflightHandles:
+                return results  # already ended by a cancellation
+            self.inflightHandles.discard(event.handle)
+            self.pendingResponses -= 1
+            if self.cancelled:
+                self.pendingResponses -= len(self.unsentRequests)
+                self.unsentRequests.clear()
+            elif self.unsentRequests:
+                self.sendNextRequest()
+        if event.eventType() == blpapi.event.Event.REQUEST_STATUS:
+            _printRequestFailure(event)
+            if self.pendingResponses == 0 and 'startDate' not in self.kwargs:
+                self.output = self.decoder.frame()
+            return results
+        if 'startDate' not in self.kwargs:
+            # ReferenceDataRequest
+            cache = self.kwargs.get('referenceCache')
+            for msg in event:
+                for security, values in self.decoder.addMessage(msg):
+                    if cache is not None:
+                        cache.putMany(security, values, self.overrideKey())
+                    if security in self.cached:
+                        values = dict(self.cached[security], **values)
+                    if len(values) == 0:
+                        print('Empty response received for ' + security)
+                        continue
+                    self.notifyReference(security, values, results, collect)
+            if self.pendingResponses == 0:
+                self.output = self.decoder.frame()
+            return results
+
+        # HistoricalDataRequest
+        fields = self.chunkFields.get(event.handle, self.fields)
+        for msg in event:
+            security, dates, values = self.history.addMessage(msg, fields)
+            if self.observers or collect:
+                outDF = pandas.DataFrame(values, index=pandas.DatetimeIndex(dates), columns=fields)
+                for field in fields:
+                    self.updateObservers(security=security, field=field, data=outDF) # update one security one field
+                self.updateObservers(security=security, field='ALL', data=outDF) # update one security all fields
+                results.append((security, outDF))
+        return results
+
+    def notifyReference(self, security, values, results, collect):
+        for field, data in values.items():
+            self.updateObservers(security=security, field=field, data=data) # update one security one field
+        if self.observers or collect:
+            data = pandas.Series(values, index=self.fields, name=security)
+            self.updateObservers(security=security, field='ALL', data=data) # update one security all fields
+            results.append((security, data))
+
+    def historyFrame(self, longFormat=False):
+        """After a HistoricalDataRequest, all the data received as one DataFrame built in one go:
+        wide with (Security, Field) MultiIndex columns by default, or long with columns security, date, field, value."""
+        return self.history.long() if longFormat else self.history.wide(self.securities)
+
     def register(self, observer):
         if not observer in self.observers:
             self.observers.append(observer)
@@ -322,30 +1654,352 @@ class BLPTS:
             del self.observers[:]
 
     def updateObservers(self, *args, **kwargs):
+        if self.stats is None or not self.observers:
+            for observer in self.observers:
+                observer.update(*args, **kwargs)
+            return
+        start = time.time()
         for observer in self.observers:
             observer.update(*args, **kwargs)
+        elapsed = time.time() - start
+        self.observerTime += elapsed
+        self.stats.record('observers', elapsed)
 
     def closeSession(self):
-        self.session.stop()
+        for session in self.sessions:
+            if not session.pooled:
+                session.stop()
 ################################################
 
 
+class BLPTickStore(object):
+    """Latest values of a stream in a float64 NumPy matrix, one row per security and one column per field, with the time of each row's last update.
+    historySize > 0 also keeps the last historySize ticks of each security in a ring buffer: the time and the whole row after the tick.
+    Writers (the stream's handler threads) take turns on a lock. Readers don't: a version number is bumped before and after every write or resize,
+    and readers copy the arrays again if it moved while they were copying, so snapshots are consistent without a lock.
+    Securities and fields can be added at any time, the arrays then grow."""
+
+    def __init__(self, securities, fields, historySize=0):
+        self.securities  = []
+        self.fields      = []
+        self.rowOf       = {}
+        self.columnOf    = {}
+        self.historySize = historySize
+        self.values      = numpy.full((0, 0), nan)
+        self.times       = numpy.full(0, nan)
+        self.ringValues  = numpy.full((0, historySize, 0), nan)
+        self.ringTimes   = numpy.full((0, historySize), nan)
+        self.ringCount   = numpy.zeros(0, dtype=numpy.int64)
+        self.version     = 0
+        self.lock        = threading.Lock()
+        self.addSecurities(securities)
+        self.addFields(fields)
+
+    def addSecurities(self, securities):
+        """Returns the row of each security, adding rows for the new ones"""
+        with self.lock:
+            new = [s for s in _uniqueList(securities) if s not in self.rowOf]
+            if new:
+                self.version += 1
+                n = len(new)
+                self.values     = numpy.vstack([self.values, numpy.full((n, len(self.fields)), nan)])
+                self.times      = numpy.concatenate([self.times, numpy.full(n, nan)])
+                self.ringValues = numpy.concatenate([self.ringValues, numpy.full((n, self.historySize, len(self.fields)), nan)])
+                self.ringTimes  = numpy.vstack([self.ringTimes, numpy.full((n, self.historySize), nan)])
+                self.ringCount  = numpy.concatenate([self.ringCount, numpy.zeros(n, dtype=numpy.int64)])
+                for security in new:
+                    self.rowOf[security] = len(self.securities)
+                    self.securities.append(security)
+                self.version += 1
+            return [self.rowOf[s] for s in securities]
+
+    def addFields(self, fields):
+        """Returns the column of each field, adding columns for the new ones"""
+        with self.lock:
+            new = [f for f in _uniqueList(fields) if f not in self.columnOf]
+            if new:
+                self.version += 1
+                n = len(new)
+                self.values     = numpy.hstack([self.values, numpy.full((len(self.securities), n), nan)])
+                self.ringValues = numpy.concatenate([self.ringValues, numpy.full((len(self.securities), self.historySize, n), nan)], axis=2)
+                for field in new:
+                    self.columnOf[field] = len(self.fields)
+                    self.fields.append(field)
+                self.version += 1
+            return [self.columnOf[f] for f in fields]
+
+    def write(self, row, columns, data, timestamp):
+        """row: index of the security, columns: list of field indices, data: their new values, timestamp: seconds since epoch"""
+        with self.lock:
+            self.version += 1
+            self.values[row, columns] = data
+            self.times[row] = timestamp
+            if self.historySize > 0:
+                i = self.ringCount[row] % self.historySize
+                self.ringTimes[row, i]  = timestamp
+                self.ringValues[row, i] = self.values[row]
+                self.ringCount[row] += 1
+            self.version += 1
+
+    def read(self, copy):
+        """Returns copy() taken while no write was in progress"""
+        while True:
+            version = self.version
+            if version % 2 == 0:
+                output = copy()
+                if self.version == version:
+                    return output
+            time.sleep(0)
+
+    def snapshot(self):
+        """DataFrame of the latest values, indexed by security with one column per field"""
+        values, securities, fields = self.read(lambda: (self.values.copy(), list(self.securities), list(self.fields)))
+        return pandas.DataFrame(values, index=securities, columns=fields)
+
+    def lastUpdates(self):
+        """Series of the time of the last tick of each security, NaT if none yet"""
+        times, securities = self.read(lambda: (self.times.copy(), list(self.securities)))
+        return pandas.Series(pandas.to_datetime(times, unit='s'), index=securities)
+
+    def latest(self, security, field):
+        return self.read(lambda: self.values[self.rowOf[security], self.columnOf[field]])
+
+    def history(self, security):
+        """DataFrame of the ticks of security still in the ring buffer, oldest first, indexed by time"""
+        row = self.rowOf[security]
+        count, times, values, fields = self.read(lambda: (self.ringCount[row], self.ringTimes[row].copy(), self.ringValues[row].copy(), list(self.fields)))
+        if count > self.historySize:
+            start  = count % self.historySize
+            times  = numpy.roll(times, -start)
+            values = numpy.roll(values, -start, axis=0)
+        else:
+            times  = times[0:count]
+            values = values[0:count]
+        return pandas.DataFrame(values, index=pandas.to_datetime(times, unit='s'), columns=fields)
+
+
+class BLPSharedTickStore(BLPTickStore):
+    """BLPTickStore kept in a memory-mapped file, so that other processes can read a stream's values without a session or subscription of their own.
+    The publishing process creates it and passes it to BLPStream as store=. Readers open it with BLPSharedTickStore.attach(name) and call snapshot, lastUpdates,
+    latest and history as on any BLPTickStore: their arrays are read-only views of the same memory, and the version number they check lives in the file too,
+    so snapshots are as consistent across processes as within one.
+    The arrays cannot grow in place, so maxSecurities and maxFields set the capacity up front. Security and field names are kept in a json file next to it.
+    name: a file name, created in /dev/shm where it exists (memory only) and in the temporary directory otherwise, or a full path.
+    A publisher starting again under the same name marks the previous file closed, so that readers still attached to it move to the new one.
+    Readers raise IOError once the publisher has closed the store and no other one has taken its place.
+    Example:
+    BLPStream(bonds, ['BID', 'ASK'], 0, list(range(len(bonds))), store=BLPSharedTickStore('prices', 5000, 2)).start()  # publisher
+    BLPSharedTickStore.attach('prices').snapshot()  # any other process
+    """
+    headerSize = 8  # int64: version, securities, fields, maxSecurities, maxFields, historySize, closed, spare
+
+    def __init__(self, name, maxSecurities, maxFields, historySize=0, securities=[], fields=[]):
+        self.path       = _sharedPath(name)
+        self.lock       = threading.Lock()
+        self.readOnly   = False
+        self.securities = []
+        self.fields     = []
+        self.rowOf      = {}
+        self.columnOf   = {}
+        self.writeNames()
+        # built aside and renamed, so processes still reading a previous file keep a valid mapping
+        buffer = numpy.memmap(self.path + '.tmp', dtype=numpy.float64, mode='w+', shape=(_sharedSize(maxSecurities, maxFields, historySize),))
+        buffer[:] = nan
+        self.mapArrays(buffer, maxSecurities, maxFields, historySize)
+        self.header[:]       = [0, 0, 0, maxSecurities, maxFields, historySize, 0, 0]
+        self.allRingCount[:] = 0
+        _markSharedClosed(self.path)
+        _replace(self.path + '.tmp', self.path)
+        self.addSecurities(securities)
+        self.addFields(fields)
+
+    @classmethod
+    def attach(cls, name):
+        """Read-only view of the store another process publishes under name"""
+        store          = cls.__new__(cls)
+        store.path     = _sharedPath(name)
+        store.lock     = threading.Lock()
+        store.readOnly = True
+        store.open()
+        return store
+
+    def open(self):
+        if not os.path.exists(self.path):
+            raise IOError('no BLPSharedTickStore at ' + self.path + ': its publisher has not created it yet, or has closed it')
+        buffer = numpy.memmap(self.path, dtype=numpy.float64, mode='r')
+        header = buffer[0:self.headerSize].view(numpy.int64)
+        self.mapArrays(buffer, int(header[3]), int(header[4]), int(header[5]))
+        self.readNames()
+
+    def readNames(self):
+        """Readers only: the names of the securities and fields the header counts"""
+        try:
+            with open(self.path + '.json') as f:
+                names = json.load(f)
+        except (IOError, OSError):
+            raise IOError('no BLPSharedTickStore names at ' + self.path + '.json: its publisher has closed it')
+        # the names are written before the counts, so there may be more of them than the counts say
+        self.securities = names['securities'][0:int(self.header[1])]
+        self.fields     = names['fields'][0:int(self.header[2])]
+        self.rowOf      = dict((s, i) for i, s in enumerate(self.securities))
+        self.columnOf   = dict((f, i) for i, f in enumerate(self.fields))
+        self.mapViews()
+
+    def mapArrays(self, buffer, maxSecurities, maxFields, historySize):
+        self.buffer        = buffer
+        self.maxSecurities = maxSecurities
+        self.maxFields     = maxFields
+        self.historySize   = historySize
+        shapes  = [(self.headerSize,), (maxSecurities, maxFields), (maxSecurities,), (maxSecurities, historySize, maxFields), (maxSecurities, historySize), (maxSecurities,)]
+        arrays  = []
+        offset  = 0
+        for shape in shapes:
+            size = int(numpy.prod(shape))
+            arrays.append(buffer[offset:offset + size].reshape(shape))
+            offset += size
+        self.header, self.allValues, self.allTimes, self.allRingValues, self.allRingTimes, self.allRingCount = arrays
+        self.header       = self.header.view(numpy.int64)
+        self.allRingCount = self.allRingCount.view(numpy.int64)
+
+    def mapViews(self):
+        """Points values, times and the ring buffer at the rows and columns in use"""
+        n, m = len(self.securities), len(self.fields)
+        self.values     = self.allValues[0:n, 0:m]
+        self.times      = self.allTimes[0:n]
+        self.ringValues = self.allRingValues[0:n, :, 0:m]
+        self.ringTimes  = self.allRingTimes[0:n]
+        self.ringCount  = self.allRingCount[0:n]
+
+    @property
+    def version(self):
+        return int(self.header[0])
+
+    @version.setter
+    def version(self, value):
+        self.header[0] = value
+
+    def addSecurities(self, securities):
+        with self.lock:
+            new = [s for s in _uniqueList(securities) if s not in self.rowOf]
+            if new:
+                if len(self.securities) + len(new) > self.maxSecurities:
+                    raise ValueError('BLPSharedTickStore ' + self.path + ' has room for ' + str(self.maxSecurities) + ' securities')
+                self.version += 1
+                for security in new:
+                    self.rowOf[security] = len(self.securities)
+                    self.securities.append(security)
+                self.writeNames()
+                self.header[1] = len(self.securities)
+                self.mapViews()
+                self.version += 1
+            return [self.rowOf[s] for s in securities]
+
+    def addFields(self, fields):
+        with self.lock:
+            new = [f for f in _uniqueList(fields) if f not in self.columnOf]
+            if new:
+                if len(self.fields) + len(new) > self.maxFields:
+                    raise ValueError('BLPSharedTickStore ' + self.path + ' has room for ' + str(self.maxFields) + ' fields')
+                self.version += 1
+                for field in new:
+                    self.columnOf[field] = len(self.fields)
+                    self.fields.append(field)
+                self.writeNames()
+                self.header[2] = len(self.fields)
+                self.mapViews()
+                self.version += 1
+            return [self.columnOf[f] for f in fields]
+
+    def writeNames(self):
+        with open(self.path + '.json.tmp', 'w') as f:
+            json.dump({'securities': self.securities, 'fields': self.fields}, f)
+        _replace(self.path + '.json.tmp', self.path + '.json')
+
+    def refresh(self):
+        """Readers pick up the securities and fields added since they last looked, and a new file if the publisher started again"""
+        if not self.readOnly:
+            return
+        if self.header[6]:
+            self.open()
+        elif self.header[1] != len(self.securities) or self.header[2] != len(self.fields):
+            self.readNames()
+
+    def read(self, copy):
+        self.refresh()
+        return BLPTickStore.read(self, copy)
+
+    def history(self, security):
+        self.refresh()
+        return BLPTickStore.history(self, security)
+
+    def close(self):
+        """Publisher only: marks the store closed, readers then reopen the file of the next publisher on their next read, and removes the files"""
+        if self.readOnly:
+            return
+        self.header[6] = 1
+        for path in [self.path, self.path + '.json']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _sharedPath(name):
+    if os.path.dirname(name):
+        return name
+    return os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), name)
+
+
+def _markSharedClosed(path):
+    '''
+    Sets the closed flag of the BLPSharedTickStore file at path, if there is one, for the readers still mapping it
+    '''
+    if not os.path.exists(path):
+        return
+    try:
+        header = numpy.memmap(path, dtype=numpy.int64, mode='r+', shape=(BLPSharedTickStore.headerSize,))
+    except (IOError, OSError, ValueError):  # not a store, or too short to be one
+        return
+    header[6] = 1
+    header.flush()
+    del header
+
+
+def _sharedSize(maxSecurities, maxFields, historySize):
+    return BLPSharedTickStore.headerSize + maxSecurities * (maxFields + 1 + historySize * (maxFields + 1) + 1)
+
+
 class BLPStream(threading.Thread):
     """The Subscription Paradigm
     The subscribed data will be sitting in self.output and update automatically. Observers will be notified.
+    Values are kept in self.store, a BLPTickStore: self.output is a consistent DataFrame snapshot of it, safe to read from any thread.
+    historySize > 0 also keeps the last historySize ticks of each security, see BLPTickStore.history.
+    Every message of every event is decoded, field values with the getter matching their datatype. Non numeric fields reach the observers but not the store.
+    self.counters counts messages, ticks (field updates), and the problems: emptyMessages, unparseableFields (e.g. null values, which are skipped) and unknownCorrelationIds.
     floatInterval is the minimum amount of time before updates - sometimes needs to be set at 0 for things to work properly. In seconds.
     intCorrID is a user defined ID for the request
     It is sometimes safer to ask for each data (for instance BID and ASK) in a separate stream.
     Note that for corporate bonds, a change in the ASK price will still trigger a BID event.
+    pooled=True borrows a warm session from BLPSessionPool; correlation IDs must then be unique across the streams sharing it.
+    stats: optional BLPStats recording messages and ticks received, decode and observer times
+    The universe can change while streaming: addSecurities, removeSecurities and setFields (or addFields, removeFields) only subscribe, unsubscribe or resubscribe the difference.
+    sessionCount > 1 shards the securities over that many sessions, each drained by its own thread. They all write to the same store,
+    and observers are called by one thread at a time, so they see one merged stream.
+    store: optional store to write to instead of a new BLPTickStore, e.g. a BLPSharedTickStore other processes read from. historySize is then the store's.
+    identity: optional blpapi Identity the subscriptions are entitled as, see BLPIdentityPool
     """
 
-    def __init__(self, strSecurityList=['ESU2 Index', 'VGU2 Index'], strDataList=['BID', 'ASK'], floatInterval=0, intCorrIDList=[0, 1], sapi_dic=None):
+    def __init__(self, strSecurityList=['ESU2 Index', 'VGU2 Index'], strDataList=['BID', 'ASK'], floatInterval=0, intCorrIDList=[0, 1], sapi_dic=None, pooled=False, stats=None, historySize=0, sessionCount=1, store=None, identity=None):
         threading.Thread.__init__(self)
-        if sapi_dic is not None:
-            self.session = BLPSession(BLPSession(sapi_dic['host_ip'], sapi_dic['host_port'], sapi_dic['uuid'], sapi_dic['local_ip']))
+        if pooled:
+            self.sessions = [BLPSessionPool.getSession(sapi_dic, slot) for slot in range(0, sessionCount)]
         else:
-            self.session = BLPSession()
-        self.session.openService("//BLP/mktdata")
+            self.sessions = [BLPSharedSession(sapi_dic) for i in range(0, sessionCount)]
+        for session in self.sessions:
+            session.getService("//BLP/mktdata")
+        self.session = self.sessions[0]
+        self.handles = [BLPRequestHandle(session) for session in self.sessions]  # one per shard, all its subscriptions are routed to it
+        self.handle  = self.handles[0]
 
         if type(strSecurityList) == str:
             strSecurityList = [strSecurityList]
@@ -356,24 +2010,39 @@ class BLPStream(threading.Thread):
         if type(strDataList) == str:
             strDataList = [strDataList]
 
-        self.strSecurityList = strSecurityList
-        self.strDataList     = strDataList
-
         if len(strSecurityList) != len(intCorrIDList):
             print('Number of securities needs to match number of Correlation IDs, overwriting IDs')
-            self.intCorrIDList = range(0, len(strSecurityList))
-        else:
-            self.intCorrIDList = intCorrIDList
-
-        self.subscriptionList = blpapi.subscriptionlist.SubscriptionList()
-        for (security, intCorrID) in zip(self.strSecurityList, self.intCorrIDList):
-            self.subscriptionList.add(security, self.strDataList, "interval="+str(floatInterval), blpapi.CorrelationId(intCorrID))
-
-        self.output               = pandas.DataFrame(index=self.strSecurityList, columns=self.strDataList)
-        self.dictCorrID           = dict(zip(self.intCorrIDList, self.strSecurityList))
+            intCorrIDList = range(0, len(strSecurityList))
+
+        self.floatInterval        = floatInterval
+        self.strSecurityList      = []
+        self.intCorrIDList        = []
+        self.strDataList          = []
+        self.store                = store if store is not None else BLPTickStore([], [], historySize)
+        self.dictCorrID           = {}
+        self.rowOfCorrID          = {}
+        self.shardOfCorrID        = {}
+        self.getterOf             = {}  # field -> (getter, numeric), picked from the datatype of the first value received for the field
+        self.lock                 = threading.RLock()
+        self.subscribed           = False
+        self.counters             = collections.Counter()
+        self.countersLock         = threading.Lock()
         self.lastUpdateTimeBlmbrg = ''  # Warning - if you mix live and delayed data you could have non increasing data
         self.lastUpdateTime       = datetime.datetime(1900, 1, 1)
         self.observers            = []
+        self.observerLock         = threading.Lock() if sessionCount > 1 else None
+        self.stats                = stats
+        self.identity             = identity
+        self.local                = threading.local()  # observer time of the current handler thread
+        self.decoding             = ([], [], [], [])
+        self.setFields(strDataList)
+        self.addSecurities(strSecurityList, intCorrIDList)
+
+    @property
+    def output(self):
+        with self.lock:
+            securities, fields = list(self.strSecurityList), list(self.strDataList)
+        return self.store.snapshot().reindex(index=securities, columns=fields)
 
     def register(self, observer):
         if not observer in self.observers:
@@ -388,13 +2057,120 @@ class BLPStream(threading.Thread):
             del self.observers[:]
 
     def updateObservers(self, *args, **kwargs):
+        if self.stats is None or not self.observers:
+            for observer in self.observers:
+                observer.update(*args, **kwargs)
+            return
+        start = time.time()
         for observer in self.observers:
             observer.update(*args, **kwargs)
+        elapsed = time.time() - start
+        self.local.observerTime = getattr(self.local, 'observerTime', 0.) + elapsed
+        self.stats.record('observers', elapsed)
+
+    @property
+    def subscriptionList(self):
+        """blpapi SubscriptionList of the current securities and fields"""
+        with self.lock:
+            return self._subscriptionList(self.intCorrIDList)
+
+    def _subscriptionList(self, intCorrIDList):
+        subscriptionList = blpapi.subscriptionlist.SubscriptionList()
+        for intCorrID in intCorrIDList:
+            subscriptionList.add(self.dictCorrID[intCorrID], self.strDataList, "interval="+str(self.floatInterval), blpapi.CorrelationId(intCorrID))
+        return subscriptionList
+
+    def shards(self, intCorrIDList):
+        """intCorrIDList split by shard, as a list of (shard, ids)"""
+        output = [[] for session in self.sessions]
+        for intCorrID in intCorrIDList:
+            output[self.shardOfCorrID[intCorrID]].append(intCorrID)
+        return [(shard, ids) for (shard, ids) in enumerate(output) if ids]
+
+    def subscribe(self, intCorrIDList):
+        for shard, ids in self.shards(intCorrIDList):
+            self.sessions[shard].subscribe(self._subscriptionList(ids), ids, self.stats, self.handles[shard], self.identity)
+
+    def addSecurities(self, securities, intCorrIDList=None):
+        """Subscribes to more securities, with the next free correlation IDs unless given. Each goes to the shard with the fewest securities."""
+        if type(securities) == str:
+            securities = [securities]
+        with self.lock:
+            if intCorrIDList is None:
+                first = max(self.intCorrIDList) + 1 if self.intCorrIDList else 0
+                intCorrIDList = range(first, first + len(securities))
+            intCorrIDList = list(intCorrIDList)
+            if len(intCorrIDList) != len(securities):
+                raise ValueError('Number of securities needs to match number of Correlation IDs')
+            for intCorrID in intCorrIDList:
+                if intCorrID in self.dictCorrID:
+                    raise ValueError('Correlation ID ' + str(intCorrID) + ' is already used by this stream')
+            shardSizes = [0] * len(self.sessions)
+            for shard in self.shardOfCorrID.values():
+                shardSizes[shard] += 1
+            for security, intCorrID, row in zip(securities, intCorrIDList, self.store.addSecurities(securities)):
+                shard = shardSizes.index(min(shardSizes))
+                shardSizes[shard] += 1
+                self.strSecurityList.append(security)
+                self.intCorrIDList.append(intCorrID)
+                self.dictCorrID[intCorrID]    = security
+                self.rowOfCorrID[intCorrID]   = row
+                self.shardOfCorrID[intCorrID] = shard
+            if self.subscribed:
+                self.subscribe(intCorrIDList)
+
+    def removeSecurities(self, securities):
+        """Unsubscribes from securities. Their last values stay in the store but leave self.output."""
+        if type(securities) == str:
+            securities = [securities]
+        with self.lock:
+            intCorrIDList = [intCorrID for (intCorrID, security) in zip(self.intCorrIDList, self.strSecurityList) if security in securities]
+            if self.subscribed:
+                for shard, ids in self.shards(intCorrIDList):
+                    self.sessions[shard].unsubscribe(self._subscriptionList(ids), self.handles[shard])
+            for intCorrID in intCorrIDList:
+                i = self.intCorrIDList.index(intCorrID)
+                del self.intCorrIDList[i]
+                del self.strSecurityList[i]
+                del self.dictCorrID[intCorrID]
+                del self.rowOfCorrID[intCorrID]
+                del self.shardOfCorrID[intCorrID]
+
+    def setFields(self, fields):
+        """Changes the fields of every subscription, resubscribing them if streaming"""
+        if type(fields) == str:
+            fields = [fields]
+        with self.lock:
+            fields = _uniqueList(fields)
+            if fields == self.strDataList:
+                return
+            self.strDataList = fields
+            # swapped in one go, as the handler threads may be decoding
+            self.decoding    = (list(fields), [blpapi.Name(f) for f in fields], self.store.addFields(fields), [self.getterOf.get(f) for f in fields])
+            if self.subscribed:
+                for shard, ids in self.shards(self.intCorrIDList):
+                    self.sessions[shard].resubscribe(self._subscriptionList(ids))
+
+    def addFields(self, fields):
+        self.setFields(self.strDataList + _uniqueList(fields))
+
+    def removeFields(self, fields):
+        fields = _uniqueList(fields)
+        self.setFields([f for f in self.strDataList if f not in fields])
 
     def run(self, verbose=False):
-        self.session.subscribe(self.subscriptionList)
+        with self.lock:
+            self.subscribed = True
+            self.subscribe(self.intCorrIDList)
+        for handle in self.handles[1:]:
+            thread = threading.Thread(target=self.drain, args=(handle, verbose))
+            thread.daemon = True
+            thread.start()
+        self.drain(self.handle, verbose)
+
+    def drain(self, handle, verbose=False):
         while True:
-            event = self.session.nextEvent()
+            event = handle.nextEvent()
             if event.eventType() == blpapi.event.Event.SUBSCRIPTION_DATA:
                 self.handleDataEvent(event)
             else:
@@ -402,34 +2178,83 @@ class BLPStream(threading.Thread):
                     self.handleOtherEvent(event)
 
     def handleDataEvent(self, event):
-        output              = blpapi.event.MessageIterator(event).__next__() if BLPAPI_VERSION > 3.17 else blpapi.event.MessageIterator(event).next()
+        if self.stats is None:
+            return self.decodeDataEvent(event)
+        self.local.observerTime = 0.
+        start = time.time()
+        self.stats.count('ticks', self.decodeDataEvent(event))
+        self.stats.record('decode', time.time() - start - self.local.observerTime)
+
+    def decodeDataEvent(self, event):
+        """Decodes every message of the event, returns the number of field updates decoded"""
         self.lastUpdateTime = datetime.datetime.now()
-        corrID              = output.correlationIds()[0].value()
-        security            = self.dictCorrID[corrID]
-        isParsed            = False
-        #print(output.toString())
-
-        if output.hasElement(EVENT_TIME):
-            self.lastUpdateTimeBlmbrg = output.getElement(EVENT_TIME).toString()
-
-        for field in self.strDataList:
-            if output.hasElement(field):
-                isParsed = True
+        now      = time.time()
+        messages = 0
+        ticks    = 0
+        for msg in event:
+            messages += 1
+            ticks    += self.decodeMessage(msg, now)
+        with self.countersLock:
+            self.counters['messages'] += messages
+            self.counters['ticks']    += ticks
+        return ticks
+
+    def decodeMessage(self, msg, now):
+        corrID   = msg.correlationIds()[0].value()
+        row      = self.rowOfCorrID.get(corrID)
+        security = self.dictCorrID.get(corrID)
+        if row is None or security is None:
+            self.count('unknownCorrelationIds')
+            return 0
+        fields, names, storeColumns, getters = self.decoding
+        updates  = []  # (field, value)
+        columns  = []  # store columns and values of the numeric fields
+        values   = []
+
+        if msg.hasElement(EVENT_TIME):
+            self.lastUpdateTimeBlmbrg = msg.getElement(EVENT_TIME).toString()
+
+        for k, name in enumerate(names):
+            if msg.hasElement(name):
+                element = msg.getElement(name)
+                getter  = getters[k]
+                if getter is None:
+                    getter = getters[k] = self.getterOf[fields[k]] = _scalarGetter(element.datatype())
                 try:
-                    data = output.getElement(field).getValueAsFloat()
-                except:
-                    data = nan
-                    print('error: ',security,field)#,output.getElement(field).getValueAsString() # this can still error if field is there but is empty
-                self.output.loc[security, field] = data
-                self.updateObservers(time=self.lastUpdateTime, security=security, field=field, corrID=corrID, data=data, bbgTime=self.lastUpdateTimeBlmbrg)
+                    data = getter[0](element)
+                except Exception:
+                    self.count('unparseableFields')  # e.g. a null value
+                    continue
+                updates.append((fields[k], data))
+                if getter[1]:
+                    columns.append(storeColumns[k])
+                    values.append(data)
+
+        if columns:
+            self.store.write(row, columns, values, now)
+        elif not updates:
+            self.count('emptyMessages')
+        if self.observerLock is None:
+            self.notify(security, corrID, updates)
+        else:
+            with self.observerLock:
+                self.notify(security, corrID, updates)
+        return len(updates)
 
+    def notify(self, security, corrID, updates):
+        for field, data in updates:
+            self.updateObservers(time=self.lastUpdateTime, security=security, field=field, corrID=corrID, data=data, bbgTime=self.lastUpdateTimeBlmbrg)
         # It can happen that you get an event without the data behind the event!
         self.updateObservers(time=self.lastUpdateTime, security=security, field='ALL', corrID=corrID, data=0, bbgTime=self.lastUpdateTimeBlmbrg)
-        # if not isParsed:
-        #     print(output.toString())
+
+    def count(self, name, n=1):
+        with self.countersLock:
+            self.counters[name] += n
+        if self.stats is not None:
+            self.stats.count(name, n)
 
     def handleOtherEvent(self, event):
-        output = blpapi.event.MessageIterator(event).__next__() if BLPAPI_VERSION > 3.17 else blpapi.event.MessageIterator(event).next()
+        output = next(iter(event))
         msg = output.toString()
         if event.eventType() == blpapi.event.Event.AUTHORIZATION_STATUS:
             print("Authorization event: " + msg)
@@ -439,32 +2264,506 @@ class BLPStream(threading.Thread):
             print("Other event: event "+str(event.eventType()))
 
     def closeSubscription(self):
-        self.session.unsubscribe(self.subscriptionList)
+        with self.lock:
+            for shard, ids in self.shards(self.intCorrIDList):
+                self.sessions[shard].unsubscribe(self._subscriptionList(ids), self.handles[shard])
+            self.subscribed = False
 ################################################
 #Convenience functions below####################
 ################################################
 
 
+def _chunks(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
+
+
+def _uniqueList(values):
+    if type(values) == str:
+        return [values]
+    seen = set()
+    return [x for x in values if not (x in seen or seen.add(x))]
+
+
+def _setOverride(request, strOverrideField, strOverrideValue):
+    if strOverrideField != '':
+        o = request.getElement('overrides').appendElement()
+        o.setElement('fieldId', strOverrideField)
+        o.setElement('value', strOverrideValue)
+
+
+def _responseMessages(handle):
+    '''
+    Yields every message of every partial and final response to a request, stopping after the final response or a request failure.
+    Raises BLPTimeoutError, after cancelling the request, if handle.deadline passes first.
+    '''
+    while True:
+        event = _nextEvent(handle, handle.deadline)
+        if event.eventType() == blpapi.event.Event.TIMEOUT:
+            handle.cancel()
+            raise BLPTimeoutError('no response in time')
+        if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.PARTIAL_RESPONSE]:
+            for msg in event:
+                yield msg
+        if event.eventType() == blpapi.event.Event.REQUEST_STATUS:
+            handle.finished = True
+            _printRequestFailure(event)
+            break
+        if event.eventType() == blpapi.event.Event.RESPONSE:
+            handle.finished = True
+            break
+
+
+def _cancelUnfinished(handles):
+    '''
+    Cancels the requests still waiting for their final response, once their reader has given up on them, e.g. after a BLPTimeoutError
+    '''
+    for handle in handles:
+        if not handle.finished and not handle.cancelled:
+            handle.cancel()
+
+
+def _nextEvent(handle, deadline=None):
+    '''
+    handle.nextEvent, returning a TIMEOUT event once deadline has passed
+    '''
+    if deadline is None:
+        return handle.nextEvent()
+    remaining = deadline - time.time()
+    if remaining < 0.001:
+        return BLPRoutedEvent(blpapi.event.Event.TIMEOUT, [])
+    return handle.nextEvent(1000 * remaining)
+
+
+def _printRequestFailure(event):
+    for msg in event:
+        print('request failed: ' + str(msg.asElement()))
+
+
+class _DecodeTimer(object):
+    '''
+    Adds up the time a loop spends on the messages it takes from wrap(), not the time spent waiting for them, and records it as 'decode' in stats.
+    Costs nothing when stats is None.
+    '''
+    def __init__(self, stats):
+        self.stats   = stats
+        self.seconds = 0.
+
+    def wrap(self, messages):
+        if self.stats is None:
+            return messages
+        return self.timed(messages)
+
+    def timed(self, messages):
+        for msg in messages:
+            start = time.time()
+            yield msg
+            self.seconds += time.time() - start
+
+    def record(self, build, *args):
+        '''Returns build(*args), recording its time along with that of the loop'''
+        if self.stats is None:
+            return build(*args)
+        start  = time.time()
+        output = build(*args)
+        self.stats.record('decode', self.seconds + time.time() - start)
+        return output
+
+
+def _elementValue(element):
+    '''
+    Reads a reference data field with the getter matching its datatype; bulk fields go through _dict_from_element
+    '''
+    datatype = element.datatype()
+    if element.isArray() or datatype in (blpapi.DataType.SEQUENCE, blpapi.DataType.CHOICE):
+        return _dict_from_element(element)
+    if element.isNull():
+        return nan
+    if datatype in (blpapi.DataType.FLOAT32, blpapi.DataType.FLOAT64, blpapi.DataType.DECIMAL):
+        return element.getValueAsFloat()
+    if datatype in (blpapi.DataType.INT32, blpapi.DataType.INT64):
+        return element.getValueAsInteger()
+    if datatype in (blpapi.DataType.DATE, blpapi.DataType.DATETIME, blpapi.DataType.TIME):
+        return element.getValueAsDatetime()
+    if datatype == blpapi.DataType.BOOL:
+        return element.getValueAsBool()
+    output = element.getValueAsString()
+    return nan if output == '#N/A' else output
+
+
+def _getFloat(element):
+    return element.getValueAsFloat()
+
+
+def _getDatetime(element):
+    return element.getValueAsDatetime()
+
+
+def _getBool(element):
+    return element.getValueAsBool()
+
+
+def _getString(element):
+    return element.getValueAsString()
+
+
+def _scalarGetter(datatype):
+    '''
+    Returns the getter for a scalar element of that datatype, e.g. a subscription field, and whether its values are numeric
+    '''
+    if datatype in (blpapi.DataType.FLOAT32, blpapi.DataType.FLOAT64, blpapi.DataType.DECIMAL, blpapi.DataType.INT32, blpapi.DataType.INT64):
+        return _getFloat, True
+    if datatype in (blpapi.DataType.DATE, blpapi.DataType.DATETIME, blpapi.DataType.TIME):
+        return _getDatetime, False
+    if datatype == blpapi.DataType.BOOL:
+        return _getBool, False
+    return _getString, False
+
+
+class _ReferenceDataDecoder(object):
+    '''
+    Decodes ReferenceDataResponse messages in a single pass into one preallocated NumPy array per field, and builds the DataFrame once at the end.
+    Each array is typed on the first value received for its field: float64 for numbers, datetime64 for dates, object otherwise.
+    A security listed more than once is decoded into its first row, copied to the others by frame().
+    '''
+    def __init__(self, securities, fields):
+        self.securities = list(securities)
+        self.fields     = list(fields)
+        self.rows       = {}
+        self.duplicates = []  # (first row, other row) of securities listed more than once
+        for i, security in enumerate(self.securities):
+            first = self.rows.setdefault(security, i)
+            if first != i:
+                self.duplicates.append((first, i))
+        self.columnOf   = {}
+        for k, field in enumerate(self.fields):
+            self.columnOf[blpapi.Name(field)] = k
+            self.columnOf.setdefault(blpapi.Name(field.upper()), k)
+        self.arrays     = [None] * len(self.fields)
+        self.getters    = [None] * len(self.fields)
+
+    def addMessage(self, msg):
+        '''
+        Returns a list of (security, {field: value}) in message order
+        '''
+        results           = []
+        securityDataArray = msg.getElement(SECURITY_DATA)
+        for i in range(0, securityDataArray.numValues()):
+            securityData = securityDataArray.getValueAsElement(i)
+            security     = securityData.getElementAsString(SECURITY)
+            row          = self.rows.get(security)
+            fieldData    = securityData.getElement(FIELD_DATA)
+            values       = {}
+            for j in range(0, fieldData.numElements()):
+                element = fieldData.getElement(j)
+                k       = self.columnOf.get(element.name())
+                if k is not None:
+                    values[self.fields[k]] = self.setValue(row, k, element)
+            results.append((security, values))
+        return results
+
+    def seed(self, values):
+        '''
+        values: {security: {field: value}} of already decoded values, e.g. from a BLPReferenceCache
+        '''
+        for security, fieldValues in values.items():
+            row = self.rows.get(security)
+            if row is None:
+                continue
+            for field, value in fieldValues.items():
+                k = self.fields.index(field)
+                if self.arrays[k] is None:
+                    self.allocateFor(k, value)
+                if value is nan:
+                    continue
+                if self.arrays[k].dtype.kind == 'f' and not isinstance(value, (float, int)) or self.arrays[k].dtype.kind == 'M' and not isinstance(value, (datetime.date, numpy.datetime64)):
+                    self.arrays[k]  = self.arrays[k].astype(object)
+                    self.getters[k] = _elementValue
+                self.arrays[k][row] = value
+
+    def allocateFor(self, k, value):
+        if isinstance(value, (float, int)) and not isinstance(value, bool):
+            self.allocate(k, blpapi.DataType.FLOAT64)
+        elif isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+            self.allocate(k, blpapi.DataType.DATE)
+        else:
+            self.allocate(k, blpapi.DataType.STRING)
+
+    def setValue(self, row, k, element):
+        if self.getters[k] is None:
+            self.allocate(k, element.datatype())
+        try:
+            value = self.getters[k](element)
+        except Exception:  # null element, or a type the column was not allocated for
+            value = _elementValue(element)
+            if value is nan:
+                return value
+            if self.arrays[k].dtype != object:
+                self.arrays[k]  = self.arrays[k].astype(object)
+                self.getters[k] = _elementValue
+        if row is not None:
+            self.arrays[k][row] = value
+        return value
+
+    def allocate(self, k, datatype):
+        n = len(self.securities)
+        if datatype in (blpapi.DataType.FLOAT32, blpapi.DataType.FLOAT64, blpapi.DataType.DECIMAL, blpapi.DataType.INT32, blpapi.DataType.INT64):
+            self.arrays[k], self.getters[k] = numpy.full(n, nan), _getFloat
+        elif datatype == blpapi.DataType.DATE:
+            self.arrays[k], self.getters[k] = numpy.full(n, numpy.datetime64('NaT'), dtype='datetime64[ns]'), _getDatetime
+        else:
+            self.arrays[k], self.getters[k] = numpy.full(n, nan, dtype=object), _elementValue
+
+    def frame(self):
+        n = len(self.securities)
+        if self.duplicates:
+            first, other = [list(rows) for rows in zip(*self.duplicates)]
+            for array in self.arrays:
+                if array is not None:
+                    array[other] = array[first]
+        columns = dict((f, self.arrays[k] if self.arrays[k] is not None else numpy.full(n, nan)) for k, f in enumerate(self.fields))
+        return pandas.DataFrame(columns, index=self.securities, columns=self.fields)
+
+
+class _HistoryAccumulator(object):
+    '''
+    Appends HistoricalDataResponse messages as they arrive: one datetime64 array of dates and one float64 matrix of values per message.
+    wide() and long() then build the output in one go, without intermediate DataFrames.
+    keep=False only decodes the messages, wide() and long() then stay empty.
+    '''
+    def __init__(self, fields, keep=True):
+        self.keep       = keep
+        self.fields     = list(fields)
+        self.fieldIndex = dict((f, k) for k, f in enumerate(self.fields))
+        self.names      = [blpapi.Name(f) for f in self.fields]
+        self.chunks     = []  # (security, dates, field indexes, values)
+
+    def addMessage(self, msg, fields=None):
+        '''
+        fields: the fields of the request the message answers, all fields by default
+        Returns (security, dates, values) for the message, values having one column per field
+        '''
+        fieldIdx       = numpy.arange(len(self.fields)) if fields is None else numpy.array([self.fieldIndex[f] for f in fields], dtype=int)
+        names          = [self.names[k] for k in fieldIdx]
+        securityData   = msg.getElement(SECURITY_DATA)
+        security       = securityData.getElementAsString(SECURITY)
+        fieldDataArray = securityData.getElement(FIELD_DATA)
+        n              = fieldDataArray.numValues()
+        ordinals       = numpy.empty(n, dtype='int64')
+        values         = numpy.full((n, len(names)), nan)
+        for i in range(0, n):
+            row         = fieldDataArray.getValueAsElement(i)
+            ordinals[i] = row.getElementAsDatetime(DATE).toordinal()
+            for k, name in enumerate(names):
+                if row.hasElement(name):
+                    values[i, k] = row.getElementAsFloat(name)
+        dates = (ordinals - _ORDINAL_1970).astype('datetime64[D]').astype('datetime64[ns]')
+        if self.keep:
+            self.chunks.append((security, dates, fieldIdx, values))
+        return security, dates, values
+
+    def append(self, security, dates, fields, values):
+        '''
+        Adds data that did not come from a message, values having one column per field
+        '''
+        fieldIdx = numpy.array([self.fieldIndex[f] for f in fields], dtype=int)
+        self.chunks.append((security, numpy.asarray(dates).astype('datetime64[ns]'), fieldIdx, numpy.asarray(values, dtype=float).reshape(len(dates), len(fields))))
+
+    def wide(self, securities=None):
+        '''
+        DataFrame indexed by date with (Security, Field) MultiIndex columns, securities in the given order or else in order of arrival
+        '''
+        if securities is None:
+            securities = _uniqueList([c[0] for c in self.chunks])
+        nFields  = len(self.fields)
+        position = dict((s, i) for i, s in enumerate(securities))
+        dates    = numpy.unique(numpy.concatenate([c[1] for c in self.chunks])) if self.chunks else numpy.array([], dtype='datetime64[ns]')
+        data     = numpy.full((len(dates), len(securities) * nFields), nan)
+        for security, chunkDates, fieldIdx, values in self.chunks:
+            if security in position:
+                data[numpy.ix_(numpy.searchsorted(dates, chunkDates), position[security] * nFields + fieldIdx)] = values
+        columns = pandas.MultiIndex.from_product([securities, self.fields], names=['Security', 'Field'])
+        return pandas.DataFrame(data, index=pandas.DatetimeIndex(dates), columns=columns)
+
+    def long(self):
+        '''
+        DataFrame with columns security, date, field, value and one row per value received
+        '''
+        securities = _uniqueList([c[0] for c in self.chunks])
+        position   = dict((s, i) for i, s in enumerate(securities))
+        secCodes, dates, fieldCodes, values = [numpy.array([], dtype=int)], [numpy.array([], dtype='datetime64[ns]')], [numpy.array([], dtype=int)], [numpy.array([])]
+        for security, chunkDates, fieldIdx, chunkValues in self.chunks:
+            n, m = chunkValues.shape
+            secCodes.append(numpy.full(n * m, position[security]))
+            dates.append(numpy.repeat(chunkDates, m))
+            fieldCodes.append(numpy.tile(fieldIdx, n))
+            values.append(chunkValues.ravel())
+        secCodes, dates, fieldCodes, values = [numpy.concatenate(x) for x in (secCodes, dates, fieldCodes, values)]
+        mask = ~numpy.isnan(values)
+        return pandas.DataFrame({'security': pandas.Categorical.from_codes(secCodes[mask], securities),
+                                 'date': dates[mask],
+                                 'field': pandas.Categorical.from_codes(fieldCodes[mask], self.fields),
+                                 'value': values[mask]})
+
+
+class _IntradayDecoder(object):
+    '''
+    Decodes IntradayBarResponse or IntradayTickResponse messages straight into one NumPy array per column, message by message.
+    columns: list of (name, dtype) - float64 columns are read with getElementAsFloat, int64 with getElementAsInteger, object with getElementAsString
+    '''
+    def __init__(self, dataName, rowsName, columns):
+        self.dataName = blpapi.Name(dataName)
+        self.rowsName = blpapi.Name(rowsName)
+        self.columns  = [(column, blpapi.Name(column), numpy.dtype(dtype)) for (column, dtype) in columns]
+
+    @staticmethod
+    def bars():
+        return _IntradayDecoder('barData', 'barTickData', [('open', 'float64'), ('high', 'float64'), ('low', 'float64'), ('close', 'float64'), ('volume', 'int64'), ('numEvents', 'int64')])
+
+    @staticmethod
+    def ticks():
+        return _IntradayDecoder('tickData', 'tickData', [('type', object), ('value', 'float64'), ('size', 'int64')])
+
+    def decode(self, msg, security=''):
+        '''
+        Returns (times, {column: array}) for the rows of the message, None for an error message
+        '''
+        if msg.hasElement(RESPONSE_ERROR):
+            print('error with ' + security + ': ' + msg.getElement(RESPONSE_ERROR).toString())
+            return None
+        rows    = msg.getElement(self.dataName).getElement(self.rowsName)
+        n       = rows.numValues()
+        times   = numpy.empty(n, dtype='datetime64[us]')
+        arrays  = [numpy.zeros(n, dtype=dtype) if dtype != object else numpy.empty(n, dtype=object) for (column, name, dtype) in self.columns]
+        getters = [_INTRADAY_GETTERS[dtype.kind] for (column, name, dtype) in self.columns]
+        names   = [name for (column, name, dtype) in self.columns]
+        for i in range(0, n):
+            row      = rows.getValueAsElement(i)
+            t        = row.getElementAsDatetime(TIME)
+            times[i] = t.replace(tzinfo=None) if t.tzinfo is not None else t
+            for array, getter, name in zip(arrays, getters, names):
+                if row.hasElement(name):
+                    array[i] = getter(row, name)
+        return times, dict((column, array) for ((column, name, dtype), array) in zip(self.columns, arrays))
+
+    def frame(self, chunks):
+        '''
+        One DataFrame indexed by time out of decode's outputs, concatenated in order
+        '''
+        times = numpy.concatenate([c[0] for c in chunks]) if chunks else numpy.array([], dtype='datetime64[us]')
+        data  = dict((column, numpy.concatenate([c[1][column] for c in chunks]) if chunks else numpy.array([], dtype=dtype)) for (column, name, dtype) in self.columns)
+        if 'type' in data:
+            data['type'] = pandas.Categorical(data['type'])
+        return pandas.DataFrame(data, index=pandas.DatetimeIndex(times.astype('datetime64[ns]'), name='time'), columns=[column for (column, name, dtype) in self.columns])
+
+
+_INTRADAY_GETTERS = {'f': lambda row, name: row.getElementAsFloat(name),
+                     'i': lambda row, name: row.getElementAsInteger(name),
+                     'O': lambda row, name: row.getElementAsString(name)}
+
+
+def _timeRanges(start, end, span):
+    '''
+    Splits [start, end) into consecutive ranges of at most span
+    '''
+    ranges = []
+    while start < end:
+        ranges.append((start, min(start + span, end)))
+        start = start + span
+    return ranges
+
+
 def _dict_from_element(element):
     '''
-    Used for e.g. dividends
+    Used for e.g. dividends: arrays become lists, sequences dictionaries keyed by sub-element name, and values strings (NaN when null).
+    Walks the element with an explicit stack and picks each node's reader from its datatype - no exception is raised and caught along the way.
+    For flat tables of bulk fields, see _BulkDecoder.
     '''
-    try:
-        return element.getValueAsString()
-    except:
-        if element.numValues() > 1:
-            results = []
-            for i in range(0, element.numValues()):
-                subelement    = element.getValue(i)
-                name          = str(subelement.name())
-                results.append(_dict_from_element(subelement))
+    holder = [None]
+    stack  = [(element, holder, 0)]  # (element, container of its value, key or index in it)
+    while stack:
+        node, container, key = stack.pop()
+        complexType = node.datatype() in (blpapi.DataType.SEQUENCE, blpapi.DataType.CHOICE)
+        if node.isArray():
+            n     = node.numValues()
+            value = [None] * n
+            if complexType:
+                for i in range(n - 1, -1, -1):
+                    stack.append((node.getValueAsElement(i), value, i))
+            else:
+                for i in range(0, n):
+                    value[i] = node.getValueAsString(i)
+        elif complexType:
+            children = [node.getElement(j) for j in range(0, node.numElements())]
+            value    = dict((str(child.name()), None) for child in children)  # keys in element order
+            for child in reversed(children):
+                stack.append((child, value, str(child.name())))
         else:
-            results = {}
-            for j in range(0, element.numElements()):
-                subelement    = element.getElement(j)
-                name          = str(subelement.name())
-                results[name] = _dict_from_element(subelement)
-        return results
+            value = nan if node.isNull() else node.getValueAsString()
+        container[key] = value
+    return holder[0]
+
+
+class _BulkDecoder(object):
+    '''
+    Decodes bulk fields (arrays of sequences such as DVD_HIST_ALL or INDX_MWEIGHT) of ReferenceDataResponse messages into flat columns, one table per field.
+    The layout of each field - its sub-element names and the getter matching each datatype - is read from its first row and cached,
+    so every value is one typed getter call, without exceptions. Scalar fields come out as one row with one column named after the field.
+    '''
+    def __init__(self):
+        self.layouts     = {}  # field -> [(column, blpapi.Name, getter)]
+        self.dateColumns = {}  # field -> columns of dates, made datetime64 in frame
+        self.tables      = {}  # field -> {'security': [...], column: [...]}
+
+    def addMessage(self, msg):
+        securityDataArray = msg.getElement(SECURITY_DATA)
+        for i in range(0, securityDataArray.numValues()):
+            securityData = securityDataArray.getValueAsElement(i)
+            security     = securityData.getElementAsString(SECURITY)
+            fieldData    = securityData.getElement(FIELD_DATA)
+            for j in range(0, fieldData.numElements()):
+                self.add(security, fieldData.getElement(j))
+
+    def add(self, security, element):
+        field = str(element.name())
+        if not element.isArray():
+            table = self.tables.setdefault(field, {'security': [], field: []})
+            table['security'].append(security)
+            table[field].append(_elementValue(element))
+            return
+        n = element.numValues()
+        if n == 0:
+            return
+        layout = self.layouts.get(field)
+        if layout is None:
+            layout = self.layouts[field] = self.layout(field, element.getValueAsElement(0))
+        table   = self.tables.setdefault(field, dict([('security', [])] + [(column, []) for (column, name, getter) in layout]))
+        table['security'].extend([security] * n)
+        columns = [(table[column], name, getter) for (column, name, getter) in layout]
+        for i in range(0, n):
+            row = element.getValueAsElement(i)
+            for values, name, getter in columns:
+                values.append(getter(row.getElement(name)) if row.hasElement(name, True) else nan)
+
+    def layout(self, field, row):
+        output = []
+        self.dateColumns[field] = []
+        for j in range(0, row.numElements()):
+            element = row.getElement(j)
+            getter  = _dict_from_element if element.isArray() or element.isComplexType() else _scalarGetter(element.datatype())[0]
+            output.append((str(element.name()), element.name(), getter))
+            if element.datatype() in (blpapi.DataType.DATE, blpapi.DataType.DATETIME):
+                self.dateColumns[field].append(str(element.name()))
+        return output
+
+    def frame(self, field):
+        table = self.tables.get(field)
+        if table is None:
+            return pandas.DataFrame(columns=['security'])
+        output = pandas.DataFrame(table, columns=list(table.keys()))
+        for column in self.dateColumns.get(field, []):
+            output[column] = pandas.to_datetime(output[column])
+        return output
 
 
 class Observer(object):
@@ -474,6 +2773,11 @@ class Observer(object):
     def update(self, *args, **kwargs):
         pass
 
+    def updateBatch(self, updates):
+        """Called by BLPQueuedObserver with a list of the keyword arguments of several updates, oldest first. Override to process them in one go."""
+        for kwargs in updates:
+            self.update(**kwargs)
+
 
 class HistoryWatcher(Observer):
     """Object to stream and record history data from Bloomberg.
@@ -486,42 +2790,583 @@ class HistoryWatcher(Observer):
             self.outputDC[(kwargs['security'], kwargs['field'])]=kwargs['data'][[kwargs['field']]]#double brackets keep it a dataframe, not a series
 
 
-def simpleReferenceDataRequest(id_to_ticker_dic, fields, sapi_dic=None):
+class BLPQueuedObserver(Observer):
+    """Runs an observer on its own thread, so that a slow observer does not hold up the BLPStream or BLPTS thread, or the other observers.
+    Register it instead of the observer: stream.register(BLPQueuedObserver(DatabaseWriter(), policy='conflate')). Observers registered directly stay inline.
+    Updates are queued and handed over in batches of at most batchSize to observer.updateBatch (see Observer), as keyword arguments.
+    When maxSize updates are waiting, policy decides what happens to the next one:
+    'block': the sender waits for room - nothing is lost, but a slow observer slows the feed down
+    'dropOldest': the oldest waiting update is discarded
+    'conflate': waiting updates are keyed by (security, field) and a new one replaces the waiting one for the same key, in place. A new key discards the oldest update when full.
+    depth() and lag() (seconds the oldest waiting update has been waiting) can be polled, summary() adds the counts of delivered, dropped and conflated updates.
+    stats: optional BLPStats recording the lag of each batch as 'observerLag' and its processing time as 'observers'.
+    close() stops the thread once the waiting updates are delivered."""
+
+    policies = ('block', 'dropOldest', 'conflate')
+
+    def __init__(self, observer, maxSize=10000, policy='block', batchSize=1000, stats=None):
+        if policy not in self.policies:
+            raise ValueError('policy must be one of ' + ', '.join(self.policies))
+        self.observer  = observer
+        self.maxSize   = maxSize
+        self.policy    = policy
+        self.batchSize = batchSize
+        self.stats     = stats
+        self.pending   = collections.OrderedDict()  # key -> (time queued, kwargs)
+        self.condition = threading.Condition()
+        self.sequence  = itertools.count()
+        self.closed    = False
+        self.maxDepth  = 0
+        self.delivered = 0
+        self.dropped   = 0
+        self.conflated = 0
+        self.thread    = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, *args, **kwargs):
+        if self.policy == 'conflate' and 'security' in kwargs:
+            key = (kwargs['security'], kwargs.get('field'))
+        else:
+            key = next(self.sequence)
+        with self.condition:
+            if self.closed:
+                return
+            if key in self.pending:
+                self.pending[key] = (self.pending[key][0], kwargs)  # keeps its place in the queue and its lag
+                self.conflated += 1
+                return
+            if self.policy == 'block':
+                while len(self.pending) >= self.maxSize and not self.closed:
+                    self.condition.wait()
+            elif len(self.pending) >= self.maxSize:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+            self.pending[key] = (time.time(), kwargs)
+            self.maxDepth = max(self.maxDepth, len(self.pending))
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.pending) == 0:
+                    return
+                batch = [self.pending.popitem(last=False)[1] for i in range(0, min(self.batchSize, len(self.pending)))]
+                self.condition.notify_all()
+            start = time.time()
+            try:
+                self.observer.updateBatch([kwargs for (queued, kwargs) in batch])
+            except Exception as e:
+                print('error in queued observer: ' + str(e))
+            if self.stats is not None:
+                self.stats.record('observerLag', start - batch[0][0])
+                self.stats.record('observers', time.time() - start)
+            with self.condition:
+                self.delivered += len(batch)
+
+    def depth(self):
+        return len(self.pending)
+
+    def lag(self):
+        with self.condition:
+            if len(self.pending) == 0:
+                return 0.
+            return time.time() - next(iter(self.pending.values()))[0]
+
+    def summary(self):
+        with self.condition:
+            return {'depth': len(self.pending), 'lag': self.lag(), 'maxDepth': self.maxDepth, 'delivered': self.delivered, 'dropped': self.dropped, 'conflated': self.conflated}
+
+    def close(self, timeout=None):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+
+def simpleReferenceDataRequest(id_to_ticker_dic, fields, sapi_dic=None, pooled=True, referenceCache=None, gateway=None):
     '''
     Common use case for reference data request
     id_to_ticker_dic: dictionnary with user id mapped to Bloomberg security ticker e.g. {'Apple':'AAPL US Equity'}
     Returns a dataframe indexed by the user id, with columns equal to fields
+    By default the request runs on a warm session from BLPSessionPool, pooled=False starts and stops a dedicated session
+    referenceCache: optional BLPReferenceCache, only what it lacks is requested
+    gateway: optional socket path of a BLPGateway to send the request to instead, True for the default one
     '''
     ticker_to_id_dic =  {v: k for k, v in id_to_ticker_dic.items()}
-    blpts = BLPTS(id_to_ticker_dic.values(), fields, sapi_dic=sapi_dic)
-    blpts.get()
-    blpts.closeSession()
-    blpts.output['id'] = blpts.output.index
-    blpts.output['id'].replace(ticker_to_id_dic,inplace=True)
-    blpts.output.set_index('id', inplace=True)
-    return blpts.output.copy()
+    if gateway is not None:
+        client = BLPGatewayClient(None if gateway is True else gateway)
+        output = client.blpts(list(id_to_ticker_dic.values()), fields)
+        client.close()
+    else:
+        blpts = BLPTS(list(id_to_ticker_dic.values()), fields, sapi_dic=sapi_dic, pooled=pooled, referenceCache=referenceCache)
+        blpts.get()
+        blpts.closeSession()
+        output = blpts.output.copy()
+    output.index = pandas.Index([ticker_to_id_dic.get(t, t) for t in output.index], name='id')
+    return output
 
 
-def simpleHistoryRequest(securities=[], fields=[], startDate=datetime.datetime(2015,1,1), endDate=datetime.datetime(2016,1,1), **kwargs):
+def simpleHistoryRequest(securities=[], fields=[], startDate=datetime.datetime(2015,1,1), endDate=datetime.datetime(2016,1,1), longFormat=False, historyStore=None, **kwargs):
     '''
     Convenience function to retrieve historical data for a list of securities and fields
     As returned data can have different length, missing data will be replaced with nan (note it's already taken care of in one security several fields)
     If multiple securities and fields, a MultiIndex dataframe will be returned.
+    longFormat=True returns a long dataframe with columns security, date, field, value instead, without the missing data.
+    historyStore: optional BLPHistoryStore, only the date ranges it lacks are requested (startDate and endDate must then be dates, not strings)
+    By default the request runs on a warm session from BLPSessionPool, pass pooled=False for a dedicated session
+    gateway: optional socket path of a BLPGateway to send the request to instead, True for the default one
     '''
+    gateway = kwargs.pop('gateway', None)
+    if gateway is not None:
+        client = BLPGatewayClient(None if gateway is True else gateway)
+        output = client.blpts(securities, fields, startDate=startDate, endDate=endDate, longFormat=longFormat, **kwargs)
+        client.close()
+        return output
+    kwargs.setdefault('pooled', True)
+    if historyStore is not None:
+        blp    = BLP(kwargs.get('sapi_dic'), kwargs['pooled'])
+        output = historyStore.history(blp._fetchHistory, _uniqueList(securities), _uniqueList(fields), startDate, endDate, False, kwargs.get('periodicity', 'DAILY'),
+                                      kwargs.get('strOverrideField', ''), kwargs.get('strOverrideValue', ''), longFormat)
+        blp.closeSession()
+        return output
     blpts = BLPTS(securities, fields, startDate=startDate, endDate=endDate, **kwargs)
-    historyWatcher = HistoryWatcher()
-    blpts.register(historyWatcher)
     blpts.get()
     blpts.closeSession()
-    #for key,df in historyWatcher.outputDC.iteritems():
-    for key, df in historyWatcher.outputDC.items():
-        df.columns = [key]
-    output = pandas.concat(historyWatcher.outputDC.values(), axis=1)
-    output.columns = pandas.MultiIndex.from_tuples(output.columns)
-    output.columns.names = ['Security', 'Field']
+    return blpts.historyFrame(longFormat)
+################################################
+
+
+class BLPGateway(object):
+    """Long-lived process owning warm sessions, which scripts and notebooks query over a local Unix socket instead of starting their own session.
+    Clients use BLPGatewayClient, or gateway= in simpleReferenceDataRequest and simpleHistoryRequest.
+    Requests and responses are length-prefixed frames: a json header, then for a DataFrame one raw buffer per numeric or date column,
+    so results are rebuilt with numpy.frombuffer rather than parsed. Other columns travel in the json header.
+    Each connection is served by its own thread, all of them sharing blp, by default BLP(sapi_dic, pooled=True) - pass one with a referenceCache,
+    historyStore, coalescer or scheduler to share those between all clients too, blpts requests included.
+    The socket is only accessible to the user running the gateway: by default it is in $XDG_RUNTIME_DIR, or in a directory of the temporary directory private to the user.
+    Example:
+    python -c "import blpapiwrapper; blpapiwrapper.BLPGateway().run()"   # once, in the background
+    BLPGatewayClient().bdp(['AAPL US Equity', 'MSFT US Equity'], 'PX_LAST')  # from any script
+    """
+    operations = ['bdp', 'bdh', 'bds', 'bdib', 'bdit', 'blpts']
+
+    def __init__(self, path=None, sapi_dic=None, blp=None):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError('BLPGateway needs Unix domain sockets')
+        self.path     = _gatewayPath(path)
+        self.sapi_dic = sapi_dic
+        self.blp      = blp if blp is not None else BLP(sapi_dic, pooled=True)
+        if os.path.exists(self.path):
+            try:
+                BLPGatewayClient(self.path).close()
+            except socket.error:
+                os.remove(self.path)  # left behind by a gateway that did not stop cleanly
+            else:
+                raise ValueError('a gateway is already listening on ' + self.path)
+        self.server = _GatewayServer(self.path, _GatewayHandler)
+        self.server.gateway = self
+        os.chmod(self.path, 0o600)
+
+    def run(self):
+        """Serves requests until stop() is called"""
+        self.server.serve_forever()
+
+    def start(self):
+        """Serves requests on a background thread"""
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def call(self, operation, args, kwargs):
+        if operation not in self.operations:
+            raise ValueError('unknown operation ' + str(operation))
+        if operation != 'blpts':
+            return getattr(self.blp, operation)(*args, **kwargs)
+        longFormat = kwargs.pop('longFormat', False)
+        kwargs.setdefault('sapi_dic', self.sapi_dic)
+        for option in ['referenceCache', 'coalescer', 'scheduler', 'priority', 'timeout', 'identity', 'stats']:
+            if getattr(self.blp, option) is not None:
+                kwargs.setdefault(option, getattr(self.blp, option))
+        blpts = BLPTS(*args, pooled=True, **kwargs)
+        blpts.get()
+        return blpts.historyFrame(longFormat) if 'startDate' in kwargs else blpts.output
+
+
+class BLPGatewayClient(object):
+    """Connection to a BLPGateway. bdp, bdh, bds, bdib and bdit take the same arguments and return the same results as the gateway's BLP,
+    so bdp for a single security and field returns a string unless that BLP has a referenceCache or coalescer. blpts(securities, fields, **kwargs) runs BLPTS(securities, fields, **kwargs).get()
+    in the gateway and returns its output, or its historyFrame(longFormat) for a HistoricalDataRequest.
+    One connection is kept open and can be used from several threads, one request at a time. Errors in the gateway are raised as BLPGatewayError."""
+
+    def __init__(self, path=None):
+        self.path = _gatewayPath(path)
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.path)
+        except socket.error:
+            self.sock.close()
+            raise
+
+    def call(self, operation, args, kwargs):
+        with self.lock:
+            _sendFrame(self.sock, json.dumps({'operation': operation, 'args': list(args), 'kwargs': kwargs}, default=_toJson).encode('utf-8'))
+            header = _receiveJson(self.sock)
+            if not header['ok']:
+                raise BLPGatewayError(header['error'])
+            buffers = [_receiveFrame(self.sock) for i in range(0, header['buffers'])]
+        return _decodeResult(header['result'], iter(buffers))
+
+    def bdp(self, *args, **kwargs):
+        return self.call('bdp', args, kwargs)
+
+    def bdh(self, *args, **kwargs):
+        return self.call('bdh', args, kwargs)
+
+    def bds(self, *args, **kwargs):
+        return self.call('bds', args, kwargs)
+
+    def bdib(self, *args, **kwargs):
+        return self.call('bdib', args, kwargs)
+
+    def bdit(self, *args, **kwargs):
+        return self.call('bdit', args, kwargs)
+
+    def blpts(self, securities, fields, **kwargs):
+        return self.call('blpts', [securities, fields], kwargs)
+
+    def close(self):
+        self.sock.close()
+
+
+class BLPGatewayError(Exception):
+    pass
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class _GatewayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class _GatewayHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = _receiveJson(self.request)
+            except EOFError:
+                return  # client gone
+            buffers = []
+            try:
+                result = self.server.gateway.call(request['operation'], request['args'], request['kwargs'])
+                header = {'ok': True, 'result': _encodeResult(result, buffers), 'buffers': len(buffers)}
+            except Exception as e:
+                header, buffers = {'ok': False, 'error': type(e).__name__ + ': ' + str(e)}, []
+            _sendFrame(self.request, json.dumps(header, default=_toJson).encode('utf-8'))
+            for buffer in buffers:
+                _sendFrame(self.request, buffer)
+
+
+def _gatewayPath(path):
+    '''
+    path, or by default a socket in a directory no other user can enter: $XDG_RUNTIME_DIR, or else blpapiwrapper-<user> in the temporary directory,
+    created with mode 0700 and refused if someone else owns it or can access it, as anyone can create it first
+    '''
+    if path is not None:
+        return path
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory or not os.path.isdir(directory):
+        directory = os.path.join(tempfile.gettempdir(), 'blpapiwrapper-' + getpass.getuser())
+        try:
+            os.mkdir(directory, 0o700)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        info = os.lstat(directory)
+        if hasattr(os, 'getuid') and (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077):
+            raise OSError(directory + ' must be a directory of ' + getpass.getuser() + ' that no one else can access')
+    return os.path.join(directory, 'blpapiwrapper.sock')
+
+
+def _sendFrame(sock, payload):
+    sock.sendall(struct.pack('!Q', len(payload)))
+    sock.sendall(payload)
+
+
+def _receiveFrame(sock):
+    size = struct.unpack('!Q', _receiveBytes(sock, 8))[0]
+    return _receiveBytes(sock, size)
+
+
+def _receiveBytes(sock, size):
+    output = bytearray(size)
+    view   = memoryview(output)
+    done   = 0
+    while done < size:
+        n = sock.recv_into(view[done:], size - done)
+        if n == 0:
+            raise EOFError('connection closed')
+        done += n
     return output
 
 
+def _receiveJson(sock):
+    return json.loads(bytes(_receiveFrame(sock)).decode('utf-8'), object_hook=_fromJson)
+
+
+def _toJson(value):
+    '''
+    json.dumps default for what json does not know: dates and times are tagged so that _fromJson restores them, numpy scalars become Python ones
+    '''
+    if isinstance(value, (datetime.datetime, pandas.Timestamp)):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {'__time__': value.isoformat()}
+    if isinstance(value, numpy.datetime64):
+        return {'__datetime__': pandas.Timestamp(value).isoformat()}
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return str(value)
+
+
+def _fromJson(d):
+    if '__datetime__' in d:
+        return pandas.Timestamp(d['__datetime__']).to_pydatetime()
+    if '__date__' in d:
+        return datetime.datetime.strptime(d['__date__'], '%Y-%m-%d').date()
+    if '__time__' in d:
+        return pandas.Timestamp('1970-01-01T' + d['__time__']).to_pydatetime().timetz()
+    return d
+
+
+def _encodeResult(result, buffers):
+    '''
+    json description of a result, the raw column buffers of DataFrames being appended to buffers
+    '''
+    if isinstance(result, pandas.DataFrame):
+        return {'frame': _encodeFrame(result, buffers)}
+    if isinstance(result, dict):
+        return {'keys': list(result.keys()), 'values': [_encodeResult(v, buffers) for v in result.values()]}
+    return {'value': result}
+
+
+def _decodeResult(result, buffers):
+    if 'frame' in result:
+        return _decodeFrame(result['frame'], buffers)
+    if 'keys' in result:
+        return dict((k, _decodeResult(v, buffers)) for k, v in zip(result['keys'], result['values']))
+    return result['value']
+
+
+def _encodeFrame(frame, buffers):
+    multi = isinstance(frame.columns, pandas.MultiIndex)
+    return {'index': _encodeColumn(frame.index.values, buffers), 'indexName': frame.index.name,
+            'columns': [list(c) if multi else c for c in frame.columns], 'multiColumns': multi, 'columnNames': list(frame.columns.names),
+            'data': [_encodeColumn(frame.iloc[:, i].values, buffers) for i in range(0, frame.shape[1])]}
+
+
+def _decodeFrame(header, buffers):
+    index   = pandas.Index(_decodeColumn(header['index'], buffers), name=header['indexName'])
+    data    = collections.OrderedDict((i, _decodeColumn(column, buffers)) for i, column in enumerate(header['data']))
+    frame   = pandas.DataFrame(data, index=index)
+    columns = header['columns']
+    frame.columns = pandas.MultiIndex.from_tuples([tuple(c) for c in columns], names=header['columnNames']) if header['multiColumns'] else pandas.Index(columns, name=header['columnNames'][0])
+    return frame
+
+
+def _encodeColumn(values, buffers):
+    if isinstance(values, pandas.Categorical):
+        buffers.append(numpy.ascontiguousarray(values.codes).tobytes())
+        return {'codes': values.codes.dtype.str, 'categories': values.categories.tolist()}
+    if values.dtype.kind in 'biufM':
+        buffers.append(numpy.ascontiguousarray(values).tobytes())
+        return {'dtype': values.dtype.str}
+    return {'values': list(values)}
+
+
+def _decodeColumn(column, buffers):
+    if 'codes' in column:
+        return pandas.Categorical.from_codes(numpy.frombuffer(next(buffers), dtype=numpy.dtype(column['codes'])), column['categories'])
+    if 'dtype' in column:
+        return numpy.frombuffer(next(buffers), dtype=numpy.dtype(column['dtype']))
+    return numpy.array(column['values'], dtype=object)
+
+################################################
+
+
+class BLPRecorder(object):
+    """Append-only log of everything a session receives, to replay it offline: pass it to BLPSharedSession.record, e.g. stream.session.record(BLPRecorder('ticks.blplog')).
+    Requests, subscriptions and every response and subscription event are written with the time they were received.
+    Encoding and compression happen on the recorder's own thread, so the dispatcher thread only queues the events.
+    The file is a header followed by zlib-compressed blocks of up to blockSize records, each written once full or flushInterval seconds after its first record.
+    Read it with BLPEventLog, or replay it through BLP, BLPTS and BLPStream with fakeblpapi.replay(path).
+    Several sessions can share one recorder. close() writes the last block."""
+    recordedTypes = (blpapi.event.Event.RESPONSE, blpapi.event.Event.PARTIAL_RESPONSE, blpapi.event.Event.REQUEST_STATUS, blpapi.event.Event.SUBSCRIPTION_DATA)
+
+    def __init__(self, path, blockSize=1000, flushInterval=1.):
+        self.path          = path
+        self.blockSize     = blockSize
+        self.flushInterval = flushInterval
+        self.file          = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(_LOG_MAGIC)
+        self.queue      = queue.Queue()
+        self.requestIds = {}  # request handle -> id in the log, until its final response
+        self.nextId     = 0
+        self.thread     = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, request, handle):
+        self.queue.put((time.time(), 'request', (request, handle)))
+
+    def subscribe(self, subscriptionList):
+        topics = [(subscriptionList.correlationIdAt(i).value(), subscriptionList.topicStringAt(i)) for i in range(0, subscriptionList.size())]
+        self.queue.put((time.time(), 'subscribe', topics))
+
+    def event(self, event):
+        if event.eventType() in self.recordedTypes:
+            self.queue.put((time.time(), 'event', event))
+
+    def run(self):
+        records, blockTime = [], None
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flushInterval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                record = self.encode(*item)
+                if record is not None:
+                    records.append(record)
+                    blockTime = blockTime or time.time()
+            if records and (len(records) >= self.blockSize or time.time() - blockTime >= self.flushInterval):
+                self.write(records)
+                records, blockTime = [], None
+        if records:
+            self.write(records)
+
+    def encode(self, timestamp, kind, data):
+        if kind == 'request':
+            request, handle = data
+            self.requestIds[handle] = self.nextId
+            self.nextId += 1
+            return [timestamp, kind, {'id': self.requestIds[handle], 'key': _requestKey(request.asElement())}]
+        if kind == 'subscribe':
+            return [timestamp, kind, data]
+        messages = []
+        for msg in data:
+            ids = [self.correlationId(c.value()) for c in msg.correlationIds()]
+            ids = [i for i in ids if i is not None]
+            if ids:
+                messages.append([str(msg.messageType()), ids, msg.topicName(), [_encodeElement(e) for e in msg.asElement().elements()]])
+        if data.eventType() in (blpapi.event.Event.RESPONSE, blpapi.event.Event.REQUEST_STATUS):
+            for msg in data:
+                for c in msg.correlationIds():
+                    self.requestIds.pop(c.value(), None)
+        return [timestamp, kind, {'type': data.eventType(), 'messages': messages}] if messages else None
+
+    def correlationId(self, value):
+        """['r', request id] for a request, ['s', correlation id] for a subscription, None for a request sent before recording started"""
+        if isinstance(value, BLPRequestHandle):
+            return ['r', self.requestIds[value]] if value in self.requestIds else None
+        return ['s', value]
+
+    def write(self, records):
+        block = zlib.compress(json.dumps(records, default=_toJson).encode('utf-8'))
+        self.file.write(struct.pack('<I', len(block)))
+        self.file.write(block)
+        self.file.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+class BLPEventLog(object):
+    """A log written by BLPRecorder, memory-mapped. Iterating yields its records in the order they were received, as (time, kind, data):
+    ('request', {'id', 'key'}), ('subscribe', [[correlation id, topic]]), ('event', {'type', 'messages'}),
+    each message being [message type, correlation ids, topic, sub-elements encoded as by _encodeElement]."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size <= len(_LOG_MAGIC):
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if data[0:len(_LOG_MAGIC)] != _LOG_MAGIC:
+                    raise ValueError(self.path + ' is not a BLPRecorder log')
+                offset = len(_LOG_MAGIC)
+                while offset + 4 <= len(data):
+                    size    = struct.unpack_from('<I', data, offset)[0]
+                    records = json.loads(zlib.decompress(data[offset + 4:offset + 4 + size]).decode('utf-8'), object_hook=_fromJson)
+                    offset += 4 + size
+                    for record in records:
+                        yield tuple(record)
+            finally:
+                data.close()
+
+
+_LOG_MAGIC = b'BLPLOG1\n'
+
+
+def _encodeElement(element):
+    '''
+    [name, datatype, value, isArray]: value is the list of encoded sub-elements of a sequence or choice, the list of values of an array
+    (encoded elements for an array of sequences), None for a null, the value itself otherwise
+    '''
+    datatype = element.datatype()
+    complex  = datatype in (blpapi.DataType.SEQUENCE, blpapi.DataType.CHOICE)
+    if element.isArray():
+        if complex:
+            return [str(element.name()), datatype, [_encodeElement(element.getValueAsElement(i)) for i in range(0, element.numValues())], True]
+        return [str(element.name()), datatype, [_encodedValue(element, datatype, i) for i in range(0, element.numValues())], True]
+    if complex:
+        return [str(element.name()), datatype, [_encodeElement(e) for e in element.elements()], False]
+    return [str(element.name()), datatype, None if element.isNull() else _encodedValue(element, datatype, 0), False]
+
+
+def _encodedValue(element, datatype, index):
+    if datatype == blpapi.DataType.ENUMERATION:
+        return element.getValueAsString(index)
+    return element.getValue(index)
+
+
+def _requestKey(element):
+    '''
+    The names and values of the non-null, non-empty sub-elements of a request, whatever their datatypes, so that a replayed request finds the one recorded
+    '''
+    def canonical(encoded):
+        name, datatype, value, isArray = encoded
+        if datatype in (blpapi.DataType.SEQUENCE, blpapi.DataType.CHOICE):
+            items = [canonical(v) for v in value]
+            items = [i for i in items if i is not None]
+            value = items if isArray else sorted(items)
+        elif isArray:
+            value = [str(v) for v in value]
+        elif value is not None:
+            value = str(value)
+        return None if value is None or value == [] else [name, value]
+    return json.dumps(canonical(_encodeElement(element)))
+
+
 ################################################
 #Examples below#################################
 ################################################
@@ -0,0 +1,187 @@
+"""
+asyncio front-end to blpapiwrapper - Python 3 only, hence a separate module
+Requests go out on a pooled BLPSharedSession. blpapi's event handler thread hands every routed event to the asyncio loop with call_soon_threadsafe,
+so hundreds of requests can be awaited at the same time without a thread per request.
+Examples:
+    prices  = await abdp(['AAPL US Equity', 'MSFT US Equity'], ['PX_LAST', 'CRNCY'])
+    history = await abdh('SPX Index', 'PX_LAST', datetime.date(2020, 1, 1), datetime.date(2021, 1, 1))
+    async for security, data in BLPTSAsync(['ESA Index', 'VGA Index'], ['BID', 'ASK'], pooled=True).partials():
+        print(security, data)
+"""
+
+import asyncio
+import datetime
+import itertools
+import time
+import weakref
+import blpapi
+from blpapiwrapper import BLP, BLPTS, BLPRequestHandle, BLPRoutedEvent, BLPTimeoutError, _cancelUnfinished, _overrideKey, _sapiKey, _uniqueList
+
+
+class BLPAsyncHandle(BLPRequestHandle):
+    """BLPRequestHandle that hands its events to an asyncio loop instead of a thread-safe queue.
+    Must be created from within the loop."""
+    def __init__(self, sharedSession, loop=None, asyncEvents=None):
+        BLPRequestHandle.__init__(self, sharedSession)
+        self.loop        = loop if loop is not None else asyncio.get_event_loop()
+        self.asyncEvents = asyncEvents if asyncEvents is not None else asyncio.Queue()
+
+    def sibling(self, sharedSession):
+        return BLPAsyncHandle(sharedSession, self.loop, self.asyncEvents)
+
+    def deliver(self, event):
+        """Hands the event to the loop - dropped if the loop has been closed since, nobody is left to await it"""
+        if self.loop.is_closed():
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.asyncEvents.put_nowait, event)
+        except RuntimeError:
+            # closed between the check and the call
+            pass
+
+    async def anextEvent(self):
+        return await self.asyncEvents.get()
+
+
+async def _anextEvent(handle, deadline):
+    """The next event of handle, or a TIMEOUT event once deadline (a time.time(), None for no deadline) has passed"""
+    try:
+        return await asyncio.wait_for(handle.anextEvent(), None if deadline is None else max(deadline - time.time(), 0))
+    except asyncio.TimeoutError:
+        return BLPRoutedEvent(blpapi.event.Event.TIMEOUT, [], handle)
+
+
+async def _aresponseMessages(handle):
+    """Awaitable _responseMessages: cancels the request and raises BLPTimeoutError if its deadline passes first.
+    The request is also cancelled if the awaiting task is."""
+    messages = []
+    try:
+        while True:
+            event = await _anextEvent(handle, handle.deadline)
+            if event.eventType() == blpapi.event.Event.TIMEOUT:
+                handle.cancel()
+                raise BLPTimeoutError('no response in time')
+            if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.PARTIAL_RESPONSE]:
+                messages.extend(event)
+            if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.REQUEST_STATUS]:
+                handle.finished = True
+                return messages
+    except asyncio.CancelledError:
+        handle.cancel()
+        raise
+
+
+async def _agatherResponses(handles):
+    """The messages of every handle, cancelling those still in flight if one fails or the awaiting task is cancelled"""
+    try:
+        return await asyncio.gather(*[_aresponseMessages(h) for h in handles])
+    finally:
+        _cancelUnfinished(handles)
+
+
+class BLPAsync(BLP):
+    """Awaitable versions of BLP.bdp and BLP.bdh, on a pooled session by default.
+    abdp always returns a DataFrame, even for a single security and field. abdh returns the same output as bdh.
+    With a historyStore, abdh runs the store's lookup and the requests for the missing ranges in the loop's default executor.
+    timeout: optional seconds each call may take, after which its requests are cancelled and BLPTimeoutError raised."""
+
+    def __init__(self, sapi_dic=None, pooled=True, historyStore=None, referenceCache=None, stats=None, identity=None, timeout=None):
+        BLP.__init__(self, sapi_dic, pooled, historyStore, referenceCache, stats, timeout=timeout, identity=identity)
+
+    async def abdp(self, strSecurity='US900123AL40 Govt', strData='PX_LAST', strOverrideField='', strOverrideValue=''):
+        overrides = _overrideKey(strOverrideField, strOverrideValue)
+        decoder, missingSecurities, missingFields = self._cachedDecoder(_uniqueList(strSecurity), _uniqueList(strData), overrides)
+        handles   = self._asendAll(self._referenceRequests(missingSecurities, missingFields, strOverrideField, strOverrideValue))
+        messages  = await _agatherResponses(handles)
+        return self._decodeReference(decoder, itertools.chain.from_iterable(messages), overrides)
+
+    async def abdh(self, strSecurity='SPX Index', strData='PX_LAST', startdate=datetime.date(2014, 1, 1), enddate=datetime.date(2014, 1, 9), adjustmentSplit=False, periodicity='DAILY', strOverrideField='', strOverrideValue=''):
+        fields     = _uniqueList(strData)
+        securities = _uniqueList(strSecurity)
+        if self.historyStore is not None:
+            # the store reads and writes files, keep it off the loop
+            output = await asyncio.get_event_loop().run_in_executor(None, self.historyStore.history, self._fetchHistory, securities, fields, startdate, enddate,
+                                                                    adjustmentSplit, periodicity, strOverrideField, strOverrideValue)
+        else:
+            requests = self._historyRequests(securities, fields, startdate, enddate, adjustmentSplit, periodicity, strOverrideField, strOverrideValue)
+            handles  = self._asendAll([r for (r, fieldChunk) in requests])
+            messages = await _agatherResponses(handles)
+            output   = self._historyOutput(securities, fields, [(m, fieldChunk) for (m, (r, fieldChunk)) in zip(messages, requests)])
+        return output[strSecurity].rename_axis(None, axis=1) if type(strSecurity) == str else output
+
+    def _asendAll(self, requests):
+        """BLP._sendAll with BLPAsyncHandle handles"""
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        return [self._send(r, BLPAsyncHandle(self.session), deadline) for r in requests]
+
+
+class BLPTSAsync(BLPTS):
+    """BLPTS whose requests are awaited rather than blocking the calling thread.
+    Results still land in self.output and the observers. partials() additionally yields them as each partial response is decoded.
+    With timeout, aget and partials cancel the requests and raise BLPTimeoutError as get does.
+    Leaving partials early, or cancelling the task awaiting it, cancels the requests still in flight."""
+
+    async def anextEvent(self):
+        """Awaitable BLPTS.nextEvent"""
+        event = await _anextEvent(self.handle, self.deadline)
+        if event.eventType() == blpapi.event.Event.TIMEOUT:
+            self.cancel()
+            raise BLPTimeoutError('BLPTS responses not in after ' + str(self.kwargs.get('timeout')) + ' seconds')
+        return event
+
+    async def aget(self, newSecurities=[], newFields=[], **kwargs):
+        async for result in self.partials(newSecurities, newFields, **kwargs):
+            pass
+
+    async def partials(self, newSecurities=[], newFields=[], **kwargs):
+        """Async generator of (security, data), data being what the observers receive for field 'ALL'"""
+        if len(newSecurities) > 0 or len(newFields) > 0:
+            self.fillRequest(newSecurities, newFields, **kwargs)
+        if len(self.requests) == 0:
+            return
+
+        handle   = BLPAsyncHandle(self.session)
+        finished = False
+        try:
+            if self.kwargs.get('coalescer') is not None:
+                # getMany blocks until the coalesced values are in, keep it off the loop
+                results = await asyncio.get_event_loop().run_in_executor(None, lambda: self.sendRequest(handle, collect=True))
+            else:
+                results = self.sendRequest(handle, collect=True)
+            for result in results:
+                yield result
+            while self.handle is not None:
+                event = await self.anextEvent()
+                if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.PARTIAL_RESPONSE, blpapi.event.Event.REQUEST_STATUS]:
+                    for result in self.handleResponseEvent(event, collect=True):
+                        yield result
+                if event.eventType() in [blpapi.event.Event.RESPONSE, blpapi.event.Event.REQUEST_STATUS] and self.pendingResponses == 0:
+                    break
+            finished = True
+        finally:
+            if not finished:
+                # left early, cancelled or failed: stop the requests still in flight
+                self.cancel()
+
+
+_blpAsync      = {}
+_blpAsyncLocks = weakref.WeakKeyDictionary()  # event loop -> asyncio.Lock, as a lock belongs to one loop before Python 3.10
+
+
+async def _getBLPAsync(sapi_dic):
+    key = _sapiKey(sapi_dic)
+    if key not in _blpAsync:
+        loop = asyncio.get_event_loop()
+        async with _blpAsyncLocks.setdefault(loop, asyncio.Lock()):
+            if key not in _blpAsync:
+                # opening the service blocks, keep it off the loop
+                _blpAsync[key] = await loop.run_in_executor(None, BLPAsync, sapi_dic)
+    return _blpAsync[key]
+
+
+async def abdp(strSecurity='US900123AL40 Govt', strData='PX_LAST', strOverrideField='', strOverrideValue='', sapi_dic=None):
+    return await (await _getBLPAsync(sapi_dic)).abdp(strSecurity, strData, strOverrideField, strOverrideValue)
+
+
+async def abdh(strSecurity='SPX Index', strData='PX_LAST', startdate=datetime.date(2014, 1, 1), enddate=datetime.date(2014, 1, 9), adjustmentSplit=False, periodicity='DAILY', strOverrideField='', strOverrideValue='', sapi_dic=None):
+    return await (await _getBLPAsync(sapi_dic)).abdh(strSecurity, strData, startdate, enddate, adjustmentSplit, periodicity, strOverrideField, strOverrideValue)
@@ -0,0 +1,1013 @@
+"""
+Pure-Python stand-in for the part of the blpapi library used by blpapiwrapper, to run and profile the wrapper without a Bloomberg connection.
+Requests get synthetic, deterministic responses and subscriptions can tick on their own. Nothing here talks to Bloomberg.
+Usage - install before blpapiwrapper is first imported:
+    import fakeblpapi
+    fakeblpapi.install()
+    import blpapiwrapper
+fakeblpapi.config controls partial response sizes, latency, tick rates and field datatypes. Securities containing 'INVALID' come back with a securityError.
+"""
+
+from __future__ import print_function
+import collections
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+import types
+import zlib
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+def version():
+    return '3.19.1.fake'
+
+
+class FakeConfig(object):
+    """Knobs of the fake backend.
+    securitiesPerPartial: ReferenceDataResponse messages carry at most that many securities, one message per PARTIAL_RESPONSE event
+    messagesPerEvent: number of messages batched in each response event
+    latency: seconds before the first event of every response
+    failRequests: answer every request with a RequestFailure, as Bloomberg does e.g. when over its limits
+    tickInterval: seconds between two SUBSCRIPTION_DATA events of a subscribed session, None for no automatic ticks
+    ticksPerEvent: messages per SUBSCRIPTION_DATA event
+    bulkRows: rows of every bulk field
+    nullTickRate: probability that a field of a tick comes as a null value
+    intradayTicksPerHour: ticks per hour and event type of IntradayTickResponse
+    fieldTypes: field -> datatype, 'BULK' for bulk fields; every other field is FLOAT64
+    replay: set by replay(), to answer from a recorded log instead"""
+    def __init__(self):
+        self.securitiesPerPartial = 100
+        self.messagesPerEvent     = 1
+        self.latency              = 0.
+        self.failRequests         = False
+        self.tickInterval         = None
+        self.ticksPerEvent        = 1
+        self.bulkRows             = 10
+        self.nullTickRate         = 0.
+        self.intradayTicksPerHour = 600
+        self.replay               = None
+        self.fieldTypes           = {'CRNCY': DataType.STRING, 'NAME': DataType.STRING, 'TICKER': DataType.STRING, 'SECURITY_DES': DataType.STRING,
+                                     'COUNTRY_ISO': DataType.STRING, 'INDUSTRY_SECTOR': DataType.STRING, 'MATURITY': DataType.DATE,
+                                     'ISSUE_DT': DataType.DATE, 'NXT_CPN_DT': DataType.DATE, 'VOLUME': DataType.INT64,
+                                     'DVD_HIST_ALL': 'BULK', 'INDX_MWEIGHT': 'BULK', 'INDX_MEMBERS': 'BULK'}
+
+
+class DataType(object):
+    BOOL           = 1
+    CHAR           = 2
+    BYTE           = 3
+    INT32          = 4
+    INT64          = 5
+    FLOAT32        = 6
+    FLOAT64        = 7
+    STRING         = 8
+    BYTEARRAY      = 9
+    DATE           = 10
+    TIME           = 11
+    DECIMAL        = 12
+    DATETIME       = 13
+    ENUMERATION    = 14
+    SEQUENCE       = 15
+    CHOICE         = 16
+    CORRELATION_ID = 17
+
+
+config = FakeConfig()
+
+
+class Name(object):
+    """Interned like blpapi names: Name('x') is Name('x')"""
+    _names = {}
+    _lock  = threading.Lock()
+
+    def __new__(cls, s):
+        s = str(s)
+        name = cls._names.get(s)
+        if name is None:
+            with cls._lock:
+                name = cls._names.get(s)
+                if name is None:
+                    name = object.__new__(cls)
+                    name._s = s
+                    cls._names[s] = name
+        return name
+
+    def __str__(self):
+        return self._s
+
+    def __repr__(self):
+        return 'Name(' + repr(self._s) + ')'
+
+    def __eq__(self, other):
+        return self is other or str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._s)
+
+
+class CorrelationId(object):
+    UNSET_TYPE   = 0
+    INT_TYPE     = 1
+    POINTER_TYPE = 2
+    AUTOGEN_TYPE = 3
+    _autogen     = [0]
+
+    def __init__(self, value=None):
+        if value is None:
+            self._type, self._value = CorrelationId.UNSET_TYPE, 0
+        elif isinstance(value, int) and not isinstance(value, bool):
+            self._type, self._value = CorrelationId.INT_TYPE, value
+        else:
+            self._type, self._value = CorrelationId.POINTER_TYPE, value
+
+    def type(self):
+        return self._type
+
+    def value(self):
+        return self._value
+
+    def _autogenerate(self):
+        CorrelationId._autogen[0] += 1
+        self._type, self._value = CorrelationId.AUTOGEN_TYPE, CorrelationId._autogen[0]
+
+    def __eq__(self, other):
+        return isinstance(other, CorrelationId) and self._type == other._type and (self._value is other._value or self._value == other._value)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._type, id(self._value) if self._type == CorrelationId.POINTER_TYPE else self._value))
+
+    def __repr__(self):
+        return 'CorrelationId(' + repr(self._value) + ')'
+
+
+class Element(object):
+    """A node of a message: a scalar, a sequence of named sub-elements, or an array of either"""
+
+    def __init__(self, name, datatype, value, isArray=False):
+        self._name     = name if isinstance(name, Name) else Name(name)
+        self._datatype = datatype
+        self._value    = value
+        self._isArray  = isArray
+        if datatype in (DataType.SEQUENCE, DataType.CHOICE) and not isArray:
+            self._children = dict((str(e._name), e) for e in value)
+
+    @staticmethod
+    def sequence(name, children):
+        return Element(name, DataType.SEQUENCE, list(children))
+
+    @staticmethod
+    def array(name, datatype, values):
+        return Element(name, datatype, list(values), True)
+
+    def name(self):
+        return self._name
+
+    def datatype(self):
+        return self._datatype
+
+    def isArray(self):
+        return self._isArray
+
+    def isComplexType(self):
+        return self._datatype in (DataType.SEQUENCE, DataType.CHOICE) and not self._isArray
+
+    def isNull(self):
+        return self._value is None
+
+    def numValues(self):
+        if self._isArray:
+            return len(self._value)
+        return 0 if self._value is None else 1
+
+    def numElements(self):
+        return len(self._value) if self.isComplexType() else 0
+
+    def hasElement(self, name, excludeNullElements=False):
+        if not self.isComplexType():
+            return False
+        e = self._children.get(str(name))
+        return e is not None and not (excludeNullElements and e.isNull())
+
+    def getElement(self, nameOrIndex):
+        if not self.isComplexType():
+            raise Exception('Element ' + str(self._name) + ' has no sub-elements')
+        if isinstance(nameOrIndex, int):
+            return self._value[nameOrIndex]
+        e = self._children.get(str(nameOrIndex))
+        if e is None:
+            raise Exception('Sub-element ' + str(nameOrIndex) + ' not found in ' + str(self._name))
+        return e
+
+    def elements(self):
+        return list(self._value) if self.isComplexType() else []
+
+    def getValue(self, index=0):
+        if self._isArray:
+            return self._value[index]
+        if self.isComplexType():
+            return self
+        return self._scalar()
+
+    def getValueAsElement(self, index=0):
+        value = self._value[index] if self._isArray else self
+        if not isinstance(value, Element):
+            raise Exception('Value of ' + str(self._name) + ' is not an element')
+        return value
+
+    def values(self):
+        return list(self._value) if self._isArray else [self.getValue()]
+
+    def _scalar(self, index=0):
+        if self._isArray:
+            value = self._value[index]
+        else:
+            value = self._value
+        if value is None or isinstance(value, Element) or self.isComplexType():
+            raise Exception('Cannot convert ' + str(self._name) + ' to a scalar')
+        return value
+
+    def getValueAsFloat(self, index=0):
+        value = self._scalar(index)
+        if self._datatype not in (DataType.FLOAT32, DataType.FLOAT64, DataType.DECIMAL, DataType.INT32, DataType.INT64, DataType.BYTE, DataType.CHAR):
+            raise Exception('Cannot convert ' + str(self._name) + ' to float')
+        return float(value)
+
+    def getValueAsInteger(self, index=0):
+        value = self._scalar(index)
+        if self._datatype not in (DataType.INT32, DataType.INT64, DataType.BYTE, DataType.CHAR, DataType.BOOL):
+            raise Exception('Cannot convert ' + str(self._name) + ' to integer')
+        return int(value)
+
+    def getValueAsBool(self, index=0):
+        return bool(self._scalar(index))
+
+    def getValueAsDatetime(self, index=0):
+        value = self._scalar(index)
+        if not isinstance(value, (datetime.date, datetime.time)):
+            raise Exception('Cannot convert ' + str(self._name) + ' to datetime')
+        return value
+
+    def getValueAsString(self, index=0):
+        value = self._scalar(index)
+        if isinstance(value, float):
+            return repr(value)
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        return str(value)
+
+    def getValueAsName(self, index=0):
+        return Name(self.getValueAsString(index))
+
+    def getElementAsFloat(self, name):
+        return self.getElement(name).getValueAsFloat()
+
+    def getElementAsInteger(self, name):
+        return self.getElement(name).getValueAsInteger()
+
+    def getElementAsString(self, name):
+        return self.getElement(name).getValueAsString()
+
+    def getElementAsDatetime(self, name):
+        return self.getElement(name).getValueAsDatetime()
+
+    def getElementAsBool(self, name):
+        return self.getElement(name).getValueAsBool()
+
+    def getElementValue(self, name):
+        return self.getElement(name).getValue()
+
+    def toString(self, level=0):
+        pad = '    ' * level
+        if self._isArray:
+            inner = ''.join(v.toString(level + 1) if isinstance(v, Element) else pad + '    ' + str(v) + '\n' for v in self._value)
+            return pad + str(self._name) + '[] = {\n' + inner + pad + '}\n'
+        if self.isComplexType():
+            return pad + str(self._name) + ' = {\n' + ''.join(e.toString(level + 1) for e in self._value) + pad + '}\n'
+        return pad + str(self._name) + ' = ' + str(self._value) + '\n'
+
+    def __str__(self):
+        return self.toString()
+
+
+class Message(object):
+    def __init__(self, messageType, elements, correlationIds=(), topicName=''):
+        self._messageType   = messageType if isinstance(messageType, Name) else Name(messageType)
+        self._element       = Element.sequence(self._messageType, elements)
+        self._corrIDs       = list(correlationIds)
+        self._topicName     = topicName
+        self.timeReceivedNs = time.time()
+
+    def messageType(self):
+        return self._messageType
+
+    def correlationIds(self):
+        return self._corrIDs
+
+    def correlationId(self, index=0):
+        return self._corrIDs[index]
+
+    def numCorrelationIds(self):
+        return len(self._corrIDs)
+
+    def topicName(self):
+        return self._topicName
+
+    def asElement(self):
+        return self._element
+
+    def numElements(self):
+        return self._element.numElements()
+
+    def hasElement(self, name, excludeNullElements=False):
+        return self._element.hasElement(name, excludeNullElements)
+
+    def getElement(self, name):
+        return self._element.getElement(name)
+
+    def getElementAsString(self, name):
+        return self._element.getElementAsString(name)
+
+    def getElementAsFloat(self, name):
+        return self._element.getElementAsFloat(name)
+
+    def getElementAsDatetime(self, name):
+        return self._element.getElementAsDatetime(name)
+
+    def toString(self):
+        return self._element.toString()
+
+    def __str__(self):
+        return self.toString()
+
+
+class Event(object):
+    ADMIN                = 1
+    SESSION_STATUS       = 2
+    SUBSCRIPTION_STATUS  = 3
+    REQUEST_STATUS       = 4
+    RESPONSE             = 5
+    PARTIAL_RESPONSE     = 6
+    SUBSCRIPTION_DATA    = 8
+    SERVICE_STATUS       = 9
+    TIMEOUT              = 10
+    AUTHORIZATION_STATUS = 11
+    RESOLUTION_STATUS    = 12
+    TOPIC_STATUS         = 13
+    TOKEN_STATUS         = 14
+    REQUEST              = 15
+    UNKNOWN              = -1
+
+    def __init__(self, eventType, messages=()):
+        self._eventType = eventType
+        self._messages  = list(messages)
+
+    def eventType(self):
+        return self._eventType
+
+    def __iter__(self):
+        return MessageIterator(self)
+
+
+class MessageIterator(object):
+    def __init__(self, event):
+        self._iter = iter(event._messages)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iter)
+
+    next = __next__  # Python 2
+
+
+class SubscriptionList(object):
+    def __init__(self):
+        self._entries = []  # (topic, fields, options, correlationId)
+
+    def add(self, topic, fields=None, options=None, correlationId=None):
+        if isinstance(fields, str):
+            fields = fields.split(',')
+        if isinstance(options, str):
+            options = [options]
+        self._entries.append((topic, list(fields or []), list(options or []), correlationId if correlationId is not None else CorrelationId()))
+        return 0
+
+    def size(self):
+        return len(self._entries)
+
+    def topicStringAt(self, index):
+        return self._entries[index][0]
+
+    def correlationIdAt(self, index):
+        return self._entries[index][3]
+
+
+class SessionOptions(object):
+    def __init__(self):
+        self.settings = {}
+
+    def __getattr__(self, name):
+        if name.startswith('set'):
+            return lambda *args: self.settings.__setitem__(name[3:], args)
+        raise AttributeError(name)
+
+
+class Identity(object):
+    def __init__(self):
+        self.authorized = False
+        self.uuid       = None
+
+
+class EventQueue(object):
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def push(self, event):
+        self._queue.put(event)
+
+    def nextEvent(self, timeout=0):
+        try:
+            return self._queue.get(timeout=timeout / 1000. if timeout > 0 else None)
+        except queue.Empty:
+            return Event(Event.TIMEOUT)
+
+    def tryNextEvent(self):
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+
+class _RequestElement(object):
+    def __init__(self):
+        self.values = {}
+
+    def setElement(self, name, value):
+        self.values[str(name)] = value
+
+
+class _ArrayElement(object):
+    def __init__(self):
+        self.items = []
+
+    def appendElement(self):
+        item = _RequestElement()
+        self.items.append(item)
+        return item
+
+    def appendValue(self, value):
+        self.items.append(value)
+
+
+class Request(object):
+    def __init__(self, service, operation):
+        self.service   = service
+        self.operation = operation
+        self.values    = {}
+        self.arrays    = {}
+
+    def set(self, name, value):
+        self.values[str(name)] = value
+
+    def append(self, name, value):
+        self.getElement(name).appendValue(value)
+
+    def getElement(self, name):
+        return self.arrays.setdefault(str(name), _ArrayElement())
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def getList(self, name):
+        return list(self.arrays[name].items) if name in self.arrays else []
+
+    def asElement(self):
+        elements = [Element(name, _datatypeOf(value), value) for name, value in self.values.items()]
+        for name, array in self.arrays.items():
+            if array.items and isinstance(array.items[0], _RequestElement):
+                items = [Element.sequence(name, [Element(n, _datatypeOf(v), v) for n, v in item.values.items()]) for item in array.items]
+                elements.append(Element.array(name, DataType.SEQUENCE, items))
+            else:
+                elements.append(Element.array(name, _datatypeOf(array.items[0]) if array.items else DataType.STRING, array.items))
+        return Element.sequence(self.operation, elements)
+
+    def toString(self):
+        return self.operation + ' ' + repr(self.values) + ' ' + repr(dict((k, v.items) for k, v in self.arrays.items()))
+
+
+def _datatypeOf(value):
+    if isinstance(value, bool):
+        return DataType.BOOL
+    if isinstance(value, int):
+        return DataType.INT64
+    if isinstance(value, float):
+        return DataType.FLOAT64
+    if isinstance(value, datetime.datetime):
+        return DataType.DATETIME
+    if isinstance(value, datetime.date):
+        return DataType.DATE
+    return DataType.STRING
+
+
+class Service(object):
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def createRequest(self, operation):
+        return Request(self, operation)
+
+    def createAuthorizationRequest(self):
+        return Request(self, 'AuthorizationRequest')
+
+
+class Session(object):
+    """Answers requests with synthetic data on a background thread.
+    With an eventHandler, events are passed to eventHandler(event, session) from that thread, otherwise they wait for nextEvent."""
+
+    def __init__(self, options=None, eventHandler=None, eventDispatcher=None):
+        self.options       = options
+        self.eventHandler  = eventHandler
+        self.events        = EventQueue()
+        self.work          = queue.Queue()
+        self.subscriptions = {}  # correlation id -> (topic, fields)
+        self.subLock       = threading.Lock()
+        self.cancelled     = set()
+        self.requestCount  = 0
+        self.lastIdentity  = None  # identity of the last request sent
+        self.stopped       = False
+        self.started       = False
+
+    def start(self):
+        self.started = True
+        self.worker = threading.Thread(target=self._work, name='fakeblpapi')
+        self.worker.daemon = True
+        self.worker.start()
+        self._post(Event(Event.SESSION_STATUS, [Message('SessionStarted', [])]))
+        return True
+
+    def startAsync(self):
+        return self.start()
+
+    def stop(self):
+        self.stopped = True
+        self.work.put(None)
+        return True
+
+    def stopAsync(self):
+        return self.stop()
+
+    def openService(self, serviceName):
+        self._post(Event(Event.SERVICE_STATUS, [Message('ServiceOpened', [Element('serviceName', DataType.STRING, serviceName)])]))
+        return True
+
+    def getService(self, serviceName):
+        return Service(serviceName)
+
+    def createIdentity(self):
+        return Identity()
+
+    def nextEvent(self, timeout=0):
+        if self.eventHandler is not None:
+            raise Exception('nextEvent cannot be called on a session with an event handler')
+        return self.events.nextEvent(timeout)
+
+    def tryNextEvent(self):
+        return self.events.tryNextEvent()
+
+    def sendAuthorizationRequest(self, request, identity, correlationId=None, eventQueue=None):
+        """Users whose ipAddress contains INVALID are refused. With config.failRequests the request itself fails."""
+        correlationId = self._correlationId(correlationId)
+        identity.authorized = 'INVALID' not in str(request.get('ipAddress', '')) and not config.failRequests
+        identity.uuid = request.get('uuid')
+        if config.failRequests:
+            event = Event(Event.REQUEST_STATUS, [Message('RequestFailure', [Element('reason', DataType.STRING, 'failRequests is set')], [correlationId])])
+        else:
+            event = Event(Event.RESPONSE, [Message('AuthorizationSuccess' if identity.authorized else 'AuthorizationFailure', [], [correlationId])])
+        self.work.put((lambda: iter([event]), eventQueue))
+        return correlationId
+
+    def revoke(self, identity, correlationId):
+        """Revokes an authorized identity, as Bloomberg does when the user logs in from another machine"""
+        identity.authorized = False
+        self._post(Event(Event.AUTHORIZATION_STATUS, [Message('AuthorizationRevoked', [], [correlationId])]))
+
+    def sendRequest(self, request, identity=None, correlationId=None, eventQueue=None, requestLabel=''):
+        correlationId = self._correlationId(correlationId)
+        self.requestCount += 1
+        self.lastIdentity = identity
+        self.work.put((lambda: self._respond(request, correlationId), eventQueue))
+        return correlationId
+
+    def cancel(self, correlationId):
+        for cid in (correlationId if isinstance(correlationId, list) else [correlationId]):
+            self.cancelled.add(cid)
+            with self.subLock:
+                self.subscriptions.pop(cid, None)
+
+    def subscribe(self, subscriptionList, identity=None, requestLabel=''):
+        messages = []
+        with self.subLock:
+            for (topic, fields, options, cid) in subscriptionList._entries:
+                self.subscriptions[cid] = (topic, fields)
+                messages.append(Message('SubscriptionStarted', [], [cid], topic))
+        self._post(Event(Event.SUBSCRIPTION_STATUS, messages))
+        if config.replay is not None and not getattr(self, 'ticker', None):
+            self.ticker = threading.Thread(target=config.replay.subscriptionEvents, args=(self,), name='fakeblpapi replay')
+            self.ticker.daemon = True
+            self.ticker.start()
+        if config.tickInterval is not None and not getattr(self, 'ticker', None):
+            self.ticker = threading.Thread(target=self._tick, name='fakeblpapi ticks')
+            self.ticker.daemon = True
+            self.ticker.start()
+
+    def resubscribe(self, subscriptionList, requestLabel=''):
+        with self.subLock:
+            for (topic, fields, options, cid) in subscriptionList._entries:
+                self.subscriptions[cid] = (topic, fields)
+
+    def unsubscribe(self, subscriptionList):
+        messages = []
+        with self.subLock:
+            for (topic, fields, options, cid) in subscriptionList._entries:
+                if self.subscriptions.pop(cid, None) is not None:
+                    messages.append(Message('SubscriptionTerminated', [], [cid], topic))
+        if messages:
+            self._post(Event(Event.SUBSCRIPTION_STATUS, messages))
+
+    def _correlationId(self, correlationId):
+        if correlationId is None:
+            correlationId = CorrelationId()
+        if correlationId.type() == CorrelationId.UNSET_TYPE:
+            correlationId._autogenerate()
+        return correlationId
+
+    def _post(self, event, eventQueue=None):
+        self.work.put((lambda: iter([event]), eventQueue))
+
+    def _deliver(self, event, eventQueue):
+        if eventQueue is not None:
+            eventQueue.push(event)
+        elif self.eventHandler is not None:
+            self.eventHandler(event, self)
+        else:
+            self.events.push(event)
+
+    def _work(self):
+        while not self.stopped:
+            item = self.work.get()
+            if item is None:
+                break
+            events, eventQueue = item
+            for event in events():
+                if self.stopped:
+                    return
+                self._deliver(event, eventQueue)
+
+    def _tick(self):
+        while not self.stopped:
+            time.sleep(config.tickInterval)
+            with self.subLock:
+                subscriptions = list(self.subscriptions.items())
+            if subscriptions:
+                self._post(Event(Event.SUBSCRIPTION_DATA, [tickMessage(cid, fields) for (cid, (topic, fields)) in random.sample(subscriptions, min(config.ticksPerEvent, len(subscriptions)))]))
+
+    def _respond(self, request, correlationId):
+        if config.replay is not None:
+            for event in config.replay.respond(request, correlationId):
+                if correlationId in self.cancelled:
+                    return
+                yield event
+            return
+        if config.latency > 0:
+            time.sleep(config.latency)
+        if config.failRequests:
+            yield Event(Event.REQUEST_STATUS, [Message('RequestFailure', [Element('reason', DataType.STRING, 'failRequests is set')], [correlationId])])
+            return
+        if request.operation == 'ReferenceDataRequest':
+            messages = _referenceMessages(request, correlationId)
+        elif request.operation == 'HistoricalDataRequest':
+            messages = _historyMessages(request, correlationId)
+        elif request.operation == 'IntradayBarRequest':
+            messages = _intradayBarMessages(request, correlationId)
+        elif request.operation == 'IntradayTickRequest':
+            messages = _intradayTickMessages(request, correlationId)
+        else:
+            yield Event(Event.REQUEST_STATUS, [Message('RequestFailure', [Element('reason', DataType.STRING, 'unknown operation ' + request.operation)], [correlationId])])
+            return
+        # the last message always goes in the final RESPONSE, as with Bloomberg
+        batch, previous = [], None
+        for msg in messages:
+            if correlationId in self.cancelled:
+                return
+            if previous is not None:
+                batch.append(previous)
+                if len(batch) == config.messagesPerEvent:
+                    yield Event(Event.PARTIAL_RESPONSE, batch)
+                    batch = []
+            previous = msg
+        yield Event(Event.RESPONSE, batch + [previous])
+
+
+#Synthetic data#################################
+
+
+def _seed(*args):
+    return zlib.crc32('|'.join(str(a) for a in args).encode('utf-8'))
+
+
+def referenceValue(security, field):
+    """The value every ReferenceDataRequest returns for (security, field)"""
+    datatype = config.fieldTypes.get(field, DataType.FLOAT64)
+    rng      = random.Random(_seed(security, field))
+    if datatype == DataType.STRING:
+        return field[:3] + str(rng.randint(0, 999))
+    if datatype == DataType.DATE:
+        return datetime.date(2020, 1, 1) + datetime.timedelta(days=rng.randint(0, 7000))
+    if datatype in (DataType.INT32, DataType.INT64):
+        return rng.randint(0, 10 ** 6)
+    return round(rng.uniform(50, 150), 4)
+
+
+def historyValue(security, field, date):
+    """The value every HistoricalDataRequest returns for (security, field, date)"""
+    return 100. + (_seed(security, field) % 1000) / 10. + (date.toordinal() % 97) / 10.
+
+
+def bulkElement(security, field):
+    rows = []
+    for i in range(0, config.bulkRows):
+        rng = random.Random(_seed(security, field, i))
+        rows.append(Element.sequence(field, [Element('Declared Date', DataType.DATE, datetime.date(2010, 1, 1) + datetime.timedelta(days=90 * i)),
+                                             Element('Ex-Date', DataType.DATE, datetime.date(2010, 1, 15) + datetime.timedelta(days=90 * i)),
+                                             Element('Dividend Amount', DataType.FLOAT64, round(rng.uniform(0, 2), 4)),
+                                             Element('Dividend Frequency', DataType.STRING, 'Quarter'),
+                                             Element('Dividend Type', DataType.STRING, 'Regular Cash')]))
+    return Element.array(field, DataType.SEQUENCE, rows)
+
+
+def fieldElement(security, field):
+    datatype = config.fieldTypes.get(field, DataType.FLOAT64)
+    if datatype == 'BULK':
+        return bulkElement(security, field)
+    return Element(field, datatype, referenceValue(security, field))
+
+
+def _securityError(security):
+    return Element.sequence('securityError', [Element('source', DataType.STRING, 'fakeblpapi'), Element('category', DataType.STRING, 'BAD_SEC'),
+                                              Element('message', DataType.STRING, 'Unknown/Invalid security')])
+
+
+def _referenceMessages(request, correlationId):
+    securities = request.getList('securities')
+    fields     = request.getList('fields')
+    for start in range(0, len(securities), config.securitiesPerPartial):
+        securityData = []
+        for i, security in enumerate(securities[start:start + config.securitiesPerPartial]):
+            children = [Element('security', DataType.STRING, security), Element('sequenceNumber', DataType.INT32, start + i)]
+            if 'INVALID' in security:
+                children += [_securityError(security), Element.sequence('fieldData', [])]
+            else:
+                children += [Element.array('fieldExceptions', DataType.SEQUENCE, []), Element.sequence('fieldData', [fieldElement(security, f) for f in fields])]
+            securityData.append(Element.sequence('securityData', children))
+        yield Message('ReferenceDataResponse', [Element.array('securityData', DataType.SEQUENCE, securityData)], [correlationId])
+
+
+def _date(value):
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value[:8], '%Y%m%d').date()
+    return datetime.date(value.year, value.month, value.day)
+
+
+def _historyMessages(request, correlationId):
+    fields = request.getList('fields')
+    start  = _date(request.get('startDate'))
+    end    = _date(request.get('endDate'))
+    days   = [start + datetime.timedelta(days=i) for i in range(0, (end - start).days + 1)]
+    days   = [d for d in days if d.weekday() < 5]
+    for i, security in enumerate(request.getList('securities')):
+        children = [Element('security', DataType.STRING, security), Element('sequenceNumber', DataType.INT32, i)]
+        if 'INVALID' in security:
+            children += [_securityError(security), Element.array('fieldData', DataType.SEQUENCE, [])]
+        else:
+            rows = [Element.sequence('fieldData', [Element('date', DataType.DATE, d)] + [Element(f, DataType.FLOAT64, historyValue(security, f, d)) for f in fields]) for d in days]
+            children += [Element.array('fieldExceptions', DataType.SEQUENCE, []), Element.array('fieldData', DataType.SEQUENCE, rows)]
+        yield Message('HistoricalDataResponse', [Element.sequence('securityData', children)], [correlationId])
+
+
+def _datetime(value):
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    return value
+
+
+def _responseError(messageType, security, correlationId):
+    return Message(messageType, [Element.sequence('responseError', [Element('source', DataType.STRING, 'fakeblpapi'), Element('category', DataType.STRING, 'BAD_SEC'),
+                                                                    Element('message', DataType.STRING, 'Unknown/Invalid security ' + security)])], [correlationId])
+
+
+def _intradayBarMessages(request, correlationId):
+    security = request.get('security')
+    if 'INVALID' in security:
+        yield _responseError('IntradayBarResponse', security, correlationId)
+        return
+    start    = _datetime(request.get('startDateTime'))
+    end      = _datetime(request.get('endDateTime'))
+    step     = datetime.timedelta(minutes=int(request.get('interval', 1)))
+    bars, t  = [], start
+    while t < end:
+        rng = random.Random(_seed(security, t))
+        o   = 100. + rng.uniform(-1, 1)
+        bars.append(Element.sequence('barTickData', [Element('time', DataType.DATETIME, t), Element('open', DataType.FLOAT64, o),
+                                                     Element('high', DataType.FLOAT64, o + 0.5), Element('low', DataType.FLOAT64, o - 0.5),
+                                                     Element('close', DataType.FLOAT64, o + 0.1), Element('volume', DataType.INT64, rng.randint(0, 10000)),
+                                                     Element('numEvents', DataType.INT32, rng.randint(1, 100))]))
+        t += step
+    for i in range(0, len(bars), 1000):
+        yield Message('IntradayBarResponse', [Element.sequence('barData', [Element.array('barTickData', DataType.SEQUENCE, bars[i:i + 1000])])], [correlationId])
+    if not bars:
+        yield Message('IntradayBarResponse', [Element.sequence('barData', [Element.array('barTickData', DataType.SEQUENCE, [])])], [correlationId])
+
+
+def _intradayTickMessages(request, correlationId):
+    security   = request.get('security')
+    if 'INVALID' in security:
+        yield _responseError('IntradayTickResponse', security, correlationId)
+        return
+    start      = _datetime(request.get('startDateTime'))
+    end        = _datetime(request.get('endDateTime'))
+    eventTypes = request.getList('eventTypes') or ['TRADE']
+    step       = datetime.timedelta(seconds=3600. / config.intradayTicksPerHour)
+    ticks, t   = [], start
+    while t < end:
+        for eventType in eventTypes:
+            rng = random.Random(_seed(security, t, eventType))
+            ticks.append(Element.sequence('tickData', [Element('time', DataType.DATETIME, t), Element('type', DataType.STRING, eventType),
+                                                       Element('value', DataType.FLOAT64, 100. + rng.uniform(-1, 1)), Element('size', DataType.INT32, rng.randint(1, 1000))]))
+        t += step
+    for i in range(0, max(len(ticks), 1), 1000):
+        yield Message('IntradayTickResponse', [Element.sequence('tickData', [Element('eidData', DataType.INT32, None), Element.array('tickData', DataType.SEQUENCE, ticks[i:i + 1000])])], [correlationId])
+
+
+_lastTick = {}
+
+
+def tickMessage(correlationId, fields):
+    """A MarketDataEvents message for one subscription: float fields move by a small random step, integer fields go up, others are typed as in fieldTypes"""
+    values = []
+    for field in fields:
+        key      = (correlationId, field)
+        datatype = config.fieldTypes.get(field, DataType.FLOAT64)
+        if config.nullTickRate > 0 and random.random() < config.nullTickRate:
+            values.append(Element(field, DataType.FLOAT64 if datatype == 'BULK' else datatype, None))
+        elif datatype in (DataType.INT32, DataType.INT64):
+            _lastTick[key] = _lastTick.get(key, 0) + random.randint(1, 100)
+            values.append(Element(field, datatype, _lastTick[key]))
+        elif datatype in (DataType.FLOAT64, 'BULK'):
+            _lastTick[key] = _lastTick.get(key, 100.) + random.uniform(-0.05, 0.05)
+            values.append(Element(field, DataType.FLOAT64, _lastTick[key]))
+        elif datatype in (DataType.TIME, DataType.DATETIME):
+            values.append(Element(field, datatype, datetime.datetime.now().time() if datatype == DataType.TIME else datetime.datetime.now()))
+        else:
+            values.append(Element(field, datatype, referenceValue(str(correlationId.value()), field)))
+    values.append(Element('EVENT_TIME', DataType.TIME, datetime.datetime.now().time()))
+    return Message('MarketDataEvents', values, [correlationId])
+
+
+def tickEvent(ticks):
+    """A SUBSCRIPTION_DATA event, ticks being a list of (correlation id, fields)"""
+    return Event(Event.SUBSCRIPTION_DATA, [tickMessage(cid if isinstance(cid, CorrelationId) else CorrelationId(cid), fields) for (cid, fields) in ticks])
+#Replay#########################################
+
+
+def replay(path, speed=None):
+    """Answers requests and feeds subscriptions from a log recorded with blpapiwrapper.BLPRecorder instead of synthetic data, until replay(None).
+    A request gets the responses of the recorded request with the same contents, or else of the next recorded request of the same operation not replayed yet.
+    Subscriptions get the recorded SUBSCRIPTION_DATA of their topic, from the start of the log once the session first subscribes.
+    speed: None replays as fast as possible, 1 at the recorded pace, 2 twice as fast, etc."""
+    config.replay = _Replay(path, speed) if path is not None else None
+
+
+class _Replay(object):
+    def __init__(self, path, speed):
+        from blpapiwrapper import BLPEventLog  # imported here, as blpapiwrapper imports this module as blpapi
+        self.log         = BLPEventLog(path)
+        self.speed       = speed
+        self.lock        = threading.Lock()
+        self.byKey       = {}  # request key -> recorded ids, in order
+        self.byOperation = {}  # operation -> recorded ids not replayed yet, in order
+        self.sentTime    = {}  # recorded id -> time the request was sent
+        self.responses   = {}  # recorded id -> [(time, event type, messages)]
+        self.topics      = {}  # recorded subscription correlation id -> topic
+        for timestamp, kind, data in self.log:
+            if kind == 'request':
+                operation = json.loads(data['key'])[0]
+                self.byKey.setdefault(data['key'], collections.deque()).append(data['id'])
+                self.byOperation.setdefault(operation, []).append(data['id'])
+                self.sentTime[data['id']] = timestamp
+            elif kind == 'subscribe':
+                for correlationId, topic in data:
+                    self.topics[correlationId] = topic
+            elif data['type'] != Event.SUBSCRIPTION_DATA:
+                for msg in data['messages']:
+                    for idKind, value in msg[1]:
+                        if idKind == 'r':
+                            events = self.responses.setdefault(value, [])
+                            if not events or events[-1][0] != timestamp or events[-1][1] != data['type']:
+                                events.append((timestamp, data['type'], []))
+                            events[-1][2].append(msg)
+
+    def recordedId(self, request):
+        from blpapiwrapper import _requestKey
+        key = _requestKey(request.asElement())
+        with self.lock:
+            ids = self.byKey.get(key)
+            while ids:
+                i = ids.popleft()
+                if i in self.byOperation.get(request.operation, []):
+                    self.byOperation[request.operation].remove(i)
+                    return i
+            if self.byOperation.get(request.operation):
+                return self.byOperation[request.operation].pop(0)
+        return None
+
+    def respond(self, request, correlationId):
+        """The recorded response events of request, paced from the time it is sent"""
+        i = self.recordedId(request)
+        if i is None:
+            yield Event(Event.REQUEST_STATUS, [Message('RequestFailure', [Element('reason', DataType.STRING, 'no ' + request.operation + ' left in the replay log')], [correlationId])])
+            return
+        start = time.time()
+        for timestamp, eventType, messages in self.responses.get(i, []):
+            self.wait(start, timestamp - self.sentTime[i])
+            yield Event(eventType, [_replayMessage(m, [correlationId]) for m in messages])
+
+    def subscriptionEvents(self, session):
+        """Posts the recorded SUBSCRIPTION_DATA to the subscriptions of session with the same topics"""
+        start, first = time.time(), None
+        for timestamp, kind, data in self.log:
+            if session.stopped or config.replay is not self:
+                return
+            if kind != 'event' or data['type'] != Event.SUBSCRIPTION_DATA:
+                continue
+            first = first if first is not None else timestamp
+            self.wait(start, timestamp - first)
+            with session.subLock:
+                byTopic = {}
+                for cid, (topic, fields) in session.subscriptions.items():
+                    byTopic.setdefault(topic, []).append(cid)
+            messages = [_replayMessage(m, [cid]) for m in data['messages'] for (idKind, value) in m[1] if idKind == 's' for cid in byTopic.get(self.topics.get(value), [])]
+            if messages:
+                session._post(Event(Event.SUBSCRIPTION_DATA, messages))
+
+    def wait(self, start, elapsed):
+        if self.speed is not None:
+            delay = start + elapsed / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def _replayMessage(encoded, correlationIds):
+    messageType, ids, topic, elements = encoded
+    return Message(messageType, [_replayElement(e) for e in elements], correlationIds, topic)
+
+
+def _replayElement(encoded):
+    name, datatype, value, isArray = encoded
+    if datatype in (DataType.SEQUENCE, DataType.CHOICE):
+        value = [_replayElement(e) for e in value]
+    return Element(name, datatype, value, isArray)
+
+
+################################################
+
+
+def install():
+    """Makes 'import blpapi' return this module"""
+    module = sys.modules[__name__]
+    sys.modules['blpapi'] = module
+    sys.modules['blpapi.event'] = event
+    sys.modules['blpapi.subscriptionlist'] = subscriptionlist
+    return module
+
+
+event = types.ModuleType('blpapi.event')
+event.Event = Event
+event.MessageIterator = MessageIterator
+subscriptionlist = types.ModuleType('blpapi.subscriptionlist')
+subscriptionlist.SubscriptionList = SubscriptionList
@@ -0,0 +1,842 @@
+"""
+Tests of blpapiwrapper, run offline against fakeblpapi: python -m pytest test_blpapiwrapper.py
+"""
+
+import asyncio
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy
+import pandas
+import pytest
+
+import fakeblpapi
+fakeblpapi.install()
+import blpapiwrapper
+import blpapiwrapper_async
+
+
+SECURITIES = ['XS%010d Corp' % i for i in range(0, 5)]
+FIELDS     = ['PX_LAST', 'PX_BID', 'CRNCY']
+START      = datetime.date(2020, 1, 1)
+END        = datetime.date(2020, 3, 31)
+
+
+@pytest.fixture(autouse=True)
+def fakeConfig():
+    """Every test starts with the default fake settings and a fresh session pool"""
+    yield fakeblpapi.config
+    fakeblpapi.config.__init__()
+    blpapiwrapper.BLPSessionPool.closeAll()
+
+
+def _requestCount(blp):
+    return blp.session.session.requestCount
+
+
+def test_bdp_scalar_matches_list():
+    blp   = blpapiwrapper.BLP(pooled=True)
+    frame = blp.bdp(SECURITIES, FIELDS)
+    assert list(frame.index) == SECURITIES and list(frame.columns) == FIELDS
+    for security in SECURITIES:
+        assert float(blp.bdp(security, 'PX_LAST')) == frame.loc[security, 'PX_LAST']
+        assert blp.bdp(security, 'CRNCY') == frame.loc[security, 'CRNCY']
+
+
+def test_bdp_chunks_requests():
+    blp = blpapiwrapper.BLP(pooled=True)
+    blp.securitiesPerRequest, blp.fieldsPerRequest = 2, 2
+    frame = blp.bdp(SECURITIES, FIELDS)
+    assert _requestCount(blp) == 3 * 2
+    pandas.testing.assert_frame_equal(frame, blpapiwrapper.BLP(pooled=True).bdp(SECURITIES, FIELDS))
+
+
+def test_bds_flat_tables(fakeConfig):
+    fakeConfig.bulkRows = 4
+    blp      = blpapiwrapper.BLP(pooled=True)
+    dividend = blp.bds(SECURITIES, 'DVD_HIST_ALL')
+    assert list(dividend.columns) == ['security', 'Declared Date', 'Ex-Date', 'Dividend Amount', 'Dividend Frequency', 'Dividend Type']
+    assert len(dividend) == 4 * len(SECURITIES) and list(dividend['security'][:4]) == [SECURITIES[0]] * 4
+    assert dividend['Ex-Date'].dtype.kind == 'M' and dividend['Dividend Amount'].dtype == float
+    expected = blpapiwrapper._dict_from_element(fakeblpapi.bulkElement(SECURITIES[0], 'DVD_HIST_ALL'))
+    assert [float(row['Dividend Amount']) for row in expected] == list(dividend['Dividend Amount'][:4])
+    # several fields, scalar ones included, chunked over several requests
+    blp.securitiesPerRequest = 2
+    tables = blp.bds(SECURITIES, ['DVD_HIST_ALL', 'PX_LAST'])
+    pandas.testing.assert_frame_equal(tables['DVD_HIST_ALL'], dividend)
+    assert list(tables['PX_LAST'].columns) == ['security', 'PX_LAST'] and len(tables['PX_LAST']) == len(SECURITIES)
+
+
+def test_dict_from_element():
+    Element = fakeblpapi.Element
+    element = Element.sequence('root', [Element('name', fakeblpapi.DataType.STRING, 'x'), Element('missing', fakeblpapi.DataType.FLOAT64, None),
+                                        Element.array('rows', fakeblpapi.DataType.SEQUENCE, [Element.sequence('rows', [Element('a', fakeblpapi.DataType.FLOAT64, 1.5)])])])
+    output = blpapiwrapper._dict_from_element(element)
+    assert list(output) == ['name', 'missing', 'rows']
+    assert output['name'] == 'x' and numpy.isnan(output['missing']) and output['rows'] == [{'a': '1.5'}]
+
+
+def test_bdh_scalar_matches_list():
+    blp  = blpapiwrapper.BLP(pooled=True)
+    wide = blp.bdh(SECURITIES, ['PX_LAST', 'VOLUME'], START, END)
+    assert wide.columns.nlevels == 2
+    for security in SECURITIES:
+        single = blp.bdh(security, ['PX_LAST', 'VOLUME'], START, END)
+        pandas.testing.assert_frame_equal(single, wide[security].dropna(how='all').rename_axis(None, axis=1), check_freq=False)
+
+
+def test_bdib_splits_ranges():
+    start, end = datetime.datetime(2020, 1, 2, 14, 30), datetime.datetime(2020, 1, 2, 16, 30)
+    blp   = blpapiwrapper.BLP(pooled=True)
+    whole = blp.bdib('A Index', start, end, 5)
+    assert list(whole.columns) == ['open', 'high', 'low', 'close', 'volume', 'numEvents'] and len(whole) == 24
+    assert whole.index[0] == pandas.Timestamp(start) and whole.index.is_monotonic_increasing
+    blp.intradayBarSpan = datetime.timedelta(minutes=45)
+    bars = blp.bdib(['A Index', 'B Index'], start, end, 5)
+    assert _requestCount(blp) == 1 + 2 * 3
+    pandas.testing.assert_frame_equal(bars['A Index'], whole)
+
+
+def test_bdit_and_chunks(fakeConfig):
+    fakeConfig.intradayTicksPerHour = 3600
+    start, end = datetime.datetime(2020, 1, 2, 14, 30), datetime.datetime(2020, 1, 2, 15, 30)
+    blp = blpapiwrapper.BLP(pooled=True)
+    blp.intradayTickSpan = datetime.timedelta(minutes=20)
+    ticks = blp.bdit('A Index', start, end, ['TRADE', 'BID'])
+    assert list(ticks.columns) == ['type', 'value', 'size'] and len(ticks) == 2 * 3600
+    assert set(ticks['type']) == {'TRADE', 'BID'} and ticks.index.is_monotonic_increasing
+    # 3 sub-ranges of 2400 ticks, answered in messages of at most 1000
+    chunks = list(blp.bditChunks('A Index', start, end, ['TRADE', 'BID'], requestsInFlight=1))
+    assert [len(c) for c in chunks] == [1000, 1000, 400] * 3
+    pandas.testing.assert_frame_equal(pandas.concat(chunks), ticks)
+
+
+def test_bdit_chunks_closed_early_cancels(fakeConfig):
+    fakeConfig.intradayTicksPerHour = 3600
+    blp = blpapiwrapper.BLP(pooled=True)
+    blp.intradayTickSpan = datetime.timedelta(minutes=10)
+    chunks = blp.bditChunks('A Index', datetime.datetime(2020, 1, 2, 14), datetime.datetime(2020, 1, 2, 15), requestsInFlight=2)
+    next(chunks)
+    chunks.close()
+    # only the requests in flight went out, the one still being read is cancelled
+    assert _requestCount(blp) == 2 and len(blp.session.session.cancelled) >= 1
+
+
+def test_blpts_reference_matches_bdp():
+    blpts = blpapiwrapper.BLPTS(SECURITIES, FIELDS, pooled=True, securitiesPerRequest=2)
+    blpts.get()
+    pandas.testing.assert_frame_equal(blpts.output, blpapiwrapper.BLP(pooled=True).bdp(SECURITIES, FIELDS))
+
+
+def test_blpts_historical_matches_bdh():
+    blpts = blpapiwrapper.BLPTS(SECURITIES, ['PX_LAST'], startDate=START, endDate=END, pooled=True)
+    blpts.get()
+    expected = blpapiwrapper.BLP(pooled=True).bdh(SECURITIES, ['PX_LAST'], START, END)
+    pandas.testing.assert_frame_equal(blpts.historyFrame(), expected, check_names=False, check_freq=False)
+
+
+def test_blpts_iterate_yields_every_security():
+    blpts   = blpapiwrapper.BLPTS(SECURITIES, FIELDS, pooled=True, securitiesPerRequest=2)
+    results = dict(blpts.iterate())
+    assert sorted(results) == sorted(SECURITIES)
+    assert results[SECURITIES[0]]['PX_LAST'] == blpapiwrapper.BLP(pooled=True).bdp(SECURITIES, 'PX_LAST').loc[SECURITIES[0], 'PX_LAST']
+
+
+def test_blpts_duplicated_security_fills_every_row():
+    blpts = blpapiwrapper.BLPTS(['A Equity', 'B Equity', 'A Equity'], ['PX_LAST'], pooled=True)
+    blpts.get()
+    assert blpts.output['PX_LAST'].iloc[0] == blpts.output['PX_LAST'].iloc[2]
+
+
+def test_blpts_without_fields_returns():
+    blpts = blpapiwrapper.BLPTS(pooled=True)
+    blpts.get(['A Equity'], [])
+    assert list(blpts.iterate()) == []
+
+
+def test_blpts_iterate_closed_early_cancels():
+    blpts     = blpapiwrapper.BLPTS(['S%d Equity' % i for i in range(0, 1000)], ['PX_LAST'], pooled=True, securitiesPerRequest=100)
+    generator = blpts.iterate()
+    next(generator)
+    generator.close()
+    assert len(blpts.session.session.cancelled) > 0
+
+
+def test_histogram_percentiles():
+    histogram = blpapiwrapper._Histogram()
+    values    = [i / 1000. for i in range(1, 1001)]  # 1ms to 1s
+    for value in values:
+        histogram.add(value)
+    summary = histogram.summary()
+    assert summary['count'] == 1000 and summary['min'] == 0.001 and summary['max'] == 1.
+    assert abs(summary['mean'] - numpy.mean(values)) < 1e-9
+    for p in [50, 90, 99]:
+        exact = numpy.percentile(values, p)
+        assert exact <= summary['p' + str(p)] <= exact * 1.19 + 1e-9
+
+
+def test_stats_counts_requests_and_calls_hook():
+    seen  = []
+
+    def hook(name, value):
+        seen.append(name)
+        raise RuntimeError('broken exporter')  # reported, not raised
+    stats = blpapiwrapper.BLPStats(hook)
+    blp   = blpapiwrapper.BLP(pooled=True, stats=stats)
+    blp.securitiesPerRequest = 2
+    blp.bdp(SECURITIES, ['PX_LAST'])
+    summary = stats.summary()
+    assert summary['requests'] == 3 and summary['responses'] == 3
+    assert summary['responseLatency']['count'] == 3 and summary['decode']['count'] >= 1
+    assert 'requests' in seen and 'responseLatency' in seen
+    stats.reset()
+    assert 'requests' not in stats.summary()
+
+
+def test_reference_cache_requests_missing_rectangle():
+    cache = blpapiwrapper.BLPReferenceCache()
+    blp   = blpapiwrapper.BLP(pooled=True, referenceCache=cache)
+    first = blp.bdp(SECURITIES[:3], ['PX_LAST', 'PX_BID'])
+    assert _requestCount(blp) == 1
+    assert blpapiwrapper._missingRectangle(SECURITIES, ['PX_LAST', 'CRNCY'], cache.getMany(SECURITIES, ['PX_LAST', 'CRNCY'])) == (SECURITIES, ['PX_LAST', 'CRNCY'])
+    assert blpapiwrapper._missingRectangle(SECURITIES[:3], ['PX_LAST'], cache.getMany(SECURITIES[:3], ['PX_LAST'])) == ([], [])
+
+    pandas.testing.assert_frame_equal(blp.bdp(SECURITIES[:3], ['PX_LAST', 'PX_BID']), first)
+    assert _requestCount(blp) == 1
+    blp.bdp(SECURITIES, ['PX_LAST'])
+    assert _requestCount(blp) == 2
+    assert cache.hits > 0 and cache.misses > 0
+
+
+def test_blpts_keeps_reference_cache_across_get():
+    cache = blpapiwrapper.BLPReferenceCache()
+    blpts = blpapiwrapper.BLPTS(pooled=True, referenceCache=cache)
+    blpts.get(SECURITIES[:2], ['PX_LAST'])
+    assert len(cache.entries) == 2
+    count = blpts.session.session.requestCount
+    blpts.get(SECURITIES[:2], ['PX_LAST'])
+    assert blpts.session.session.requestCount == count
+    assert list(blpts.output['PX_LAST']) == [cache.getMany([s], ['PX_LAST'])[s]['PX_LAST'] for s in SECURITIES[:2]]
+
+
+def test_coalescer_shares_concurrent_requests(fakeConfig):
+    fakeConfig.latency = 0.2
+    coalescer = blpapiwrapper.BLPRequestCoalescer()
+    results   = []
+
+    def fetch():
+        results.append(blpapiwrapper.BLP(pooled=True, coalescer=coalescer).bdp(SECURITIES, ['PX_LAST']))
+    threads = [threading.Thread(target=fetch) for i in range(0, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = coalescer.summary()
+    assert summary['requests'] == 1 and summary['requested'] == len(SECURITIES) and summary['inflight'] == 0
+    for result in results:
+        pandas.testing.assert_frame_equal(result, results[0])
+
+
+def test_coalescer_request_failure_gives_nan(fakeConfig):
+    fakeConfig.failRequests = True
+    coalescer = blpapiwrapper.BLPRequestCoalescer()
+    frame     = blpapiwrapper.BLP(pooled=True, coalescer=coalescer).bdp(SECURITIES, ['PX_LAST'])
+    assert frame['PX_LAST'].isnull().all()
+    assert coalescer.summary()['inflight'] == 0
+
+
+def test_coalescer_close(fakeConfig):
+    fakeConfig.latency = 1.
+    results = []
+    with blpapiwrapper.BLPRequestCoalescer(pooled=False) as coalescer:
+        thread = threading.Thread(target=lambda: results.append(coalescer.getMany(SECURITIES[:2], ['PX_LAST'])))
+        thread.start()
+        _waitFor(lambda: coalescer.summary()['requests'] == 1)
+    thread.join(5)
+    assert results == [dict((s, {'PX_LAST': blpapiwrapper.nan}) for s in SECURITIES[:2])]
+    assert not coalescer.thread.is_alive() and coalescer.session.stopped
+    assert coalescer.summary()['inflight'] == 0
+    with pytest.raises(ValueError):
+        coalescer.getMany(SECURITIES, ['PX_LAST'])
+
+
+def test_coalescer_rejects_scheduler():
+    with pytest.raises(ValueError):
+        blpapiwrapper.BLP(pooled=True, coalescer=blpapiwrapper.BLPRequestCoalescer(), scheduler=blpapiwrapper.BLPScheduler())
+
+
+def test_history_store_fetches_missing_ranges_only(tmpdir):
+    fetched = []
+    blp     = blpapiwrapper.BLP(pooled=True)
+
+    def fetch(securities, fields, startdate, enddate, *args):
+        fetched.append((startdate, enddate))
+        return blp._fetchHistory(securities, fields, startdate, enddate, *args)
+    store = blpapiwrapper.BLPHistoryStore(str(tmpdir))
+    store.history(fetch, SECURITIES, ['PX_LAST'], datetime.date(2020, 2, 1), datetime.date(2020, 2, 29))
+    assert fetched == [(datetime.date(2020, 2, 1), datetime.date(2020, 2, 29))]
+    output = store.history(fetch, SECURITIES, ['PX_LAST'], START, END)
+    assert sorted(fetched[1:]) == [(datetime.date(2020, 1, 1), datetime.date(2020, 1, 31)), (datetime.date(2020, 3, 1), datetime.date(2020, 3, 31))]
+    store.history(fetch, SECURITIES, ['PX_LAST'], START, END)
+    assert len(fetched) == 3
+    pandas.testing.assert_frame_equal(output, blp.bdh(SECURITIES, ['PX_LAST'], START, END), check_freq=False)
+
+
+def test_history_store_locks_per_security(tmpdir):
+    blp     = blpapiwrapper.BLP(pooled=True)
+    release = threading.Event()
+
+    def slowFetch(*args):
+        release.wait(5)
+        return blp._fetchHistory(*args)
+    store  = blpapiwrapper.BLPHistoryStore(str(tmpdir))
+    thread = threading.Thread(target=store.history, args=(slowFetch, SECURITIES[:1], ['PX_LAST'], START, END))
+    thread.start()
+    try:
+        _waitFor(lambda: store.securityLock(SECURITIES[0]).locked())
+        # another security is fetched while the first one is still waiting for its response
+        output = store.history(blp._fetchHistory, SECURITIES[1:], ['PX_LAST'], START, END)
+        assert thread.is_alive() and list(output.columns.levels[0]) == SECURITIES[1:]
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_replace_overwrites(tmpdir):
+    src, dst = str(tmpdir.join('src')), str(tmpdir.join('dst'))
+    for path, text in ((src, 'new'), (dst, 'old')):
+        with open(path, 'w') as f:
+            f.write(text)
+    blpapiwrapper._replace(src, dst)
+    assert open(dst).read() == 'new' and not tmpdir.join('src').exists()
+
+
+def test_tick_store_ring_history():
+    store = blpapiwrapper.BLPTickStore(['A Index'], ['BID', 'ASK'], historySize=3)
+    assert len(store.history('A Index')) == 0
+    for i in range(0, 5):
+        store.write(0, [0, 1], [i, i + 0.5], 1000. + i)
+    history = store.history('A Index')
+    assert list(history['BID']) == [2., 3., 4.] and list(history['ASK']) == [2.5, 3.5, 4.5]
+    assert list(history.index) == list(pandas.to_datetime([1002., 1003., 1004.], unit='s'))
+    # growing keeps what was written
+    store.addSecurities(['B Index'])
+    store.addFields(['LAST_PRICE'])
+    store.write(1, [2], [7.], 1005.)
+    snapshot = store.snapshot()
+    assert snapshot.loc['A Index', 'BID'] == 4. and snapshot.loc['B Index', 'LAST_PRICE'] == 7.
+    assert numpy.isnan(snapshot.loc['A Index', 'LAST_PRICE']) and store.latest('A Index', 'ASK') == 4.5
+    assert store.lastUpdates()['B Index'] == pandas.Timestamp(1005., unit='s')
+
+
+def test_tick_store_snapshots_are_consistent():
+    fields = ['F' + str(i) for i in range(0, 50)]
+    store  = blpapiwrapper.BLPTickStore(['A Index'], fields, historySize=2)
+    done   = threading.Event()
+
+    def writer():
+        i = 0
+        while not done.is_set():
+            i += 1
+            store.write(0, list(range(0, len(fields))), [float(i)] * len(fields), float(i))
+            time.sleep(0)  # as a stream waits for its next event, otherwise readers retry for ever
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for i in range(0, 200):
+            # every write sets the whole row to one value, a torn copy would mix two
+            row = store.snapshot().loc['A Index']
+            assert row.nunique() <= 1
+            assert store.history('A Index').nunique(axis=1).max() <= 1
+    finally:
+        done.set()
+        thread.join()
+
+
+def test_shared_tick_store(tmpdir):
+    path      = str(tmpdir.join('prices'))
+    publisher = blpapiwrapper.BLPSharedTickStore(path, 4, 2, historySize=3, securities=SECURITIES[:2], fields=['BID'])
+    reader    = blpapiwrapper.BLPSharedTickStore.attach(path)
+    publisher.write(0, [0], [1.5], 1000.)
+    assert reader.snapshot().loc[SECURITIES[0], 'BID'] == 1.5
+    publisher.addSecurities(SECURITIES[2:3])
+    publisher.addFields(['ASK'])
+    publisher.write(2, [0, 1], [2., 3.], 1001.)
+    snapshot = reader.snapshot()
+    assert list(snapshot.index) == SECURITIES[:3] and list(snapshot.columns) == ['BID', 'ASK']
+    assert snapshot.loc[SECURITIES[2], 'ASK'] == 3.
+    assert list(reader.history(SECURITIES[2])['ASK']) == [3.]
+    with pytest.raises(ValueError):
+        publisher.addSecurities(SECURITIES)
+
+
+def test_shared_tick_store_restart_and_close(tmpdir):
+    path   = str(tmpdir.join('prices'))
+    first  = blpapiwrapper.BLPSharedTickStore(path, 2, 1, securities=['A Index'], fields=['BID'])
+    reader = blpapiwrapper.BLPSharedTickStore.attach(path)
+    first.write(0, [0], [1.], 1000.)
+    assert reader.latest('A Index', 'BID') == 1.
+    # a new publisher under the same name: the reader moves to its file
+    second = blpapiwrapper.BLPSharedTickStore(path, 2, 1, securities=['B Index'], fields=['BID'])
+    assert first.header[6] == 1
+    second.write(0, [0], [2.], 1001.)
+    assert list(reader.snapshot().index) == ['B Index'] and reader.latest('B Index', 'BID') == 2.
+    second.close()
+    with pytest.raises(IOError):
+        reader.snapshot()
+    with pytest.raises(IOError):
+        blpapiwrapper.BLPSharedTickStore.attach(path)
+
+
+def test_bdh_with_history_store(tmpdir):
+    store = blpapiwrapper.BLPHistoryStore(str(tmpdir))
+    blp   = blpapiwrapper.BLP(pooled=True, historyStore=store)
+    first = blp.bdh(SECURITIES, ['PX_LAST'], START, END)
+    count = _requestCount(blp)
+    pandas.testing.assert_frame_equal(blp.bdh(SECURITIES, ['PX_LAST'], START, END), first)
+    assert _requestCount(blp) == count
+
+
+def test_bdp_timeout(fakeConfig):
+    fakeConfig.latency = 1.
+    started = time.time()
+    with pytest.raises(blpapiwrapper.BLPTimeoutError):
+        blpapiwrapper.BLP(pooled=True, timeout=0.1).bdp(SECURITIES, ['PX_LAST'])
+    assert time.time() - started < 0.9
+
+
+def test_blpts_timeout(fakeConfig):
+    fakeConfig.latency = 1.
+    with pytest.raises(blpapiwrapper.BLPTimeoutError):
+        blpapiwrapper.BLPTS(SECURITIES, ['PX_LAST'], pooled=True, timeout=0.1).get()
+
+
+def test_timeout_cancels_every_chunk(fakeConfig):
+    fakeConfig.latency = 1.
+    blp = blpapiwrapper.BLP(pooled=True, timeout=0.1)
+    blp.securitiesPerRequest = 2
+    with pytest.raises(blpapiwrapper.BLPTimeoutError):
+        blp.bdp(SECURITIES[:4] + ['A Equity', 'B Equity', 'C Equity', 'D Equity'], ['PX_LAST'])
+    assert len(blp.session.session.cancelled) == 4
+    with pytest.raises(blpapiwrapper.BLPTimeoutError):
+        blp.bdh(SECURITIES[:4], ['PX_LAST'], START, END)
+    assert len(blp.session.session.cancelled) == 6
+
+
+def test_blpts_keeps_timeout_across_get(fakeConfig):
+    fakeConfig.latency = 1.
+    started = time.time()
+    with pytest.raises(blpapiwrapper.BLPTimeoutError):
+        blpapiwrapper.BLPTS(pooled=True, timeout=0.1).get(SECURITIES, ['PX_LAST'])
+    assert time.time() - started < 0.9
+
+
+class _SentRequests(object):
+    """Stands in for a BLPSharedSession, recording what a BLPScheduler sends"""
+    def __init__(self):
+        self.sent = []
+
+    def sendRequest(self, request, handle, stats=None, identity=None):
+        self.sent.append((request, time.time()))
+        handle.deliver(blpapiwrapper.BLPRoutedEvent(fakeblpapi.Event.RESPONSE, [], handle))
+        return handle
+
+
+def test_scheduler_sends_interactive_first():
+    session = _SentRequests()
+    with blpapiwrapper.BLPScheduler() as scheduler:
+        with scheduler.condition:  # queue everything before the thread picks anything
+            handles = [scheduler.sendRequest(session, name, blpapiwrapper.BLPRequestHandle(session), priority=priority)
+                       for (name, priority) in [('batch1', scheduler.BATCH), ('batch2', scheduler.BATCH), ('lookup', scheduler.INTERACTIVE)]]
+        for handle in handles:
+            assert handle.nextEvent(5000).eventType() == fakeblpapi.Event.RESPONSE
+    assert [request for (request, sent) in session.sent] == ['lookup', 'batch1', 'batch2']
+
+
+def test_scheduler_rate_limits():
+    session = _SentRequests()
+    started = time.time()
+    with blpapiwrapper.BLPScheduler(requestsPerSecond=20) as scheduler:
+        handles = [scheduler.sendRequest(session, i) for i in range(0, 30)]
+        for handle in handles:
+            handle.nextEvent(5000)
+        assert scheduler.summary()['sent'] == 30
+    # a burst of 20, then 10 more at 20 per second
+    assert 0.4 < session.sent[-1][1] - started < 2.
+    assert session.sent[19][1] - started < 0.2
+
+
+def test_token_bucket_allows_debt():
+    bucket = blpapiwrapper._TokenBucket(10)
+    now    = bucket.time
+    assert bucket.wait(500, now) == 0  # a request larger than the rate only waits for a full bucket
+    bucket.take(500)
+    assert bucket.wait(1, now) == pytest.approx(49.1)
+    assert blpapiwrapper._TokenBucket(None).wait(10 ** 6, now) == 0
+
+
+def test_scheduler_drops_expired_and_fails_waiting_on_close():
+    session   = _SentRequests()
+    scheduler = blpapiwrapper.BLPScheduler(requestsPerSecond=1)
+    expired   = blpapiwrapper.BLPRequestHandle(session)
+    expired.deadline = time.time() - 1
+    scheduler.sendRequest(session, 'first')
+    scheduler.sendRequest(session, 'expired', expired)
+    waiting   = scheduler.sendRequest(session, 'waiting')
+    _waitFor(lambda: scheduler.summary()['dropped'] == 1)
+    scheduler.close()
+    assert waiting.nextEvent(5000).eventType() == fakeblpapi.Event.REQUEST_STATUS
+    assert [request for (request, sent) in session.sent] == ['first']
+    with pytest.raises(ValueError):
+        scheduler.sendRequest(session, 'late')
+
+
+def test_coalesced_timeout(fakeConfig):
+    fakeConfig.latency = 1.
+    with pytest.raises(blpapiwrapper.BLPTimeoutError):
+        blpapiwrapper.BLP(pooled=True, coalescer=blpapiwrapper.BLPRequestCoalescer(), timeout=0.1).bdp(SECURITIES, ['PX_LAST'])
+
+
+def test_async_timeout(fakeConfig):
+    fakeConfig.latency = 1.
+    with pytest.raises(blpapiwrapper.BLPTimeoutError):
+        asyncio.run(blpapiwrapper_async.BLPTSAsync(SECURITIES, ['PX_LAST'], pooled=True, timeout=0.1).aget())
+    with pytest.raises(blpapiwrapper.BLPTimeoutError):
+        asyncio.run(blpapiwrapper_async.BLPAsync(timeout=0.1).abdp(SECURITIES, ['PX_LAST']))
+
+
+def test_async_leaving_partials_cancels_requests(fakeConfig):
+    fakeConfig.latency = 0.1
+    blpts = blpapiwrapper_async.BLPTSAsync(SECURITIES, ['PX_LAST'], pooled=True, securitiesPerRequest=1)
+
+    async def first():
+        async for result in blpts.partials():
+            return result
+
+    assert asyncio.run(first())[0] in SECURITIES
+    assert len(blpts.session.session.cancelled) == len(SECURITIES) - 1
+
+
+def test_async_cancelled_task_cancels_requests(fakeConfig):
+    fakeConfig.latency = 0.2
+    blp = blpapiwrapper_async.BLPAsync(pooled=True)
+    blp.securitiesPerRequest = 1
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(blp.abdp(SECURITIES, ['PX_LAST']), 0.05))
+    assert len(blp.session.session.cancelled) == len(SECURITIES)
+
+
+def test_dispatch_isolates_handles():
+    session = blpapiwrapper.BLPSessionPool.getSession()
+    broken, healthy = blpapiwrapper.BLPRequestHandle(session), blpapiwrapper.BLPRequestHandle(session)
+
+    def fail(event):
+        raise RuntimeError('broken handle')
+    broken.deliver = fail
+    loop = asyncio.new_event_loop()
+    closed = blpapiwrapper_async.BLPAsyncHandle(session, loop)
+    loop.close()
+    event = fakeblpapi.Event(fakeblpapi.Event.RESPONSE, [fakeblpapi.Message('ReferenceDataResponse', [], [fakeblpapi.CorrelationId(h)]) for h in [broken, closed, healthy]])
+    session.dispatch(event)
+    assert len(list(healthy.nextEvent(1000))) == 1
+
+
+@pytest.fixture
+def gateway():
+    """A BLPGateway serving a BLP with a referenceCache, on a short socket path as AF_UNIX paths are limited in length"""
+    directory = tempfile.mkdtemp()
+    server    = blpapiwrapper.BLPGateway(os.path.join(directory, 'gw.sock'), blp=blpapiwrapper.BLP(pooled=True, referenceCache=blpapiwrapper.BLPReferenceCache()))
+    server.start()
+    yield server
+    server.stop()
+    shutil.rmtree(directory)
+
+
+def test_gateway_round_trip(gateway):
+    client = blpapiwrapper.BLPGatewayClient(gateway.path)
+    try:
+        blp = blpapiwrapper.BLP(pooled=True)
+        pandas.testing.assert_frame_equal(client.bdp(SECURITIES, FIELDS), blp.bdp(SECURITIES, FIELDS))
+        pandas.testing.assert_frame_equal(client.bdh(SECURITIES, ['PX_LAST'], START, END), blp.bdh(SECURITIES, ['PX_LAST'], START, END), check_freq=False)
+        pandas.testing.assert_frame_equal(client.blpts(SECURITIES, ['PX_ASK']), blp.bdp(SECURITIES, ['PX_ASK']), check_names=False)
+        # the blpts request went through the gateway's referenceCache
+        assert sorted(gateway.blp.referenceCache.getMany(SECURITIES, ['PX_ASK'])) == sorted(SECURITIES)
+    finally:
+        client.close()
+
+
+def test_gateway_reports_errors(gateway):
+    client = blpapiwrapper.BLPGatewayClient(gateway.path)
+    try:
+        with pytest.raises(blpapiwrapper.BLPGatewayError):
+            client.call('shutdown', [], {})
+        with pytest.raises(blpapiwrapper.BLPGatewayError):
+            client.bdh(SECURITIES, ['PX_LAST'], 'not a date', END)
+        # the connection is still usable after an error
+        assert list(client.bdp(SECURITIES, ['PX_LAST']).index) == SECURITIES
+    finally:
+        client.close()
+
+
+def test_gateway_path_is_private(monkeypatch):
+    directory = tempfile.mkdtemp()
+    try:
+        monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+        monkeypatch.setattr(tempfile, 'tempdir', directory)
+        path = blpapiwrapper._gatewayPath(None)
+        assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+        os.chmod(os.path.dirname(path), 0o777)
+        with pytest.raises(OSError):
+            blpapiwrapper._gatewayPath(None)
+        monkeypatch.setenv('XDG_RUNTIME_DIR', directory)
+        assert blpapiwrapper._gatewayPath(None) == os.path.join(directory, 'blpapiwrapper.sock')
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_async_matches_sync():
+    frame = asyncio.run(blpapiwrapper_async.abdp(SECURITIES, FIELDS))
+    pandas.testing.assert_frame_equal(frame, blpapiwrapper.BLP(pooled=True).bdp(SECURITIES, FIELDS))
+
+
+def _waitFor(condition, timeout=5.):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_stream_add_remove_securities(fakeConfig):
+    fakeConfig.tickInterval = 0.005
+    stream = blpapiwrapper.BLPStream(['A Index', 'B Index'], ['BID', 'ASK'], 0, [0, 1])
+    stream.daemon = True
+    stream.start()
+    subscriptions = stream.session.session.subscriptions
+    try:
+        _waitFor(lambda: len(subscriptions) == 2)
+
+        stream.addSecurities(['C Index'])
+        _waitFor(lambda: len(subscriptions) == 3)
+        _waitFor(lambda: not numpy.isnan(stream.output.loc['C Index', 'BID']))
+        assert stream.intCorrIDList == [0, 1, 2]
+
+        stream.removeSecurities('A Index')
+        _waitFor(lambda: len(subscriptions) == 2)
+        assert list(stream.output.index) == ['B Index', 'C Index']
+
+        stream.addFields('LAST_PRICE')
+        _waitFor(lambda: not numpy.isnan(stream.output.loc['B Index', 'LAST_PRICE']))
+        stream.removeFields(['ASK'])
+        assert list(stream.output.columns) == ['BID', 'LAST_PRICE']
+        subscriptionList = stream.subscriptionList
+        assert [subscriptionList.topicStringAt(i) for i in range(0, subscriptionList.size())] == ['B Index', 'C Index']
+        stream.closeSubscription()
+        assert len(subscriptions) == 0
+    finally:
+        stream.session.stop()  # stops the fake's tick thread before the config is reset
+
+
+def test_stream_decodes_bursts_and_counts_problems():
+    stats    = blpapiwrapper.BLPStats()
+    stream   = blpapiwrapper.BLPStream(['A Index', 'B Index'], ['BID', 'CRNCY'], 0, [0, 1], pooled=True, stats=stats)
+    observer = _GatedObserver()
+    observer.gate.set()
+    stream.register(observer)
+    Element  = fakeblpapi.Element
+    messages = [fakeblpapi.tickMessage(fakeblpapi.CorrelationId(0), ['BID', 'CRNCY']),
+                fakeblpapi.tickMessage(fakeblpapi.CorrelationId(1), ['BID']),
+                fakeblpapi.Message('MarketDataEvents', [Element('BID', fakeblpapi.DataType.FLOAT64, None)], [fakeblpapi.CorrelationId(1)]),
+                fakeblpapi.Message('MarketDataEvents', [], [fakeblpapi.CorrelationId(0)]),
+                fakeblpapi.tickMessage(fakeblpapi.CorrelationId(7), ['BID'])]
+    # one event carrying several messages, as Bloomberg sends bursts
+    stream.handleDataEvent(fakeblpapi.Event(fakeblpapi.Event.SUBSCRIPTION_DATA, messages))
+    assert stream.counters['messages'] == 5 and stream.counters['ticks'] == 3
+    assert stream.counters['unparseableFields'] == 1 and stream.counters['unknownCorrelationIds'] == 1
+    assert stream.counters['emptyMessages'] == 2  # the null only message and the empty one
+    output = stream.output
+    assert not numpy.isnan(output.loc['A Index', 'BID']) and not numpy.isnan(output.loc['B Index', 'BID'])
+    assert numpy.isnan(output.loc['A Index', 'CRNCY'])  # strings reach the observers, not the store
+    assert isinstance(observer.data[1], str)
+    summary = stats.summary()
+    assert summary['ticks'] == 3 and summary['decode']['count'] == 1 and summary['observers']['count'] > 0
+
+
+class _CountingObserver(object):
+    def __init__(self):
+        self.securities = set()
+        self.concurrent = 0
+        self.overlaps   = 0
+
+    def update(self, *args, **kwargs):
+        self.concurrent += 1
+        if self.concurrent > 1:
+            self.overlaps += 1
+        self.securities.add(kwargs['security'])
+        time.sleep(0.001)
+        self.concurrent -= 1
+
+
+def test_sharded_stream(fakeConfig):
+    fakeConfig.tickInterval = 0.005
+    securities = ['A Index', 'B Index', 'C Index', 'D Index']
+    stream     = blpapiwrapper.BLPStream(securities, ['BID'], 0, [0, 1, 2, 3], sessionCount=2)
+    observer   = _CountingObserver()
+    stream.register(observer)
+    stream.daemon = True
+    stream.start()
+    shards = [session.session.subscriptions for session in stream.sessions]
+    try:
+        _waitFor(lambda: [len(s) for s in shards] == [2, 2])
+        _waitFor(lambda: not stream.output['BID'].isnull().any() and observer.securities == set(securities))
+        assert observer.overlaps == 0
+
+        stream.removeSecurities(['A Index', 'C Index'])
+        _waitFor(lambda: sum(len(s) for s in shards) == 2)
+        # the new securities go to the shards with the fewest
+        stream.addSecurities(['E Index', 'F Index'])
+        _waitFor(lambda: [len(s) for s in shards] == [2, 2])
+        _waitFor(lambda: not stream.output['BID'].isnull().any())
+        assert list(stream.output.index) == ['B Index', 'D Index', 'E Index', 'F Index']
+        stream.closeSubscription()
+        assert [len(s) for s in shards] == [0, 0]
+    finally:
+        for session in stream.sessions:
+            session.stop()
+
+
+class _GatedObserver(blpapiwrapper.Observer):
+    """Records the data it receives, once gate is set"""
+    def __init__(self):
+        self.gate = threading.Event()
+        self.data = []
+
+    def update(self, *args, **kwargs):
+        self.gate.wait(5)
+        self.data.append(kwargs['data'])
+
+
+def _queuedObserver(policy, maxSize):
+    """A BLPQueuedObserver whose thread has taken a first update and waits for the gate, so the next ones queue up"""
+    observer = _GatedObserver()
+    queued   = blpapiwrapper.BLPQueuedObserver(observer, maxSize=maxSize, policy=policy, batchSize=1)
+    queued.update(security='A Index', field='BID', data=0)
+    _waitFor(lambda: queued.depth() == 0)
+    return observer, queued
+
+
+def test_queued_observer_drop_oldest():
+    observer, queued = _queuedObserver('dropOldest', 2)
+    for i in range(1, 5):
+        queued.update(security='A Index', field='BID', data=i)
+    assert queued.summary()['dropped'] == 2 and queued.lag() > 0
+    observer.gate.set()
+    queued.close()
+    assert observer.data == [0, 3, 4] and queued.summary()['delivered'] == 3
+
+
+def test_queued_observer_conflate():
+    observer, queued = _queuedObserver('conflate', 10)
+    queued.update(security='A Index', field='BID', data=1)
+    queued.update(security='B Index', field='BID', data=2)
+    queued.update(security='A Index', field='BID', data=3)
+    assert queued.depth() == 2 and queued.summary()['conflated'] == 1
+    observer.gate.set()
+    queued.close()
+    assert observer.data == [0, 3, 2]
+
+
+def test_queued_observer_block():
+    observer, queued = _queuedObserver('block', 1)
+    queued.update(security='A Index', field='BID', data=1)
+    sender = threading.Thread(target=queued.update, kwargs={'security': 'A Index', 'field': 'BID', 'data': 2})
+    sender.start()
+    time.sleep(0.05)
+    assert sender.is_alive()  # waiting for room
+    observer.gate.set()
+    sender.join(5)
+    queued.close()
+    assert observer.data == [0, 1, 2] and queued.summary()['dropped'] == 0
+    with pytest.raises(ValueError):
+        blpapiwrapper.BLPQueuedObserver(observer, policy='newest')
+
+
+def test_recorder_and_replay(tmpdir, fakeConfig):
+    path     = str(tmpdir.join('session.blplog'))
+    recorder = blpapiwrapper.BLPRecorder(path, blockSize=2)
+    fakeConfig.bulkRows     = 2
+    fakeConfig.tickInterval = 0.005
+    blp = blpapiwrapper.BLP(pooled=True)
+    blp.session.record(recorder)
+    prices    = blp.bdp(SECURITIES, FIELDS)
+    dividends = blp.bds(SECURITIES[0], 'DVD_HIST_ALL')
+    stream    = blpapiwrapper.BLPStream(['A Index'], ['BID'], 0, [0], pooled=True)
+    stream.daemon = True
+    stream.start()
+    _waitFor(lambda: stream.counters['messages'] >= 3)
+    stream.closeSubscription()
+    blp.session.record(None)
+    recorder.close()
+
+    records = list(blpapiwrapper.BLPEventLog(path))
+    kinds   = [kind for (timestamp, kind, data) in records]
+    assert kinds.count('request') == 2 and kinds.count('subscribe') == 1
+    assert any(data['type'] == fakeblpapi.Event.SUBSCRIPTION_DATA for (timestamp, kind, data) in records if kind == 'event')
+    assert [timestamp for (timestamp, kind, data) in records] == sorted(timestamp for (timestamp, kind, data) in records)
+
+    # synthetic data would now differ, the replayed responses do not
+    blpapiwrapper.BLPSessionPool.closeAll()
+    fakeConfig.__init__()
+    fakeConfig.bulkRows = 5
+    fakeblpapi.replay(path)
+    blp = blpapiwrapper.BLP(pooled=True)
+    pandas.testing.assert_frame_equal(blp.bdp(SECURITIES, FIELDS), prices)
+    pandas.testing.assert_frame_equal(blp.bds(SECURITIES[0], 'DVD_HIST_ALL'), dividends)
+    # no synthetic ticks without tickInterval: these come from the log
+    stream = blpapiwrapper.BLPStream(['A Index'], ['BID'], 0, [0], pooled=True)
+    stream.daemon = True
+    stream.start()
+    _waitFor(lambda: not numpy.isnan(stream.output.loc['A Index', 'BID']))
+    stream.closeSubscription()
+
+
+def test_identity_pool_authorizes_once_and_after_revocation():
+    pool       = blpapiwrapper.BLPIdentityPool({'host_ip': '10.0.0.1', 'host_port': 8194})
+    identities = []
+    threads    = [threading.Thread(target=lambda: identities.append(pool.getIdentity(1234, '10.0.0.2'))) for i in range(0, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(identity is identities[0] for identity in identities)
+    assert pool.summary()['authorizations'] == 1
+
+    with pytest.raises(blpapiwrapper.BLPAuthorizationError):
+        pool.getIdentity(99, 'INVALID')
+
+    pool.session.session.revoke(identities[0], pool.identities[(1234, '10.0.0.2')].correlationId)
+    _waitFor(lambda: pool.summary()['revocations'] == 1)
+    assert pool.getIdentity(1234, '10.0.0.2') is not identities[0]
+
+
+def test_identity_pool_request_failure(fakeConfig):
+    pool = blpapiwrapper.BLPIdentityPool({'host_ip': '10.0.0.1', 'host_port': 8194}, timeout=5)
+    fakeConfig.failRequests = True
+    start = time.time()
+    with pytest.raises(blpapiwrapper.BLPAuthorizationError):
+        pool.getIdentity(1234, '10.0.0.2')
+    assert time.time() - start < 1 and pool.summary()['identities'] == 0
+    fakeConfig.failRequests = False
+    assert pool.getIdentity(1234, '10.0.0.2').authorized
+
+
+def test_blpts_keeps_identity_across_get():
+    pool     = blpapiwrapper.BLPIdentityPool({'host_ip': '10.0.0.1', 'host_port': 8194})
+    identity = pool.getIdentity(1234, '10.0.0.2')
+    blpts    = blpapiwrapper.BLPTS(SECURITIES[:2], ['PX_LAST'], sapi_dic=pool.sapi_dic, pooled=True, identity=identity)
+    blpts.get()
+    blpts.get(SECURITIES[2:], ['PX_BID'])
+    assert blpts.session.session.lastIdentity is identity